@@ -0,0 +1,191 @@
+"""Compare full JPEG decoding with draft (DCT-scaled) decoding for hashing.
+
+Usage: python bench_fast_decode.py [folder] [--limit N] [--max-distance BITS]
+                                   [--group-distance BITS]
+
+Each mode runs in its own process so images/sec and peak RSS are measured
+independently. Without a folder a small set of synthetic 12 MP JPEGs and
+benchmark.py's corpus of resized, recompressed and cropped copies are
+generated in a temporary directory. The run fails if any image's draft hash
+is more than --max-distance bits away from its full-decode hash, or if the
+draft hashes group the images into different duplicates than the full-decode
+hashes do at --group-distance. The scripts match exactly and decode fully
+because of the latter.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from clustering import cluster_groups
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg')
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MiB, or None if unknown."""
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        memory = psutil.Process().memory_info()
+        return getattr(memory, "peak_wset", memory.rss) / (1024 * 1024)
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def make_synthetic_jpegs(folder, count=12, size=(4000, 3000), seed=0):
+    """Write count random-shape JPEGs of the given size into folder."""
+    rng = random.Random(seed)
+    for i in range(count):
+        img = Image.new("RGB", size, tuple(rng.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(img)
+        for _ in range(40):
+            x, y = rng.randrange(size[0]), rng.randrange(size[1])
+            w, h = rng.randrange(100, size[0] // 2), rng.randrange(100, size[1] // 2)
+            draw.ellipse([x, y, x + w, y + h], fill=tuple(rng.randrange(256) for _ in range(3)))
+        img.save(os.path.join(folder, f"synthetic_{i:03d}.jpg"), quality=90)
+
+def make_test_images(folder):
+    """Write the synthetic 12 MP JPEGs and, under copies/, a corpus with duplicates."""
+    from benchmark import make_corpus
+    make_synthetic_jpegs(folder)
+    make_corpus(os.path.join(folder, "copies"))
+
+def list_images(folder, limit):
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(folder):
+        dirnames[:] = [d for d in dirnames if d != "Error"]
+        paths.extend(os.path.join(dirpath, name) for name in filenames if name.lower().endswith(IMAGE_EXTENSIONS))
+    paths.sort()
+    return paths[:limit] if limit else paths
+
+def run_child(mode, paths):
+    """Hash every image with both hash functions in the given decode mode; unreadable ones get None."""
+    import dupli8_working
+    import dupli_across_size2
+
+    fast_decode = mode == "draft"
+    hashes = {}
+    start = time.perf_counter()
+    for path in paths:
+        try:
+            average_hash = int(str(dupli8_working.hash_image(path, fast_decode)), 16)
+            bits = dupli_across_size2.get_image_bits(path, fast_decode)
+        except Exception:
+            hashes[path] = None
+            continue
+        hashes[path] = [average_hash, bits]
+    elapsed = time.perf_counter() - start
+
+    print(json.dumps({
+        "mode": mode,
+        "images": len(paths),
+        "seconds": elapsed,
+        "images_per_sec": len(paths) / elapsed if elapsed else None,
+        "peak_rss_mb": peak_rss_mb(),
+        "hashes": hashes,
+    }))
+
+def run_child_process(*args):
+    """Run this script with the given arguments in a fresh interpreter and return its stdout.
+
+    Linux keeps the peak RSS across fork/exec, so anything memory hungry in the
+    parent (like generating the synthetic images) would leak into the children.
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    return subprocess.run(
+        [sys.executable, os.path.abspath(__file__), *args],
+        # dupli_across_size2 opens duplicates.log in the working directory
+        cwd=tempfile.gettempdir(),
+        env={**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [script_dir, os.environ.get("PYTHONPATH")]))},
+        check=True, capture_output=True, text=True,
+    ).stdout
+
+def duplicate_groups(hashes, max_distance):
+    """Return the duplicate groups of a list of hashes as a set of frozensets of indices."""
+    return {frozenset(group) for group in cluster_groups(np.array(hashes, dtype=np.uint64), max_distance)}
+
+def run_mode(mode, folder, limit):
+    output = run_child_process("--child", mode, folder, str(limit))
+    return json.loads(output.splitlines()[-1])
+
+def main():
+    if len(sys.argv) == 5 and sys.argv[1] == "--child":
+        run_child(sys.argv[2], list_images(sys.argv[3], int(sys.argv[4])))
+        return 0
+    if len(sys.argv) > 2 and sys.argv[1] == "--generate":
+        make_test_images(sys.argv[2])
+        return 0
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("folder", nargs="?", help="folder of JPEGs to benchmark")
+    parser.add_argument("--limit", type=int, default=0, help="only use the first N images")
+    parser.add_argument("--max-distance", type=int, default=4, help="allowed Hamming distance between modes")
+    parser.add_argument("--group-distance", type=int, default=0,
+                        help="distance duplicates are grouped at when comparing the modes' groups (default: exact)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        folder = args.folder
+        if folder is None:
+            folder = scratch
+            print(f"Generating synthetic JPEGs and copies in {folder}...")
+            run_child_process("--generate", folder)
+
+        paths = list_images(folder, args.limit)
+        if not paths:
+            print(f"No JPEGs found in {folder}")
+            return 1
+
+        results = {mode: run_mode(mode, folder, args.limit) for mode in ("full", "draft")}
+
+    for mode, result in results.items():
+        rss = f"{result['peak_rss_mb']:.1f} MiB" if result["peak_rss_mb"] is not None else "n/a"
+        print(f"{mode:>5}: {result['images_per_sec']:.2f} images/sec, peak RSS {rss}")
+
+    full, draft = results["full"]["hashes"], results["draft"]["hashes"]
+    readable = [path for path in paths if full[path] is not None and draft[path] is not None]
+    if not readable:
+        print("No readable JPEGs to compare")
+        return 1
+
+    worst = 0
+    regrouped = []
+    for name, column in (("average_hash", 0), ("get_image_bits", 1)):
+        distances = [bin(full[path][column] ^ draft[path][column]).count("1") for path in readable]
+        worst = max(worst, max(distances))
+        print(f"{name}: mean Hamming distance {sum(distances) / len(distances):.2f}, max {max(distances)}")
+
+        groups = {mode: duplicate_groups([hashes[path][column] for path in readable], args.group_distance)
+                  for mode, hashes in (("full", full), ("draft", draft))}
+        copies = {mode: sum(len(group) - 1 for group in mode_groups) for mode, mode_groups in groups.items()}
+        print(f"{name}: {copies['full']} duplicate copies with a full decode, {copies['draft']} with a draft decode")
+        if groups["full"] != groups["draft"]:
+            regrouped.append(name)
+
+    failed = False
+    if worst > args.max_distance:
+        print(f"FAIL: draft hashes drift up to {worst} bits (allowed {args.max_distance})")
+        failed = True
+    if regrouped:
+        print(f"FAIL: draft decoding changes the duplicate groups of {', '.join(regrouped)} "
+              f"at distance {args.group_distance}")
+        failed = True
+    if failed:
+        return 1
+    print("OK: draft hashes stay within the allowed distance and group the images like a full decode")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,230 @@
+"""Benchmark the dedup entry points on a reproducible synthetic corpus.
+
+Usage: python benchmark.py [--originals N] [--seed S] [--workers W]
+                           [--entry NAME ...] [--output results.json]
+
+The corpus is generated offline: each original gets resized, recompressed
+and cropped copies plus the odd corrupt file, spread over "W x H" folders
+like Processed1. Every entry point runs in a fresh process on its own copy
+of the corpus and reports files/sec, time per stage, peak RSS and the number
+of duplicates it renamed. --output writes the results as JSON so runs can be
+compared.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageDraw
+
+from bench_fast_decode import peak_rss_mb
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tiff')
+ORIGINAL_SIZES = [(1100, 900), (800, 600), (1600, 1200)]
+
+def synthetic_image(rng, size):
+    """Draw a random picture of overlapping shapes."""
+    img = Image.new("RGB", size, tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        w, h = rng.randrange(size[0] // 10, size[0] // 2), rng.randrange(size[1] // 10, size[1] // 2)
+        shape = draw.ellipse if rng.random() < 0.5 else draw.rectangle
+        shape([x, y, x + w, y + h], fill=tuple(rng.randrange(256) for _ in range(3)))
+    return img
+
+def _save(img, root, name, quality=90):
+    folder = os.path.join(root, f"{img.width} x {img.height}")
+    os.makedirs(folder, exist_ok=True)
+    img.save(os.path.join(folder, name), quality=quality)
+    return os.path.join(os.path.basename(folder), name)
+
+def make_corpus(root, originals=40, seed=0):
+    """Generate the corpus under root and return its manifest.
+
+    The manifest maps each relative file path to {"group", "variant"}; files
+    sharing a group are copies of the same original. Corrupt files have
+    group None.
+    """
+    rng = random.Random(seed)
+    names = iter(rng.sample(range(100000, 999999), originals * 6))
+    manifest = {}
+
+    for group in range(originals):
+        img = synthetic_image(rng, rng.choice(ORIGINAL_SIZES))
+        variants = [("original", img, 90)]
+        if rng.random() < 0.7:
+            scale = rng.choice([0.25, 0.5, 0.75])
+            variants.append(("resized", img.resize((int(img.width * scale), int(img.height * scale))), 90))
+        if rng.random() < 0.5:
+            variants.append(("recompressed", img, rng.choice([40, 60])))
+        if rng.random() < 0.3:
+            border_x, border_y = img.width // 20, img.height // 20
+            variants.append(("cropped", img.crop((border_x, border_y, img.width - border_x, img.height - border_y)), 90))
+
+        for variant, variant_img, quality in variants:
+            path = _save(variant_img, root, f"FILE{next(names)}.jpg", quality)
+            manifest[path] = {"group": group, "variant": variant}
+
+        if rng.random() < 0.1:
+            # A truncated JPEG, the typical damage in recovered files
+            buffer = io.BytesIO()
+            img.save(buffer, "JPEG", quality=90)
+            data = buffer.getvalue()
+            folder = f"{img.width} x {img.height}"
+            path = os.path.join(folder, f"FILE{next(names)}.jpg")
+            with open(os.path.join(root, path), "wb") as f:
+                f.write(data[:rng.randrange(200, len(data) // 3)])
+            manifest[path] = {"group": None, "variant": "corrupt"}
+
+    return manifest
+
+def list_corpus_images(root):
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d != "Error"]
+        paths.extend(os.path.join(dirpath, f) for f in filenames if f.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(paths)
+
+def _dupli8_hash(paths):
+    import dupli8_working
+    for path in paths:
+        try:
+            dupli8_working.hash_image(path)
+        except Exception:
+            pass
+
+def _dupli8_dedup(root, workers):
+    import dupli8_working
+    for subfolder in sorted(os.listdir(root)):
+        subfolder_path = os.path.join(root, subfolder)
+        if os.path.isdir(subfolder_path):
+            dupli8_working.find_and_rename_duplicates_in_subfolder(subfolder_path, workers=workers)
+
+def _dupli8_global_dedup(root, workers):
+    import dupli8_working
+    dupli8_working.find_and_rename_duplicates_globally(root, workers=workers)
+
+def _across_size2_hash(paths):
+    import dupli_across_size2
+    for path in paths:
+        try:
+            dupli_across_size2.probe_fingerprint(path)
+        except Exception:
+            pass
+
+def _across_size2_dedup(root, workers):
+    import dupli_across_size2
+    dupli_across_size2.find_duplicates(root, use_cache=False)
+
+# name -> (hash-only stage, full dedup stage, pattern of names given to duplicates)
+ENTRY_POINTS = {
+    "dupli8": (_dupli8_hash, _dupli8_dedup, r"_Dupli\d+\."),
+    "dupli8_global": (_dupli8_hash, _dupli8_global_dedup, r"_Dupli\d+\."),
+    "across_size2": (_across_size2_hash, _across_size2_dedup, r"_Size([2-9]|\d\d+)_"),
+}
+
+def run_child(name, root, workers):
+    """Run one entry point on root and print its measurements as JSON."""
+    hash_stage, dedup_stage, duplicate_pattern = ENTRY_POINTS[name]
+    paths = list_corpus_images(root)
+    stages = {}
+
+    start = time.perf_counter()
+    hash_stage(paths)
+    stages["hash"] = time.perf_counter() - start
+
+    # Silence the scripts' per-file output so it does not skew the timing
+    with open(os.devnull, "w") as devnull:
+        stdout = sys.stdout
+        sys.stdout = devnull
+        start = time.perf_counter()
+        try:
+            dedup_stage(root, workers)
+        finally:
+            sys.stdout = stdout
+        stages["dedup"] = time.perf_counter() - start
+
+    duplicates = sum(
+        1 for dirpath, _, filenames in os.walk(root)
+        for filename in filenames if re.search(duplicate_pattern, filename)
+    )
+    print(json.dumps({
+        "entry": name,
+        "files": len(paths),
+        "stages": stages,
+        "files_per_sec": len(paths) / stages["dedup"] if stages["dedup"] else None,
+        "peak_rss_mb": peak_rss_mb(),
+        "duplicates_found": duplicates,
+    }))
+
+def run_entry(name, corpus_root, workers, scratch):
+    """Copy the corpus and run one entry point on the copy in a fresh interpreter."""
+    root = os.path.join(scratch, name, "Processed1")
+    shutil.copytree(corpus_root, root)
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", name, root, str(workers)],
+        # dupli_across_size2 opens duplicates.log in the working directory
+        cwd=os.path.dirname(root),
+        env={**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [script_dir, os.environ.get("PYTHONPATH")]))},
+        check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+def main():
+    if len(sys.argv) == 5 and sys.argv[1] == "--child":
+        run_child(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+        return 0
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--originals", type=int, default=40, help="number of original images in the corpus")
+    parser.add_argument("--seed", type=int, default=0, help="corpus random seed")
+    parser.add_argument("--workers", type=int, default=1, help="hash workers for entry points that support them")
+    parser.add_argument("--entry", action="append", choices=sorted(ENTRY_POINTS), help="entry point to run (default: all)")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        corpus_root = os.path.join(scratch, "corpus")
+        start = time.perf_counter()
+        manifest = make_corpus(corpus_root, args.originals, args.seed)
+        generate_seconds = time.perf_counter() - start
+
+        # Every copy beyond the first of each group is a duplicate to find
+        groups = [entry["group"] for entry in manifest.values() if entry["group"] is not None]
+        expected = len(groups) - len(set(groups))
+        results = {
+            "corpus": {
+                "originals": args.originals,
+                "seed": args.seed,
+                "files": len(manifest),
+                "corrupt": len(manifest) - len(groups),
+                "expected_duplicates": expected,
+                "generate_seconds": generate_seconds,
+            },
+            "workers": args.workers,
+            "entries": [run_entry(name, corpus_root, args.workers, scratch) for name in args.entry or ENTRY_POINTS],
+        }
+
+    print(f"Corpus: {results['corpus']['files']} files, {expected} duplicate copies")
+    for entry in results["entries"]:
+        stages = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in entry["stages"].items())
+        rss = f"{entry['peak_rss_mb']:.1f} MiB" if entry["peak_rss_mb"] is not None else "n/a"
+        print(f"{entry['entry']:>14}: {entry['files_per_sec']:.1f} files/sec ({stages}), "
+              f"peak RSS {rss}, {entry['duplicates_found']} duplicates found")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+"""Periodic JSON checkpoints so long batch runs can resume after a crash.
+
+A Checkpoint holds a JSON-serializable state dict. Callers update the state
+as they go and call tick() once per processed file; every interval files (or
+interval_seconds, whichever comes first) the state is written to disk
+atomically, so a crash loses at most one interval of work. A restarted run
+loads the file and continues from the saved state; clear() removes it once
+the job is complete.
+
+Per-file results that only ever grow (hashes, failures) go to records
+instead of the state: add_record() queues one, and each save appends the
+queued ones to a JSON Lines file next to the checkpoint. A save then writes
+only what changed since the last one, not everything recorded so far.
+"""
+import json
+import os
+import time
+
+# Files processed between two checkpoint writes
+CHECKPOINT_INTERVAL = 500
+# Longest time between two checkpoint writes while files are being processed
+CHECKPOINT_SECONDS = 60
+# Appended to the checkpoint path for the file holding the records
+RECORDS_SUFFIX = ".records.jsonl"
+
+class Checkpoint:
+    """A state dict and a list of records saved to checkpoint_path every interval ticks."""
+
+    def __init__(self, checkpoint_path, interval=CHECKPOINT_INTERVAL, interval_seconds=CHECKPOINT_SECONDS):
+        self.checkpoint_path = checkpoint_path
+        self.records_path = checkpoint_path + RECORDS_SUFFIX
+        self.interval = interval
+        self.interval_seconds = interval_seconds
+        self.state = {}
+        self.records = []
+        self.new_records = []
+        self.pending = 0
+        self.last_save = time.monotonic()
+        if os.path.exists(checkpoint_path):
+            try:
+                with open(checkpoint_path, encoding="utf-8") as f:
+                    self.state = json.load(f)
+            except (OSError, ValueError) as e:
+                # A damaged checkpoint only costs the work it recorded
+                print(f"Ignoring unreadable checkpoint {checkpoint_path}: {e}")
+        if os.path.exists(self.records_path):
+            self.records = self._load_records()
+
+    def _load_records(self):
+        records = []
+        valid_bytes = 0
+        try:
+            with open(self.records_path, "rb") as f:
+                for line in f:
+                    # A crash can leave the last line half written
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        break
+                    valid_bytes += len(line)
+            if valid_bytes != os.path.getsize(self.records_path):
+                # Cut off the broken line so the next records are not appended to it
+                with open(self.records_path, "r+b") as f:
+                    f.truncate(valid_bytes)
+        except OSError as e:
+            print(f"Ignoring unreadable checkpoint records {self.records_path}: {e}")
+        return records
+
+    @property
+    def resumed(self):
+        """Whether a saved state or saved records were loaded."""
+        return bool(self.state) or bool(self.records)
+
+    def add_record(self, record):
+        """Add a JSON-serializable record; it is written with the next save."""
+        self.records.append(record)
+        self.new_records.append(record)
+
+    def clear_records(self):
+        """Forget all records, on disk too; for when the state moves on to other work."""
+        self.records = []
+        self.new_records = []
+        if os.path.exists(self.records_path):
+            os.remove(self.records_path)
+
+    def tick(self, count=1):
+        """Count processed items and save when the interval is reached."""
+        self.pending += count
+        if self.pending >= self.interval or time.monotonic() - self.last_save >= self.interval_seconds:
+            self.save()
+
+    def save(self):
+        """Append the new records and write the state now, replacing the previous state atomically."""
+        if self.new_records:
+            with open(self.records_path, "a", encoding="utf-8") as f:
+                f.writelines(json.dumps(record) + "\n" for record in self.new_records)
+                f.flush()
+                os.fsync(f.fileno())
+            self.new_records = []
+        temp_path = self.checkpoint_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.checkpoint_path)
+        self.pending = 0
+        self.last_save = time.monotonic()
+
+    def clear(self):
+        """Forget the state and records and delete the checkpoint files."""
+        self.state = {}
+        self.pending = 0
+        self.clear_records()
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
@@ -1,9 +1,16 @@
 import os
 import shutil
+import time
 from torchvision import models, transforms
 from PIL import Image
 import torch
 import torch.nn as nn
+from checkpoint import CHECKPOINT_INTERVAL, Checkpoint
+from cpu_inference import build_backend
+from scan_pipeline import TreeScanner
+from image_loader import LOADER_WORKERS, load_batches
+from prefetch import Prefetcher, open_image
+from thumb_store import ThumbStore, store_folder_for
 
 # Define the categories
 CATEGORIES = ["Document", "Screenshot", "Meme", "Photograph"]
@@ -11,6 +18,19 @@ CATEGORIES = ["Document", "Screenshot", "Meme", "Photograph"]
 # Ignore folder
 IGNORE_FOLDER = "Error"
 
+# Progress file kept in the target folder while it is being classified
+CHECKPOINT_FILENAME = ".classi2.checkpoint"
+
+# Classify from the shared thumbnail store next to SOURCE_DIR instead of decoding every file
+USE_THUMB_STORE = False
+
+# Images classified together in one forward pass
+BATCH_SIZE = 32
+# Threads torch uses for a forward pass; None keeps torch's default of one per core
+INFERENCE_THREADS = None
+# CPU backend for the model: "eager", "int8", "torchscript" or "onnx" (see cpu_inference.py; check it there first)
+INFERENCE_BACKEND = "eager"
+
 # Transform for input images
 transform = transforms.Compose([
     transforms.Resize((224, 224)),
@@ -18,23 +38,110 @@ transform = transforms.Compose([
     transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
 ])
 
-# Load the pre-trained AlexNet model
-model = models.alexnet(pretrained=True)
-model.classifier[6] = nn.Linear(4096, len(CATEGORIES))  # Update the output layer to match the number of categories
-model.eval()
+# The pre-trained AlexNet model, loaded by load_model() so loader worker processes do not load it too
+model = None
+
+def load_model():
+    global model
+    if model is None:
+        model = models.alexnet(pretrained=True)
+        model.classifier[6] = nn.Linear(4096, len(CATEGORIES))  # Update the output layer to match the number of categories
+        model.eval()
+    return model
+
+def load_image(image_path, data=None, thumbs=None):
+    """Open an image as RGB, from memory, the thumbnail store or the file."""
+    if thumbs is not None:
+        # Already 224x224, so the Resize in transform costs nothing
+        return thumbs.image(image_path, "rgb224", data)
+    return (open_image(data) if data is not None else Image.open(image_path)).convert('RGB')
+
+def predict_batch(batch, model):
+    """Return the category of each image in a stacked batch, from one inference-mode forward pass."""
+    with torch.inference_mode():
+        outputs = model(batch)
+    return [CATEGORIES[index] for index in outputs.argmax(dim=1).tolist()]
+
+def predict_tensors(tensors, model):
+    """Return the category of each transformed image, from one inference-mode forward pass."""
+    return predict_batch(torch.stack(tensors), model)
 
 # Function to classify images
-def classify_image(image_path, model):
+def classify_image(image_path, model, data=None, thumbs=None):
     try:
-        image = Image.open(image_path).convert('RGB')
-        image_tensor = transform(image).unsqueeze(0)
-        outputs = model(image_tensor)
-        _, predicted = torch.max(outputs, 1)
-        return CATEGORIES[predicted.item()]
+        return predict_tensors([transform(load_image(image_path, data, thumbs))], model)[0]
     except Exception as e:
         print(f"Error processing {image_path}: {e}")
         return None
 
+class BatchClassifier:
+    """Collect transformed images and classify them batch_size at a time.
+
+    add() and flush() return (key, category) for every image whose batch has
+    run; category is None if the image could not be classified. classify()
+    runs a batch that was stacked elsewhere, such as by image_loader. threads
+    sets torch's thread count for the whole process.
+    """
+
+    def __init__(self, model, batch_size=BATCH_SIZE, threads=INFERENCE_THREADS):
+        if threads:
+            torch.set_num_threads(threads)
+        self.model = model
+        self.batch_size = batch_size
+        self.pending = []
+        self.images = 0
+        self.batches = 0
+        self.transform_seconds = 0.0
+        self.inference_seconds = 0.0
+        self.start = None
+
+    def add(self, key, image):
+        self._started()
+        start = time.perf_counter()
+        try:
+            tensor = transform(image)
+        except Exception as e:
+            print(f"Error processing {key}: {e}")
+            return [(key, None)]
+        finally:
+            self.transform_seconds += time.perf_counter() - start
+        self.pending.append((key, tensor))
+        if len(self.pending) >= self.batch_size:
+            return self.flush()
+        return []
+
+    def flush(self):
+        if not self.pending:
+            return []
+        batch, self.pending = self.pending, []
+        return self.classify([key for key, _ in batch], torch.stack([tensor for _, tensor in batch]))
+
+    def classify(self, keys, batch):
+        """Classify a stacked batch and return (key, category) for each of its rows."""
+        self._started()
+        start = time.perf_counter()
+        try:
+            categories = predict_batch(batch, self.model)
+        except Exception as e:
+            print(f"Error classifying a batch of {len(keys)} images: {e}")
+            categories = [None] * len(keys)
+        self.inference_seconds += time.perf_counter() - start
+        self.images += len(keys)
+        self.batches += 1
+        return list(zip(keys, categories))
+
+    def _started(self):
+        if self.start is None:
+            self.start = time.perf_counter()
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start if self.start is not None else 0.0
+        inference_rate = self.images / self.inference_seconds if self.inference_seconds else 0.0
+        overall_rate = self.images / elapsed if elapsed else 0.0
+        return (f"Classified {self.images} images in {self.batches} batches of up to {self.batch_size}: "
+                f"{inference_rate:.1f} img/s in inference ({self.inference_seconds:.1f}s), "
+                f"{self.transform_seconds:.1f}s transforming, {overall_rate:.1f} img/s overall")
+
 # Function to create subfolders
 def create_subfolders(target_dir, categories):
     for category in categories:
@@ -42,44 +149,101 @@ def create_subfolders(target_dir, categories):
         os.makedirs(category_path, exist_ok=True)
 
 # Function to process images in the directory
-def process_directory(source_dir, target_dir, model, categories, ignore_folder):
-    total_files = sum([len(files) for r, d, files in os.walk(source_dir) if IGNORE_FOLDER not in r])
-    processed_files = 0
+def process_directory(source_dir, target_dir, model, categories, ignore_folder, checkpoint_interval=CHECKPOINT_INTERVAL,
+                      thumbs=None, batch_size=BATCH_SIZE, threads=INFERENCE_THREADS, workers=LOADER_WORKERS,
+                      backend=INFERENCE_BACKEND):
+    # Classified files are moved out of the scan as they go, so a restart only has to
+    # remember the running count. Files that could not be classified stay where they
+    # are, recorded as checkpoint records, and a resumed run tries them once more
+    checkpoint = Checkpoint(os.path.join(target_dir, CHECKPOINT_FILENAME), checkpoint_interval)
+    retried = len(checkpoint.records)
+    processed_files = checkpoint.state.get("processed", 0) - retried
+    if checkpoint.resumed:
+        print(f"Resuming {source_dir}: {processed_files} files done, {retried} failed files to retry")
+    checkpoint.clear_records()
 
-    for root, dirs, files in os.walk(source_dir):
-        # Skip the ignore folder
-        if IGNORE_FOLDER in root:
-            continue
+    def is_candidate(entry):
+        name = entry.name.lower()
+        return name.endswith((".jpg", ".jpeg", ".png", ".bmp", ".tiff")) and not name.endswith((".xxjpg"))
+
+    def is_scanned(dirpath):
+        return ignore_folder not in dirpath
+
+    # Files already moved into the category folders need no second pass
+    def should_descend(entry):
+        return not (os.path.dirname(entry.path) == target_dir and entry.name in categories)
+
+    scanner = TreeScanner(source_dir, dir_filter=is_scanned, descend=should_descend, entry_filter=is_candidate)
+    # Images are classified batch_size at a time; files are moved as their batch finishes
+    classifier = BatchClassifier(build_backend(model, backend, threads=threads), batch_size, threads)
+
+    def finish(entry, category):
+        nonlocal processed_files
+        file_path = entry.path
+        try:
+            if category:
+                category_path = os.path.join(target_dir, category)
+                os.makedirs(category_path, exist_ok=True)
+
+                # Move the file to the category folder
+                shutil.move(file_path, os.path.join(category_path, entry.name))
+            else:
+                checkpoint.add_record(file_path)
 
-        for file in files:
-            file_path = os.path.join(root, file)
-            if file.lower().endswith((".jpg", ".jpeg", ".png", ".bmp", ".tiff")) and not file.lower().endswith((".xxjpg")):
-                try:
-                    print(f"Processing file: {file_path}")
-                    category = classify_image(file_path, model)
-
-                    if category:
-                        category_path = os.path.join(target_dir, category)
-                        os.makedirs(category_path, exist_ok=True)
-
-                        # Move the file to the category folder
-                        shutil.move(file_path, os.path.join(category_path, file))
-                    
-                    processed_files += 1
-                    percentage_completed = (processed_files / total_files) * 100
-                    print(f"Completed: {percentage_completed:.2f}%")
-                except Exception as e:
-                    print(f"Error processing file {file_path}: {e}")
-
-        # Rename the folder as _Done after processing all files
-        if not files:
-            new_folder_name = root + "_Classified"
-            os.rename(root, new_folder_name)
+            processed_files += 1
+            checkpoint.state["processed"] = processed_files
+            checkpoint.tick()
+            total = f"{scanner.discovered}" if scanner.finished else f"{scanner.discovered}+"
+            print(f"Completed: {processed_files}/{total} files")
+        except Exception as e:
+            print(f"Error processing file {file_path}: {e}")
+
+    # Classification starts as soon as the first folder is listed
+    if thumbs is None and workers > 0:
+        # Worker processes decode and transform upcoming batches while the current one is classified
+        for batch in load_batches(scanner, transform, batch_size, workers):
+            for error in batch.errors:
+                print(f"Error processing {error.item.path}: {error.stage} failed with {error.error_type}: {error.message}")
+                finish(error.item, None)
+            if batch.items:
+                for done, category in classifier.classify(batch.items, batch.tensor):
+                    finish(done, category)
+    else:
+        # Upcoming files are read while the current one is classified
+        prefetcher = Prefetcher(scanner)
+        for entry, data, _ in prefetcher:
+            print(f"Processing file: {entry.path}")
+            try:
+                image = load_image(entry.path, data, thumbs)
+            except Exception as e:
+                print(f"Error processing {entry.path}: {e}")
+                finish(entry, None)
+                continue
+            for done, category in classifier.add(entry, image):
+                finish(done, category)
+        for done, category in classifier.flush():
+            finish(done, category)
+        print(prefetcher.stats.summary())
+    print(classifier.summary())
+
+    # Rename folders that held no files as _Classified, deepest first, now that the scan is over.
+    # source_dir itself is renamed by the caller.
+    for dirpath in reversed(scanner.empty_dirs):
+        if dirpath == source_dir or not is_scanned(dirpath):
+            continue
+        if any(os.path.isfile(os.path.join(dirpath, name)) for name in os.listdir(dirpath)):
+            continue
+        new_folder_name = dirpath + "_Classified"
+        os.rename(dirpath, new_folder_name)
+    checkpoint.clear()
 
 if __name__ == "__main__":
     # Directory paths
     SOURCE_DIR = "F:\\ULTFONE_20240829_175529\\E\\Lost Files\\File Name Lost\\jpg\\JPG\\2024\\Processed1\\"
 
+    thumbs = ThumbStore(store_folder_for(SOURCE_DIR)) if USE_THUMB_STORE else None
+    model = load_model()
+
     # Iterate through each subfolder in the source directory
     for subdir in os.listdir(SOURCE_DIR):
         subdir_path = os.path.join(SOURCE_DIR, subdir)
@@ -91,7 +255,9 @@ if __name__ == "__main__":
                 create_subfolders(TARGET_DIR, CATEGORIES)
 
                 # Process images and classify them
-                process_directory(subdir_path, TARGET_DIR, model, CATEGORIES, IGNORE_FOLDER)
+                process_directory(subdir_path, TARGET_DIR, model, CATEGORIES, IGNORE_FOLDER, thumbs=thumbs,
+                                  batch_size=BATCH_SIZE, threads=INFERENCE_THREADS, workers=LOADER_WORKERS,
+                                  backend=INFERENCE_BACKEND)
 
                 # Rename the folder as _Classified after processing all files
                 new_folder_name = subdir_path + "_Classified"
@@ -99,3 +265,5 @@ if __name__ == "__main__":
                 print(f"Finished processing folder: {subdir_path}")
             except Exception as e:
                 print(f"Error processing folder {subdir_path}: {e}")
+    if thumbs is not None:
+        thumbs.close()
@@ -0,0 +1,186 @@
+"""Group near-duplicate hashes into clusters with union-find.
+
+With a distance threshold, "is a duplicate of" is not transitive: A~B and
+B~C do not imply A~C. Clustering links every candidate pair (hashes at most
+max_distance bits apart) and takes the connected components, so A, B and C
+end up in one group. An optional max_diameter caps how far apart two members
+of one cluster may be; it is enforced with per-cluster AND/OR bit envelopes
+(bits on which all members agree), which bound the largest pairwise distance
+from above without comparing every pair.
+
+Candidate pairs are found among the distinct hashes by sorting on blocks of
+bits that near duplicates must share, with no per-hash tree queries, and are
+consumed in chunks of numpy arrays. Memory is bounded by the number of
+distinct hashes plus one chunk, not by the number of pairs.
+"""
+import itertools
+import math
+
+import numpy as np
+
+import hash_engine
+
+# Candidate pairs handled per batch
+PAIR_CHUNK_SIZE = 1_000_000
+
+def _block_masks(count, bits=64):
+    """Split the hash into count bit ranges and return one mask per range."""
+    masks, shift = [], bits
+    for i in range(count):
+        width = bits // count + (1 if i < bits % count else 0)
+        shift -= width
+        masks.append(((1 << width) - 1) << shift)
+    return masks
+
+def _block_count(hash_count, max_distance, bits=64):
+    """Pick how many blocks to split hashes into for the fewest expected comparisons.
+
+    More blocks mean more passes (one per choice of matching blocks) but
+    longer, more selective keys. Sorting is weighted as roughly 8 times
+    cheaper per element than comparing a pair.
+    """
+    log_n = math.log2(max(hash_count, 2))
+
+    def cost(count):
+        key_bits = bits * (count - max_distance) / count
+        return math.comb(count, max_distance) * (hash_count * log_n + 8 * hash_count ** 2 / 2 ** key_bits)
+
+    return min(range(max_distance + 1, min(bits, max_distance + 12) + 1), key=cost)
+
+def candidate_pairs(hashes, max_distance, distance=None, chunk_size=PAIR_CHUNK_SIZE):
+    """Yield (a, b) index arrays of hash pairs at most max_distance bits apart.
+
+    Split into n blocks, two hashes that far apart still agree exactly on at
+    least n - max_distance of them (pigeonhole). Each pass sorts the hashes on
+    one such choice of blocks and compares only hashes with equal keys, all in
+    numpy. A pair can be yielded once per pass it matches in. With distance,
+    only pairs exactly that far apart are yielded.
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    masks = _block_masks(_block_count(len(hashes), max_distance))
+    first, second, pending = [], [], 0
+    for chosen in itertools.combinations(masks, len(masks) - max_distance):
+        keys = hashes & np.uint64(sum(chosen))
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        # End (exclusive) of the run of equal keys each sorted position belongs to
+        run_starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        run_lengths = np.diff(np.r_[run_starts, len(order)])
+        run_ends = np.repeat(run_starts + run_lengths, run_lengths)
+
+        # Compare each position with the one offset places after it in the same run
+        positions = np.flatnonzero(np.repeat(run_lengths, run_lengths) > 1)
+        offset = 1
+        while len(positions):
+            positions = positions[positions + offset < run_ends[positions]]
+            a, b = order[positions], order[positions + offset]
+            distances = hash_engine.hamming(hashes[a], hashes[b])
+            keep = distances <= max_distance if distance is None else distances == distance
+            if keep.any():
+                first.append(a[keep])
+                second.append(b[keep])
+                pending += int(keep.sum())
+            if pending >= chunk_size:
+                yield np.concatenate(first), np.concatenate(second)
+                first, second, pending = [], [], 0
+            offset += 1
+    if first:
+        yield np.concatenate(first), np.concatenate(second)
+
+def _roots(parent, nodes):
+    roots = parent[nodes]
+    while True:
+        next_roots = parent[roots]
+        if np.array_equal(next_roots, roots):
+            return roots
+        roots = next_roots
+
+def _compress(parent):
+    while True:
+        next_parent = parent[parent]
+        if np.array_equal(next_parent, parent):
+            return parent
+        parent = next_parent
+
+def union_pairs(parent, a, b):
+    """Union every (a[i], b[i]) pair into the forest parent, in place and vectorized.
+
+    Each root points at the smallest index of its component, so the result
+    does not depend on the order of the pairs.
+    """
+    while len(a):
+        root_a, root_b = _roots(parent, a), _roots(parent, b)
+        apart = root_a != root_b
+        if not apart.any():
+            break
+        root_a, root_b = root_a[apart], root_b[apart]
+        np.minimum.at(parent, np.maximum(root_a, root_b), np.minimum(root_a, root_b))
+        a, b = a[apart], b[apart]
+    parent[:] = _compress(parent)
+
+def _union_within_diameter(parent, and_envelope, or_envelope, a, b, max_diameter):
+    """Union pairs one at a time, skipping merges that could exceed max_diameter bits."""
+    for i, j in zip(a.tolist(), b.tolist()):
+        root_i, root_j = i, j
+        while parent[root_i] != root_i:
+            root_i = parent[root_i]
+        while parent[root_j] != root_j:
+            root_j = parent[root_j]
+        if root_i == root_j:
+            continue
+        merged_and = int(and_envelope[root_i]) & int(and_envelope[root_j])
+        merged_or = int(or_envelope[root_i]) | int(or_envelope[root_j])
+        if (merged_and ^ merged_or).bit_count() > max_diameter:
+            continue
+        low, high = min(root_i, root_j), max(root_i, root_j)
+        parent[high] = low
+        and_envelope[low] = merged_and
+        or_envelope[low] = merged_or
+    parent[:] = _compress(parent)
+
+def cluster_labels(hashes, max_distance, max_diameter=None, chunk_size=PAIR_CHUNK_SIZE):
+    """Return a cluster label per hash: the smallest index in its cluster.
+
+    Hashes at most max_distance bits apart are linked, transitively. With
+    max_diameter, closer pairs are linked first and a link is skipped when
+    the merged cluster's members could differ in more than max_diameter bits.
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    if len(hashes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    distinct, first_row, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+    # Number the distinct hashes by first appearance so labels follow row order
+    order = np.argsort(first_row, kind="stable")
+    distinct = distinct[order]
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    inverse = rank[inverse.ravel()]
+
+    parent = np.arange(len(distinct), dtype=np.int64)
+    if max_distance > 0:
+        if max_diameter is None:
+            for a, b in candidate_pairs(distinct, max_distance, chunk_size=chunk_size):
+                union_pairs(parent, a, b)
+        else:
+            and_envelope = distinct.copy()
+            or_envelope = distinct.copy()
+            for distance in range(1, max_distance + 1):
+                for a, b in candidate_pairs(distinct, max_distance, distance, chunk_size):
+                    _union_within_diameter(parent, and_envelope, or_envelope, a, b, max_diameter)
+
+    # Map each row to the first row of its cluster
+    cluster_first_row = first_row[order]
+    return cluster_first_row[parent[inverse]]
+
+def cluster_groups(hashes, max_distance, max_diameter=None, chunk_size=PAIR_CHUNK_SIZE):
+    """Return lists of row indices for clusters of more than one row.
+
+    Clusters are ordered by their first row and rows within a cluster by index;
+    choosing which member to keep is left to the caller.
+    """
+    labels = cluster_labels(hashes, max_distance, max_diameter, chunk_size)
+    order = np.argsort(labels, kind="stable")
+    boundaries = np.flatnonzero(labels[order][1:] != labels[order][:-1]) + 1
+    groups = [group.tolist() for group in np.split(order, boundaries) if len(group) > 1]
+    groups.sort(key=lambda group: group[0])
+    return groups
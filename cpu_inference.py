@@ -0,0 +1,174 @@
+"""Run the category classifier on an optimized CPU backend.
+
+Usage: python cpu_inference.py <folder> [--backend int8] [--limit N] [--batch-size N]
+
+The classify machines have no GPU, and the fp32 AlexNet in classi2 is the
+slowest stage of the workflow. build_backend() returns a stand-in for the
+model that runs on one of BACKENDS:
+
+    eager        the model as loaded
+    int8         dynamic int8 quantization of the Linear layers, which hold
+                 almost all of AlexNet's weights
+    torchscript  traced, frozen and optimized for inference
+    onnx         exported to ONNX and run by onnxruntime, if it is installed
+
+Run as a script it classifies the images of a folder with the eager model
+and with each backend asked for, and reports the backends' agreement with
+the eager model's categories, their largest output difference and their
+throughput. It fails if a backend agrees on fewer than MIN_AGREEMENT of the
+images; check a backend this way before setting it in classi2.
+"""
+import argparse
+import copy
+import os
+import sys
+import tempfile
+import time
+
+import torch
+import torch.nn as nn
+
+from image_loader import load_batches
+
+BACKENDS = ("eager", "int8", "torchscript", "onnx")
+# Share of images a backend must classify as the eager model does
+MIN_AGREEMENT = 0.98
+# Timed runs over the images per backend; the fastest counts
+TIMING_REPEATS = 3
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tiff")
+
+# (id(model), backend, onnx threads) -> built model, so a backend is built once per process
+_built = {}
+
+def quantize_int8(model):
+    """Copy of model with its Linear layers quantized to int8, weights ahead of time and activations per batch."""
+    return torch.ao.quantization.quantize_dynamic(copy.deepcopy(model), {nn.Linear}, dtype=torch.qint8)
+
+def to_torchscript(model, example):
+    """model traced on example, frozen and optimized for inference."""
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+    return torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+class OnnxModel:
+    """A model exported to ONNX, called like the torch model it came from."""
+
+    def __init__(self, model, example, threads=None):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise RuntimeError("The onnx backend needs the onnxruntime package") from None
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        with tempfile.TemporaryDirectory() as scratch:
+            path = os.path.join(scratch, "model.onnx")
+            torch.onnx.export(model, example, path, input_names=["input"], output_names=["output"],
+                              dynamic_axes={"input": {0: "batch"}, "output": {0: "batch"}})
+            self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    def __call__(self, batch):
+        outputs = self.session.run(None, {"input": batch.contiguous().numpy()})[0]
+        return torch.from_numpy(outputs)
+
+def build_backend(model, backend, input_size=224, threads=None):
+    """Return model prepared for the given backend; eval mode, called on a batch of input_size images.
+
+    threads is the number of threads an onnx session uses; None takes torch's
+    current setting. The torch backends follow torch.set_num_threads when called.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {backend!r}; expected one of {', '.join(BACKENDS)}")
+    if backend == "eager":
+        return model
+    threads = threads or torch.get_num_threads()
+    key = (id(model), backend, threads if backend == "onnx" else None)
+    if key not in _built:
+        example = torch.randn(1, 3, input_size, input_size)
+        start = time.perf_counter()
+        if backend == "int8":
+            built = quantize_int8(model)
+        elif backend == "torchscript":
+            built = to_torchscript(model, example)
+        else:
+            built = OnnxModel(model, example, threads)
+        print(f"Built the {backend} backend in {time.perf_counter() - start:.1f}s")
+        # The model is kept so its id is not reused while the entry exists
+        _built[key] = (model, built)
+    return _built[key][1]
+
+def run(model, batches):
+    """Outputs of model for every batch, and the seconds the fastest of TIMING_REPEATS runs took."""
+    best = None
+    for _ in range(TIMING_REPEATS):
+        start = time.perf_counter()
+        with torch.inference_mode():
+            outputs = [model(batch) for batch in batches]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return outputs, best
+
+def compare_backends(model, backends, batches):
+    """Compare each backend with the eager model on the same batches.
+
+    Returns one dict per backend, eager first: images/sec, the share of
+    images given the same category as the eager model, and the largest
+    absolute difference from the eager model's softmax outputs.
+    """
+    images = sum(len(batch) for batch in batches)
+    reference, reference_seconds = run(model, batches)
+    reference_labels = [output.argmax(dim=1) for output in reference]
+    results = [{"backend": "eager", "images_per_sec": images / reference_seconds, "agreement": 1.0, "max_delta": 0.0}]
+    for backend in backends:
+        if backend == "eager":
+            continue
+        outputs, seconds = run(build_backend(model, backend, batches[0].shape[-1]), batches)
+        agreed = sum(int((output.argmax(dim=1) == labels).sum()) for output, labels in zip(outputs, reference_labels))
+        max_delta = max(
+            float((torch.softmax(output.float(), dim=1) - torch.softmax(expected.float(), dim=1)).abs().max())
+            for output, expected in zip(outputs, reference)
+        )
+        results.append({"backend": backend, "images_per_sec": images / seconds,
+                        "agreement": agreed / images, "max_delta": max_delta})
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("folder", help="folder of images to classify")
+    parser.add_argument("--backend", action="append", choices=[b for b in BACKENDS if b != "eager"],
+                        help="backend to compare with the eager model (repeatable; default: int8 and torchscript)")
+    parser.add_argument("--limit", type=int, default=256, help="images to use, 0 for all")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--min-agreement", type=float, default=MIN_AGREEMENT)
+    args = parser.parse_args()
+
+    import classi2
+
+    paths = sorted(
+        os.path.join(root, name) for root, _, files in os.walk(args.folder)
+        for name in files if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    if args.limit:
+        paths = paths[:args.limit]
+    batches = [batch.tensor for batch in load_batches(paths, classi2.transform, args.batch_size) if batch.items]
+    if not batches:
+        print(f"No readable images found in {args.folder}")
+        return 1
+
+    try:
+        results = compare_backends(classi2.load_model(), args.backend or ["int8", "torchscript"], batches)
+    except RuntimeError as e:
+        print(e)
+        return 1
+    failed = False
+    print(f"{sum(len(batch) for batch in batches)} images in batches of up to {args.batch_size}")
+    for result in results:
+        ok = result["agreement"] >= args.min_agreement
+        failed = failed or not ok
+        print(f"{result['backend']:>11}: {result['images_per_sec']:8.1f} img/s, "
+              f"{result['agreement']:.1%} agree with eager, max softmax delta {result['max_delta']:.4f}"
+              f"{'' if ok else '  BELOW --min-agreement'}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,11 @@
 import os
 import hashlib
+import mmap
 import shutil
 from PIL import Image
 import imagehash
-from pytesseract import image_to_string
 from tqdm import tqdm
+from text_detect import TextDetector, default_cache_path, measure_file
 
 # Hardcoded paths
 INPUT_DIRECTORY = "F:\duplicates"  # Replace with the path to the directory you want to scan
@@ -13,6 +14,15 @@ DUPLICATES_FOLDER = os.path.join(OUTPUT_FOLDER, "Duplicates")
 ERROR_FOLDER = os.path.join(OUTPUT_FOLDER, "Error")
 DOCUMENT_FOLDER = os.path.join(OUTPUT_FOLDER, "Document")
 
+# Hash used for non-image files: any hashlib name, or "xxhash" for a fast non-cryptographic hash
+FILE_HASH_ALGORITHM = "sha256"
+# Bytes hashed from each end of a file before deciding whether to hash all of it
+PARTIAL_HASH_BYTES = 64 * 1024
+# Images with more words than this are moved to DOCUMENT_FOLDER
+TEXT_WORD_THRESHOLD = 10
+# OCR word counts by file contents, kept next to INPUT_DIRECTORY so reruns skip OCR
+OCR_CACHE_PATH = default_cache_path(INPUT_DIRECTORY)
+
 def calculate_image_hash(image_path):
     """Calculate a perceptual hash for an image."""
     try:
@@ -22,25 +32,111 @@ def calculate_image_hash(image_path):
         print(f"Error processing image {image_path}: {e}")
         return None
 
-def calculate_file_hash(file_path, chunk_size=1024 * 1024):
-    """Calculate a SHA256 hash for a file."""
-    hash_func = hashlib.sha256()
+def new_hash_func(algorithm=FILE_HASH_ALGORITHM):
+    """Create a hash object; "xxhash" uses the xxhash package and falls back to blake2b."""
+    if algorithm == "xxhash":
+        try:
+            import xxhash
+        except ImportError:
+            return hashlib.blake2b()
+        return xxhash.xxh3_128()
+    return hashlib.new(algorithm)
+
+def calculate_file_hash(file_path, chunk_size=16 * 1024 * 1024, algorithm=FILE_HASH_ALGORITHM):
+    """Calculate a hash of a whole file, memory-mapping it where possible."""
+    hash_func = new_hash_func(algorithm)
+    try:
+        with open(file_path, "rb") as f:
+            try:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                # Empty files and some network shares cannot be mapped
+                while chunk := f.read(chunk_size):
+                    hash_func.update(chunk)
+            else:
+                with mapped, memoryview(mapped) as view:
+                    for start in range(0, len(view), chunk_size):
+                        hash_func.update(view[start:start + chunk_size])
+    except Exception as e:
+        print(f"Error processing file {file_path}: {e}")
+        return None
+    return hash_func.hexdigest()
+
+def calculate_partial_hash(file_path, file_size, edge_bytes=PARTIAL_HASH_BYTES, algorithm=FILE_HASH_ALGORITHM):
+    """Hash only the first and last edge_bytes of a file."""
+    hash_func = new_hash_func(algorithm)
     try:
         with open(file_path, "rb") as f:
-            while chunk := f.read(chunk_size):
-                hash_func.update(chunk)
+            hash_func.update(f.read(edge_bytes))
+            if file_size > 2 * edge_bytes:
+                f.seek(-edge_bytes, os.SEEK_END)
+            hash_func.update(f.read(edge_bytes))
     except Exception as e:
         print(f"Error processing file {file_path}: {e}")
         return None
     return hash_func.hexdigest()
 
-def contains_text(image_path, text_threshold=10):
+def _group_by_hash(file_paths, hash_file, errors):
+    """Split file_paths into groups of two or more with equal hashes, keeping order."""
+    groups = {}
+    for file_path in file_paths:
+        file_hash = hash_file(file_path)
+        if file_hash is None:
+            errors.append(file_path)
+        else:
+            groups.setdefault(file_hash, []).append(file_path)
+    return [group for group in groups.values() if len(group) > 1]
+
+def find_exact_duplicates(file_paths, algorithm=FILE_HASH_ALGORITHM, edge_bytes=PARTIAL_HASH_BYTES):
+    """Group byte-identical files by size, then by a head/tail hash, then by a full hash.
+
+    Returns (groups, errors): each group lists identical files in input order,
+    errors lists files that could not be read. Files with a unique size are
+    never opened, and files no larger than 2 * edge_bytes are fully covered
+    by the partial hash.
+    """
+    errors = []
+    by_size = {}
+    for file_path in file_paths:
+        try:
+            file_size = os.stat(file_path).st_size
+        except OSError as e:
+            print(f"Error processing file {file_path}: {e}")
+            errors.append(file_path)
+            continue
+        by_size.setdefault(file_size, []).append(file_path)
+
+    groups = []
+    total_bytes = 0
+    bytes_read = 0
+    for file_size, same_size in by_size.items():
+        total_bytes += file_size * len(same_size)
+        if len(same_size) < 2:
+            continue
+
+        bytes_read += min(file_size, 2 * edge_bytes) * len(same_size)
+        partial_groups = _group_by_hash(
+            same_size, lambda path: calculate_partial_hash(path, file_size, edge_bytes, algorithm), errors
+        )
+        if file_size <= 2 * edge_bytes:
+            groups.extend(partial_groups)
+            continue
+
+        for candidates in partial_groups:
+            bytes_read += file_size * len(candidates)
+            groups.extend(_group_by_hash(
+                candidates, lambda path: calculate_file_hash(path, algorithm=algorithm), errors
+            ))
+
+    print(f"Exact duplicate scan read {bytes_read:,} of {total_bytes:,} bytes")
+    return groups, errors
+
+def contains_text(image_path, text_threshold=TEXT_WORD_THRESHOLD):
     """Check if the image contains significant text content."""
     try:
-        with Image.open(image_path) as img:
-            text = image_to_string(img)
-        # Count the number of words detected
-        return len(text.strip().split()) > text_threshold
+        # Count the number of words detected; images without text-like strokes are not OCRed
+        words, _ = measure_file(image_path, "words")
+        return words > text_threshold
     except Exception as e:
         print(f"Error performing OCR on {image_path}: {e}")
         return False
@@ -53,42 +149,66 @@ def move_file(file_path, dest_folder):
     shutil.move(file_path, dest_path)
     print(f"Moved: {file_path} -> {dest_path}")
 
-def find_and_categorize_files(directory, include_images=True):
+def find_and_categorize_files(directory, include_images=True, algorithm=FILE_HASH_ALGORITHM, ocr_cache_path=None):
     """Find duplicates and categorize files into subfolders."""
     hash_map = {}
     duplicates = []
+    image_files = []
+    other_files = []
 
     for root, _, files in os.walk(directory):
-        for file in tqdm(files, desc="Processing files"):
+        for file in files:
             file_path = os.path.join(root, file)
 
             # Process images separately
             if include_images and file.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tiff')):
-                if contains_text(file_path):  # Check for text in the image
-                    move_file(file_path, DOCUMENT_FOLDER)
-                    continue
-                
-                file_hash = calculate_image_hash(file_path)
+                image_files.append(file_path)
             else:
-                file_hash = calculate_file_hash(file_path)
+                # Byte-exact duplicates are found in one staged pass after the walk
+                other_files.append(file_path)
 
-            # Handle errors during processing
-            if file_hash is None:
-                move_file(file_path, ERROR_FOLDER)
-                continue
+    # Check for text in the images: OCR runs in a process pool, only on images the
+    # prefilter finds text-like strokes in, and once per file contents
+    word_counts = {}
+    if image_files:
+        with TextDetector(ocr_cache_path) as detector:
+            word_counts = detector.measure(image_files, "words")
+            print(detector.summary())
 
-            # Detect duplicates
-            if file_hash in hash_map:
-                duplicates.append(file_path)
-                move_file(file_path, DUPLICATES_FOLDER)
-            else:
-                hash_map[file_hash] = file_path
+    for file_path in tqdm(image_files, desc="Processing images"):
+        words = word_counts[file_path]
+        if words is not None and words > TEXT_WORD_THRESHOLD:
+            move_file(file_path, DOCUMENT_FOLDER)
+            continue
+
+        file_hash = calculate_image_hash(file_path)
+
+        # Handle errors during processing
+        if file_hash is None:
+            move_file(file_path, ERROR_FOLDER)
+            continue
+
+        # Detect duplicates
+        if file_hash in hash_map:
+            duplicates.append(file_path)
+            move_file(file_path, DUPLICATES_FOLDER)
+        else:
+            hash_map[file_hash] = file_path
+
+    groups, errors = find_exact_duplicates(other_files, algorithm)
+    for file_path in errors:
+        move_file(file_path, ERROR_FOLDER)
+    for group in groups:
+        # Keep the first file found, like the image path above
+        for file_path in group[1:]:
+            duplicates.append(file_path)
+            move_file(file_path, DUPLICATES_FOLDER)
 
     return duplicates
 
 def main():
     print(f"Scanning and categorizing files in {INPUT_DIRECTORY}...")
-    duplicates = find_and_categorize_files(INPUT_DIRECTORY, include_images=True)
+    duplicates = find_and_categorize_files(INPUT_DIRECTORY, include_images=True, ocr_cache_path=OCR_CACHE_PATH)
 
     print("\nOperation completed.")
     if duplicates:
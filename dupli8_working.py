@@ -1,62 +1,149 @@
 import os
 import hashlib
+import json
 import shutil
+import signal
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 import imagehash
 from tqdm import tqdm
+from checkpoint import CHECKPOINT_INTERVAL, Checkpoint
+from hash_config import load_hash_config, max_distance_for
+from hash_index import HammingIndex, hash_to_int
+from prefetch import Prefetcher, open_image
+from rename_plan import RenameJournal, RenamePlanner, new_journal_path, replace_file, run_plan
 
-def calculate_image_hash(image_path, error_folder):
-    """Calculate a perceptual hash for an image."""
+# Number of hashing processes used by main(); 1 hashes in the main process
+HASH_WORKERS = os.cpu_count() or 1
+# Images sent to a worker per task
+HASH_CHUNK_SIZE = 64
+# Hashes this many bits apart or closer count as duplicates; 0 means exact match
+MAX_DISTANCE = 0
+# Smallest size a JPEG is decoded at before hashing when fast_decode is on
+DRAFT_SIZE = (64, 64)
+# Resolve duplicates across all subfolders in one run instead of per subfolder
+GLOBAL_INDEX = False
+# Folder inside the base folder holding one saved hash shard per processed subfolder
+SHARD_FOLDER = ".dupli_shards"
+# Decode shards are hashed with; shards without it hold draft-decoded hashes and are hashed again
+SHARD_DECODE = "full"
+# Progress file of an unfinished subfolder (per-subfolder mode) or run (global mode, in SHARD_FOLDER)
+CHECKPOINT_FILENAME = ".dupli8.checkpoint"
+
+def hash_image(image_path, fast_decode=False, data=None):
+    """Average-hash an image, decoding JPEGs at reduced size when fast_decode is set.
+
+    Duplicates are matched exactly by default, so fast_decode is off: a draft
+    decode moves some hashes by a bit or more (see bench_fast_decode.py).
+    data, if given, is the file's contents already read into memory.
+    """
+    with (open_image(data) if data is not None else Image.open(image_path)) as img:
+        if fast_decode:
+            # Let the JPEG decoder scale by up to 1/8 in the DCT; no-op for other formats
+            img.draft("L", DRAFT_SIZE)
+        return imagehash.average_hash(img)
+
+def calculate_image_hash(image_path, error_folder, fast_decode=False, data=None, journal=None):
+    """Calculate a perceptual hash for an image; unreadable ones are moved to error_folder."""
     try:
-        with Image.open(image_path) as img:
-            return imagehash.average_hash(img)
+        return hash_image(image_path, fast_decode, data)
     except Exception as e:
         print(f"Error processing image {image_path}: {e}")
-        move_to_error_folder(image_path, error_folder)
+        move_to_error_folder(image_path, error_folder, journal)
         return None
 
-def move_to_error_folder(file_path, error_folder):
-    """Move the file to the Error subfolder."""
+def _ignore_sigint():
+    """Leave Ctrl-C handling to the main process."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _hash_chunk(image_paths, fast_decode):
+    """Hash a chunk of images inside a worker process."""
+    results = []
+    for image_path in image_paths:
+        try:
+            results.append((image_path, hash_image(image_path, fast_decode), None))
+        except Exception as e:
+            results.append((image_path, None, str(e)))
+    return results
+
+def hash_images_parallel(image_paths, workers, chunk_size=HASH_CHUNK_SIZE, max_in_flight=None, fast_decode=False):
+    """Hash images in a process pool, yielding (path, hash, error) in input order.
+
+    At most max_in_flight chunks are queued at once so memory stays flat.
+    """
+    if max_in_flight is None:
+        max_in_flight = workers * 2
+
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=_ignore_sigint)
+    pending = deque()
+    try:
+        for start in range(0, len(image_paths), chunk_size):
+            pending.append(executor.submit(_hash_chunk, image_paths[start:start + chunk_size], fast_decode))
+            if len(pending) >= max_in_flight:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    except BaseException:
+        # Ctrl-C or an abandoned generator: drop queued work and stop the pool
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+
+def iter_image_hashes(image_paths, error_folder, workers=1, fast_decode=False, journal=None):
+    """Yield (path, hash) pairs, hashing serially or in a process pool.
+
+    Serial hashing reads files ahead in background threads while decoding.
+    Unreadable images are moved to error_folder from this process, recorded
+    in journal when one is given.
+    """
+    if workers <= 1:
+        prefetcher = Prefetcher(image_paths)
+        # A file that could not be read ahead is opened again by path, which reports the error
+        for image_path, data, _ in prefetcher:
+            yield image_path, calculate_image_hash(image_path, error_folder, fast_decode, data, journal)
+        print(prefetcher.stats.summary())
+        return
+
+    for image_path, image_hash, error in hash_images_parallel(image_paths, workers, fast_decode=fast_decode):
+        if error is not None:
+            print(f"Error processing image {image_path}: {error}")
+            move_to_error_folder(image_path, error_folder, journal)
+        yield image_path, image_hash
+
+def move_to_error_folder(file_path, error_folder, journal=None):
+    """Move the file to the Error subfolder, recording it in journal when one is given."""
     if not os.path.exists(error_folder):
         os.makedirs(error_folder)
-    shutil.move(file_path, os.path.join(error_folder, os.path.basename(file_path)))
+    error_path = os.path.join(error_folder, os.path.basename(file_path))
+    if journal is not None:
+        journal.rename(file_path, error_path)
+    else:
+        shutil.move(file_path, error_path)
     print(f"Moved {file_path} to {error_folder}")
 
-def rename_duplicate_image(file_path, original_file_path, original_folder, file_name):
-    """Rename duplicate image by adding a postfix to it."""
+def rename_duplicate_image(file_path, original_file_path, original_folder, file_name, planner):
+    """Plan renaming a duplicate image by adding a postfix to it."""
     base_name, ext = os.path.splitext(os.path.basename(original_file_path))
-    counter = 1
-    new_name = f"{base_name}_Orig_Dupli{counter}{ext}"
-    new_file_path = os.path.join(original_folder, new_name)
-
-    while os.path.exists(new_file_path):
-        counter += 1
-        new_name = f"{base_name}_Orig_Dupli{counter}{ext}"
-        new_file_path = os.path.join(original_folder, new_name)
+    new_file_path = planner.unique_path(original_folder, base_name, "_Orig_Dupli{}", ext)
+    planner.add(file_path, new_file_path, "Duplicate renamed")
+    return new_file_path
 
-    # Rename the duplicate file
-    os.rename(file_path, new_file_path)
-    print(f"Duplicate renamed: {file_path} -> {new_file_path}")
-
-def rename_original_image(original_file_path):
-    """Rename the original image by adding '_Orig' postfix."""
+def rename_original_image(original_file_path, planner):
+    """Plan renaming the original image by adding '_Orig' postfix."""
     base_name, ext = os.path.splitext(original_file_path)
     new_name = f"{base_name}_Orig{ext}"
     new_file_path = new_name
 
-    if not os.path.exists(new_file_path):
-        os.rename(original_file_path, new_file_path)
-        print(f"Original renamed: {original_file_path} -> {new_file_path}")
+    if not planner.exists(new_file_path):
+        planner.add(original_file_path, new_file_path, "Original renamed")
         return new_file_path
     return original_file_path
 
-def find_and_rename_duplicates_in_subfolder(subfolder):
-    """Find and rename duplicate images in a specific subfolder."""
-    hash_map = {}
-    duplicates = set()
-    error_folder = os.path.join(subfolder, "Error")
-    
-    for file in tqdm(os.listdir(subfolder), desc=f"Processing {subfolder}"):
+def list_images(subfolder):
+    """Return the image files directly inside subfolder, in listing order."""
+    image_paths = []
+    for file in os.listdir(subfolder):
         file_path = os.path.join(subfolder, file)
 
         # Skip directories
@@ -65,23 +152,243 @@ def find_and_rename_duplicates_in_subfolder(subfolder):
 
         # Process only image files
         if file.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tiff')):
-            file_hash = calculate_image_hash(file_path, error_folder)
+            image_paths.append(file_path)
+    return image_paths
 
-            if file_hash is None:
-                # Handle files with errors (optional, like in the original script)
-                continue
+def hash_subfolder(subfolder, workers=1, known=None, journal=None):
+    """Yield (path, integer hash) for each readable image in subfolder; unreadable ones go to Error.
 
-            if file_hash in hash_map:
-                # Rename duplicate instead of moving
-                original_file_path = hash_map[file_hash]
-                rename_duplicate_image(file_path, original_file_path, subfolder, file)
-                duplicates.add(original_file_path)
-            else:
-                hash_map[file_hash] = file_path
+    Images in known (path -> integer hash) are not hashed again. Results come
+    in listing order either way. Moves to Error are recorded in journal when
+    one is given.
+    """
+    known = known or {}
+    error_folder = os.path.join(subfolder, "Error")
+    image_paths = list_images(subfolder)
+
+    hashes = iter_image_hashes([path for path in image_paths if path not in known], error_folder, workers,
+                               journal=journal)
+    for file_path in tqdm(image_paths, desc=f"Processing {subfolder}"):
+        if file_path in known:
+            yield file_path, known[file_path]
+            continue
+        _, file_hash = next(hashes)
+        if file_hash is None:
+            # Handle files with errors (optional, like in the original script)
+            continue
+        yield file_path, hash_to_int(file_hash)
+    # Let the hashing generator run to its end so it can clean up and report
+    next(hashes, None)
+
+def find_and_rename_duplicates_in_subfolder(subfolder, workers=1, max_distance=0, journal=None,
+                                            checkpoint_interval=CHECKPOINT_INTERVAL):
+    """Find and rename duplicate images in a specific subfolder.
+
+    With workers > 1 the images are hashed in a process pool; hash_map and the
+    renames stay in this process, so the result matches a serial run.
+    Images whose hashes differ by at most max_distance bits are duplicates.
+    All renames are planned first and then run together, recorded in journal
+    when one is given, as are moves of unreadable images to Error.
+
+    Hashes are checkpointed in the subfolder every checkpoint_interval files,
+    and the rename plan before it runs, so an interrupted subfolder resumes
+    without hashing or renaming anything twice.
+    """
+    checkpoint = Checkpoint(os.path.join(subfolder, CHECKPOINT_FILENAME), checkpoint_interval)
+    if checkpoint.state.get("phase") == "renaming":
+        print(f"Resuming renames in {subfolder}")
+        run_plan(checkpoint.state["plan"], journal, resume=True)
+        checkpoint.clear()
+        return
+
+    checkpoint.state["phase"] = "hashing"
+    # Hashes are checkpointed as [name, hex hash] records, appended rather than rewritten
+    known = {os.path.join(subfolder, name): int(value, 16) for name, value in checkpoint.records}
+
+    hash_map = HammingIndex()
+    duplicates = set()
+    planner = RenamePlanner()
+
+    for file_path, file_hash in hash_subfolder(subfolder, workers, known, journal):
+        if file_path not in known:
+            checkpoint.add_record([os.path.basename(file_path), format(file_hash, "016x")])
+            checkpoint.tick()
+        match = hash_map.find(file_hash, max_distance)
+        if match is not None:
+            # Rename duplicate instead of moving
+            original_file_path = match[0]
+            rename_duplicate_image(file_path, original_file_path, subfolder, os.path.basename(file_path), planner)
+            duplicates.add(original_file_path)
+        else:
+            hash_map.add(file_hash, file_path)
 
     # Rename original files only if they have duplicates
     for original_file_path in duplicates:
-        rename_original_image(original_file_path)
+        rename_original_image(original_file_path, planner)
+
+    checkpoint.state = {"phase": "renaming", "plan": planner.plan}
+    checkpoint.save()
+    planner.execute(journal)
+    checkpoint.clear()
+
+def load_shards(shard_folder):
+    """Load the saved per-subfolder shards, oldest first."""
+    shards = {}
+    if os.path.isdir(shard_folder):
+        for name in os.listdir(shard_folder):
+            if name.endswith(".json"):
+                with open(os.path.join(shard_folder, name), encoding="utf-8") as f:
+                    shards[name[:-len(".json")]] = json.load(f)
+    return dict(sorted(shards.items(), key=lambda item: item[1]["order"]))
+
+def save_shard(shard_folder, key, shard, journal=None):
+    """Write a shard atomically, through journal when given so undoing the run rolls it back."""
+    os.makedirs(shard_folder, exist_ok=True)
+    shard_path = os.path.join(shard_folder, f"{key}.json")
+    if journal is not None:
+        journal.replace_file(shard_path, json.dumps(shard))
+    else:
+        replace_file(shard_path, json.dumps(shard))
+
+def original_base(record):
+    """Name of a shard's original before it got the '_Orig' postfix; duplicates are named after it."""
+    if "base" in record:
+        return record["base"]
+    stem, ext = os.path.splitext(record["name"])
+    # Shards written before "base" was recorded only kept the renamed name
+    if record.get("orig") and stem.endswith("_Orig"):
+        return stem[:-len("_Orig")] + ext
+    return record["name"]
+
+def rehash_shard(base_folder, shard):
+    """Hash a shard's originals again with a full decode, keeping the old hash of unreadable ones."""
+    for record in shard["files"]:
+        try:
+            file_hash = hash_image(os.path.join(base_folder, shard["folder"], record["name"]))
+        except Exception as e:
+            print(f"Keeping the saved hash of {record['name']}: {e}")
+            continue
+        record["hash"] = format(hash_to_int(file_hash), "016x")
+    shard["decode"] = SHARD_DECODE
+
+def merge_shards(shards):
+    """Bulk-build one index over the originals recorded in every shard."""
+    return HammingIndex.build(
+        (int(record["hash"], 16), (key, record))
+        for key, shard in shards.items()
+        for record in shard["files"]
+    )
+
+def _finish_subfolder(checkpoint, shard_folder, journal=None, resume=False):
+    """Run a subfolder's checkpointed renames, rename the subfolder and save its shards."""
+    state = checkpoint.state
+    run_plan(state["plan"], journal, resume)
+    if not (resume and os.path.exists(state["new_subfolder"])):
+        rename_subfolder(state["subfolder"], state["new_subfolder"], journal)
+    for key, shard in state["shards"].items():
+        save_shard(shard_folder, key, shard, journal)
+    checkpoint.clear()
+
+def find_and_rename_duplicates_globally(base_folder, workers=1, max_distance=0, journal=None,
+                                        checkpoint_interval=CHECKPOINT_INTERVAL):
+    """Find and rename duplicates within and across all subfolders of base_folder.
+
+    Each subfolder's originals are saved as a shard in SHARD_FOLDER and merged
+    into one index. Subfolders that already have a shard are not hashed
+    again, so later runs only process newly added folders. A duplicate stays
+    in its own folder and is named after its original, wherever that lives.
+
+    The subfolder in progress is checkpointed in SHARD_FOLDER: its hashes
+    every checkpoint_interval files, then its renames and updated shards
+    before they are applied, so an interrupted run picks up where it stopped.
+    """
+    shard_folder = os.path.join(base_folder, SHARD_FOLDER)
+    os.makedirs(shard_folder, exist_ok=True)
+    checkpoint = Checkpoint(os.path.join(shard_folder, CHECKPOINT_FILENAME), checkpoint_interval)
+    if checkpoint.state.get("phase") == "renaming":
+        print(f"Resuming renames for {checkpoint.state['subfolder']}")
+        _finish_subfolder(checkpoint, shard_folder, journal, resume=True)
+
+    shards = load_shards(shard_folder)
+    for key, shard in shards.items():
+        if shard.get("decode") != SHARD_DECODE:
+            print(f"Hashing the originals of {shard['folder']} again with a full decode")
+            rehash_shard(base_folder, shard)
+            save_shard(shard_folder, key, shard, journal)
+    hash_map = merge_shards(shards)
+    known_folders = {shard["folder"] for shard in shards.values()}
+
+    def original_path(key, record, name=None):
+        return os.path.join(base_folder, shards[key]["folder"], name or record["name"])
+
+    for subfolder in os.listdir(base_folder):
+        subfolder_path = os.path.join(base_folder, subfolder)
+        if subfolder == SHARD_FOLDER or subfolder in known_folders or not os.path.isdir(subfolder_path):
+            continue
+
+        print(f"Processing subfolder: {subfolder_path}")
+        key = subfolder
+        while key in shards:
+            key = f"{key}_"
+        shard = {"folder": subfolder, "order": len(shards), "decode": SHARD_DECODE, "files": []}
+        shards[key] = shard
+        originals = {}
+        planner = RenamePlanner()
+
+        if checkpoint.state.get("folder") != subfolder:
+            checkpoint.state = {"phase": "hashing", "folder": subfolder}
+            checkpoint.clear_records()
+        known = {os.path.join(subfolder_path, name): int(value, 16) for name, value in checkpoint.records}
+
+        for file_path, file_hash in hash_subfolder(subfolder_path, workers, known, journal):
+            if file_path not in known:
+                checkpoint.add_record([os.path.basename(file_path), format(file_hash, "016x")])
+                checkpoint.tick()
+            match = hash_map.find(file_hash, max_distance)
+            if match is not None:
+                original_key, original = match[0]
+                # Named after the original's name before '_Orig', as in per-subfolder mode
+                original_file_path = original_path(original_key, original, original_base(original))
+                rename_duplicate_image(file_path, original_file_path, subfolder_path, os.path.basename(file_path), planner)
+                originals[id(original)] = (original_key, original)
+            else:
+                record = {"name": os.path.basename(file_path), "hash": format(file_hash, "016x")}
+                shard["files"].append(record)
+                hash_map.add(file_hash, (key, record))
+
+        # Rename originals only if they have duplicates, in whichever shard they live,
+        # and only once even if later runs find more duplicates of them
+        changed = {key}
+        for original_key, original in originals.values():
+            if original.get("orig"):
+                continue
+            new_file_path = rename_original_image(original_path(original_key, original), planner)
+            original["base"] = original["name"]
+            original["name"] = os.path.basename(new_file_path)
+            original["orig"] = True
+            changed.add(original_key)
+
+        # Rename the subfolder by appending '_Done'
+        new_subfolder_path = f"{subfolder_path}_Done"
+        shard["folder"] = os.path.basename(new_subfolder_path)
+
+        checkpoint.state = {
+            "phase": "renaming",
+            "plan": planner.plan,
+            "subfolder": subfolder_path,
+            "new_subfolder": new_subfolder_path,
+            "shards": {changed_key: shards[changed_key] for changed_key in changed},
+        }
+        checkpoint.save()
+        _finish_subfolder(checkpoint, shard_folder, journal)
+
+def rename_subfolder(subfolder_path, new_subfolder_path, journal=None):
+    """Rename a finished subfolder, recording it in journal when one is given."""
+    if journal is not None:
+        journal.rename(subfolder_path, new_subfolder_path)
+    else:
+        os.rename(subfolder_path, new_subfolder_path)
+    print(f"Renamed subfolder: {subfolder_path} -> {new_subfolder_path}")
 
 def main():
     
@@ -93,17 +400,24 @@ def main():
         print(f"Folder {base_folder} does not exist.")
         return
 
-    # Iterate through all subfolders
-    for subfolder in os.listdir(base_folder):
-        subfolder_path = os.path.join(base_folder, subfolder)
+    # A threshold tuned with tune_hashes.py for this script's 8x8 average hash replaces MAX_DISTANCE
+    max_distance = max_distance_for(load_hash_config(), "dupli8_working", MAX_DISTANCE)
+
+    # Every rename of this run is journaled; undo with: python rename_plan.py undo <journal>
+    with RenameJournal(new_journal_path(base_folder)) as journal:
+        if GLOBAL_INDEX:
+            find_and_rename_duplicates_globally(base_folder, workers=HASH_WORKERS, max_distance=max_distance, journal=journal)
+            return
+
+        # Iterate through all subfolders
+        for subfolder in os.listdir(base_folder):
+            subfolder_path = os.path.join(base_folder, subfolder)
 
-        if os.path.isdir(subfolder_path):
-            print(f"Processing subfolder: {subfolder_path}")
-            find_and_rename_duplicates_in_subfolder(subfolder_path)
-            # Rename the subfolder by appending '_Done'
-            new_subfolder_path = f"{subfolder_path}_Done"
-            os.rename(subfolder_path, new_subfolder_path)
-            print(f"Renamed subfolder: {subfolder_path} -> {new_subfolder_path}")
+            if os.path.isdir(subfolder_path):
+                print(f"Processing subfolder: {subfolder_path}")
+                find_and_rename_duplicates_in_subfolder(subfolder_path, workers=HASH_WORKERS, max_distance=max_distance, journal=journal)
+                # Rename the subfolder by appending '_Done'
+                rename_subfolder(subfolder_path, f"{subfolder_path}_Done", journal)
 
 if __name__ == "__main__":
     main()
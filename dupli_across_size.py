@@ -4,14 +4,28 @@ import shutil
 from PIL import Image
 import imagehash
 from tqdm import tqdm
-
-def calculate_image_hash(image_path, error_folder, hash_size=8):
+from hash_config import DEFAULT_HASH_CONFIG, load_hash_config
+from hash_index import HammingIndex, hash_to_int
+
+# imagehash function for each algorithm name used in hash_config
+HASH_FUNCTIONS = {
+    "ahash": imagehash.average_hash,
+    "dhash": imagehash.dhash,
+    "phash": imagehash.phash,
+    "whash": imagehash.whash,
+}
+
+def hash_file(image_path, hash_size=8, algorithm="ahash"):
+    """Return (perceptual hash, resized size) of an image file; tune_hashes.py scores this function."""
+    with Image.open(image_path) as img:
+        # Resize the image to a fixed size before hashing
+        img = img.resize((hash_size * 4, hash_size * 4), Image.Resampling.LANCZOS)
+        return HASH_FUNCTIONS[algorithm](img, hash_size=hash_size), img.size
+
+def calculate_image_hash(image_path, error_folder, hash_size=8, algorithm="ahash"):
     """Calculate a perceptual hash for an image after resizing it to a fixed size."""
     try:
-        with Image.open(image_path) as img:
-            # Resize the image to a fixed size before hashing
-            img = img.resize((hash_size * 4, hash_size * 4), Image.ANTIALIAS)
-            return imagehash.average_hash(img, hash_size=hash_size), img.size
+        return hash_file(image_path, hash_size, algorithm)
     except Exception as e:
         print(f"Error processing image {image_path}: {e}")
         move_to_error_folder(image_path, error_folder)
@@ -36,9 +50,12 @@ def rename_image_by_size(images, subfolder):
         os.rename(file_path, new_file_path)
         print(f"Renamed {file_path} -> {new_file_path}")
 
-def find_and_rename_duplicates_in_subfolder(subfolder):
-        """Find and rename duplicate images in a specific subfolder and its sub-subfolders."""
-        hash_map = {}
+def find_and_rename_duplicates_in_subfolder(subfolder, hash_size=8, algorithm="ahash", max_distance=0):
+        """Find and rename duplicate images in a specific subfolder and its sub-subfolders.
+
+        Hashes at most max_distance bits apart count as duplicates.
+        """
+        hash_map = HammingIndex()
         duplicates = set()
         error_folder = os.path.join(subfolder, "Error")
         images_with_resolution = []
@@ -53,7 +70,7 @@ def find_and_rename_duplicates_in_subfolder(subfolder):
 
                 # Process only image files
                 if file.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tiff')):
-                    file_hash, resolution = calculate_image_hash(file_path, error_folder)
+                    file_hash, resolution = calculate_image_hash(file_path, error_folder, hash_size, algorithm)
 
                     if file_hash is None:
                         # Handle files with errors (optional, like in the original script)
@@ -61,11 +78,13 @@ def find_and_rename_duplicates_in_subfolder(subfolder):
 
                     images_with_resolution.append((file_path, resolution))
 
-                    if file_hash in hash_map:
+                    file_hash = hash_to_int(file_hash)
+                    match = hash_map.find(file_hash, max_distance)
+                    if match is not None:
                         # Mark as duplicate but do not rename yet
-                        duplicates.add(hash_map[file_hash])
+                        duplicates.add(match[0])
                     else:
-                        hash_map[file_hash] = file_path
+                        hash_map.add(file_hash, file_path)
 
         # Rename images based on resolution
         rename_image_by_size(images_with_resolution, subfolder)
@@ -78,8 +97,10 @@ def main():
     if not os.path.exists(base_folder):
         print(f"Folder {base_folder} does not exist.")
         return
-    
-    find_and_rename_duplicates_in_subfolder(base_folder)
+
+    # Algorithm, hash size and threshold recommended by tune_hashes.py, if it was run
+    config = load_hash_config(default=DEFAULT_HASH_CONFIG)
+    find_and_rename_duplicates_in_subfolder(base_folder, config["hash_size"], config["algorithm"], config["max_distance"])
 
     # Iterate through all subfolders
     # for subfolder in os.listdir(base_folder):
@@ -2,21 +2,25 @@ import os
 import hashlib
 from PIL import Image
 import re
+from image_probe import probe_image
+
+def image_hash(img):
+    """Generate a hash for an open image."""
+    img = img.resize((8, 8), Image.Resampling.LANCZOS).convert("L")
+    pixels = list(img.getdata())
+    avg_pixel = sum(pixels) / len(pixels)
+    bits = [1 if pixel > avg_pixel else 0 for pixel in pixels]
+    hash_string = ''.join(str(bit) for bit in bits)
+    return hashlib.md5(hash_string.encode('utf-8')).hexdigest()
 
 def get_image_hash(image_path):
     """Generate a hash for an image file."""
     with Image.open(image_path) as img:
-        img = img.resize((8, 8), Image.Resampling.LANCZOS).convert("L")
-        pixels = list(img.getdata())
-        avg_pixel = sum(pixels) / len(pixels)
-        bits = [1 if pixel > avg_pixel else 0 for pixel in pixels]
-        hash_string = ''.join(str(bit) for bit in bits)
-        return hashlib.md5(hash_string.encode('utf-8')).hexdigest()
+        return image_hash(img)
 
 def get_image_resolution(image_path):
-    """Get the resolution of an image."""
-    with Image.open(image_path) as img:
-        return img.size
+    """Get the resolution of an image from its header."""
+    return probe_image(image_path).resolution
 
 def find_duplicates(root_folder):
     """Find and rename duplicate images in a folder structure."""
@@ -34,8 +38,8 @@ def find_duplicates(root_folder):
 
             file_path = os.path.join(dirpath, filename)
             try:
-                file_hash = get_image_hash(file_path)
-                resolution = get_image_resolution(file_path)
+                probe = probe_image(file_path, hash_func=image_hash)
+                file_hash, resolution = probe.hash, probe.resolution
 
                 if file_hash in hash_map:
                     hash_map[file_hash].append((file_path, resolution))
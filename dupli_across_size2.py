@@ -1,77 +1,219 @@
+import argparse
+import json
+import multiprocessing
 import os
-import hashlib
+import socket
+import sys
+import numpy as np
 from PIL import Image
 import re
 import logging
 from tqdm import tqdm
+import hash_engine
+from checkpoint import Checkpoint
+from clustering import cluster_groups
+from fingerprint_cache import FingerprintCache, CACHE_FILENAME
+from hash_config import load_hash_config, max_distance_for
+from hash_store import HashStore
+from image_probe import probe_image
+from scan_pipeline import scan_dirs, scan_files
+from thumb_store import ThumbStore, store_folder_for
 
 # Configure logging
 logging.basicConfig(filename='duplicates.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def get_image_hash(image_path):
-    """Generate a hash for an image file."""
+# Hashes this many bits apart or closer count as duplicates; 0 means exact match
+MAX_DISTANCE = 0
+# Largest number of bits two members of one near-duplicate group may differ in; None means no limit
+MAX_DIAMETER = None
+# Rename plan of an interrupted run, kept in the root folder until all renames are done
+CHECKPOINT_FILENAME = ".dupli_across_size2.checkpoint"
+# Take hashes and resolutions from the shared thumbnail store next to the root folder
+USE_THUMB_STORE = False
+
+def image_bits(img, fast_decode=False):
+    """Return the 8x8 average-hash bits of an open image as a 64-bit integer.
+
+    Groups are matched exactly by default, so the image is fully decoded:
+    with fast_decode a JPEG is draft-decoded, and the bits can drift.
+    """
+    return int(hash_engine.ahash(hash_engine.hash_thumbnail(img, fast_decode)))
+
+def get_image_bits(image_path, fast_decode=False, thumbs=None):
+    """Return the 8x8 average-hash bits of an image file as a 64-bit integer.
+
+    With a ThumbStore the bits come from its 8x8 thumbnail instead of decoding
+    the file; the store makes that thumbnail with the same full-decode
+    hash_thumbnail, so the bits are the same either way.
+    """
+    if thumbs is not None and not fast_decode:
+        return int(hash_engine.ahash(thumbs.fetch(image_path, "gray8")))
     with Image.open(image_path) as img:
-        img = img.resize((8, 8), Image.Resampling.LANCZOS).convert("L")
-        pixels = list(img.getdata())
-        avg_pixel = sum(pixels) / len(pixels)
-        bits = [1 if pixel > avg_pixel else 0 for pixel in pixels]
-        hash_string = ''.join(str(bit) for bit in bits)
-        return hashlib.md5(hash_string.encode('utf-8')).hexdigest()
+        return image_bits(img, fast_decode)
+
+def bits_to_hash(bits):
+    """Return the MD5 key that get_image_hash produces for the given bits."""
+    return hash_engine.to_md5(bits)
+
+def get_image_hash(image_path, thumbs=None):
+    """Generate a hash for an image file."""
+    return bits_to_hash(get_image_bits(image_path, thumbs=thumbs))
 
 def get_image_resolution(image_path):
-    """Get the resolution of an image."""
-    with Image.open(image_path) as img:
-        return img.size
+    """Get the resolution of an image from its header."""
+    return probe_image(image_path).resolution
 
-def find_duplicates(root_folder):
-    """Find and rename duplicate images in a folder structure."""
-    hash_map = {}
-    exclude_folder = os.path.join(root_folder, "Error")
-    exclude_extension = ".xxjpg"
-    image_extensions = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tiff"}
+def probe_fingerprint(file_path, thumbs=None):
+    """Return (hash bits, resolution), opening the file only once."""
+    if thumbs is not None:
+        return get_image_bits(file_path, thumbs=thumbs), thumbs.resolution(file_path)
+    probe = probe_image(file_path, hash_func=image_bits)
+    return probe.hash, probe.resolution
+
+def get_fingerprint(file_path, cache=None, stat_result=None, thumbs=None):
+    """Return (hash bits, resolution) for an image, reusing cached values for unchanged files."""
+    if cache is None:
+        return probe_fingerprint(file_path, thumbs)
+
+    if stat_result is None:
+        stat_result = os.stat(file_path)
+    cached = cache.get(file_path, stat_result)
+    if cached is None and not stat_result.st_ino:
+        # os.scandir reports no inode on Windows; os.stat does, and the cache needs it
+        # to find files renamed or moved since the last run, and to store for the next
+        stat_result = os.stat(file_path)
+        cached = cache.get(file_path, stat_result)
+    if cached is not None:
+        file_hash, resolution, error = cached
+        if error:
+            raise ValueError(f"{error} (cached)")
+        return int(file_hash, 16), resolution
+
+    try:
+        bits, resolution = probe_fingerprint(file_path, thumbs)
+    except Exception as e:
+        cache.put(file_path, stat_result, None, None, str(e))
+        raise
+    cache.put(file_path, stat_result, format(bits, "016x"), resolution)
+    return bits, resolution
+
+def rename_file(file_path, new_filepath, cache=None, store=None, row=None):
+    """Rename a file, logging the result and moving its cache entry and store row along."""
+    try:
+        os.rename(file_path, new_filepath)
+        logging.info(f"Renamed {file_path} -> {new_filepath}")
+        if cache is not None:
+            cache.rename(file_path, new_filepath)
+        if store is not None:
+            store.rename(row, new_filepath)
+    except Exception as e:
+        logging.error(f"Error renaming {file_path} to {new_filepath}: {e}")
 
-    # Count total files for progress bar
-    total_files = sum([len(files) for r, d, files in os.walk(root_folder) if exclude_folder not in r])
+def find_duplicates(root_folder, use_cache=True, max_distance=0, store_path=None, max_diameter=None,
+                    thumb_store=None):
+    """Find and rename duplicate images in a folder structure.
 
-    with tqdm(total=total_files, desc="Processing files") as pbar:
-        for dirpath, dirnames, filenames in os.walk(root_folder):
-            if "Error" in os.path.split(dirpath)[1]:
+    With use_cache the hash and resolution of every file are kept in a SQLite
+    file in root_folder, so unchanged files are not decoded again next run.
+    Images whose hashes differ by at most max_distance bits are grouped together,
+    transitively; max_diameter limits how far apart any two of a group may be.
+    With store_path the hashes, resolutions and final paths of every image are
+    saved there as a memory-mappable HashStore. With thumb_store, the folder
+    of a ThumbStore, images are hashed from the thumbnails kept there, and
+    decoded into it if they are not there yet.
+
+    The renames are checkpointed before they start. If a run is interrupted
+    while renaming, the next run finishes the saved plan instead of scanning
+    again; already renamed files are skipped. Hashes survive an interruption
+    through the cache.
+    """
+    cache = FingerprintCache(os.path.join(root_folder, CACHE_FILENAME)) if use_cache else None
+    thumbs = ThumbStore(thumb_store) if thumb_store is not None else None
+    try:
+        checkpoint = Checkpoint(os.path.join(root_folder, CHECKPOINT_FILENAME))
+        if checkpoint.resumed:
+            print("Resuming the renames of an interrupted run")
+            _finish_renames(root_folder, checkpoint, cache, resume=True)
+            if store_path is not None:
+                print(f"Not saving {store_path}: a resumed run has no hashes")
+            return
+        store = _find_duplicates(root_folder, cache, max_distance, checkpoint, max_diameter, thumbs)
+        if store_path is not None:
+            store.save(store_path)
+    finally:
+        if cache is not None:
+            cache.close()
+        if thumbs is not None:
+            thumbs.close()
+
+def _group_rows(store, max_distance, max_diameter=None):
+    """Return lists of store rows holding the same image.
+
+    Above max_distance 0, near matches are clustered transitively, so A~B and
+    B~C put A, B and C in one group (see clustering.py).
+    """
+    if max_distance == 0:
+        return [group.tolist() for group in store.exact_groups()]
+    return cluster_groups(store.hashes[:len(store)], max_distance, max_diameter)
+
+def _finish_renames(root_folder, checkpoint, cache=None, store=None, resume=False):
+    """Run the checkpointed file renames, then the folder renames, then drop the checkpoint."""
+    if checkpoint.state["phase"] == "files":
+        for file_path, new_filepath, row in checkpoint.state["plan"]:
+            if resume and not os.path.exists(file_path) and os.path.exists(new_filepath):
                 continue
+            rename_file(file_path, new_filepath, cache, store, row)
+        checkpoint.state = {"phase": "folders"}
+        checkpoint.save()
+    rename_subfolders(root_folder, cache, store)
+    checkpoint.clear()
+
+def _scan_into_store(root_folder, cache, store, thumbs=None):
+    """Fingerprint every image below root_folder and append it to store."""
+    exclude_extension = ".xxjpg"
+    image_extensions = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tiff"}
 
-            for filename in filenames:
-                if filename.lower().endswith(exclude_extension):
-                    continue
+    def is_image(entry):
+        filename = entry.name.lower()
+        if filename.endswith(exclude_extension):
+            return False
+        return any(filename.endswith(ext) for ext in image_extensions)
 
-                if not any(filename.lower().endswith(ext) for ext in image_extensions):
-                    continue
+    def is_scanned(dirpath):
+        return "Error" not in os.path.split(dirpath)[1]
 
-                file_path = os.path.join(dirpath, filename)
-                try:
-                    file_hash = get_image_hash(file_path)
-                    resolution = get_image_resolution(file_path)
+    # The progress total grows while the tree is still being scanned
+    with tqdm(total=0, desc="Processing files") as pbar:
+        for entry in scan_files(root_folder, dir_filter=is_scanned, file_filter=is_image, pbar=pbar):
+            file_path = entry.path
+            try:
+                stat_result = entry.stat()
+                file_hash, resolution = get_fingerprint(file_path, cache, stat_result, thumbs)
+                store.add(file_path, file_hash, resolution, stat_result.st_size)
+            except Exception as e:
+                logging.error(f"Error processing {file_path}: {e}")
+            pbar.update(1)
 
-                    if file_hash in hash_map:
-                        hash_map[file_hash].append((file_path, resolution))
-                    else:
-                        hash_map[file_hash] = [(file_path, resolution)]
-                except Exception as e:
-                    logging.error(f"Error processing {file_path}: {e}")
-                pbar.update(1)
+def plan_renames(store, max_distance=0, same_location=None, max_diameter=None):
+    """Return (path, new path, row) renames for every group of duplicates in store.
 
-    for file_hash, files in hash_map.items():
-        if len(files) > 1:
+    The highest-resolution copy gets _Size1; the others are named after it
+    with _Size<n>_<resolution> and moved next to it. same_location(row, row)
+    can veto that move (say, for files on different machines), in which case
+    the copy is renamed in its own folder.
+    """
+    plan = []
+    for rows in _group_rows(store, max_distance, max_diameter):
+        if len(rows) > 1:
+            files = [(store.path(row), store.resolution(row), row) for row in rows]
             sorted_files = sorted(files, key=lambda x: x[1], reverse=True)  # Sort by resolution descending
             highest_res_file = sorted_files[0]
 
-            for idx, (file_path, resolution) in enumerate(sorted_files):
+            for idx, (file_path, resolution, row) in enumerate(sorted_files):
                 if (highest_res_file[0] == file_path):
                     new_filename = f"{os.path.splitext(os.path.split(file_path)[1])[0]}_Size1{os.path.splitext(file_path)[1]}"
                     new_filepath = os.path.join(os.path.dirname(file_path), new_filename)
-                    try:
-                        os.rename(file_path, new_filepath)
-                        logging.info(f"Renamed {file_path} -> {new_filepath}")
-                    except Exception as e:
-                        logging.error(f"Error renaming {file_path} to {new_filepath}: {e}")
+                    plan.append((file_path, new_filepath, row))
                 else:
                     # Regular expression to extract resolution
                     resolution_pattern = r"\b\d+\s*x\s*\d+\b"
@@ -86,36 +228,154 @@ def find_duplicates(root_folder):
                         
                     size_suffix = f"_Size{idx + 1}"
                     new_filename = f"{os.path.splitext(os.path.split(highest_res_file[0])[1])[0]}{size_suffix}_{resolution}{os.path.splitext(highest_res_file[0])[1]}"
-                    new_filepath = os.path.join(os.path.dirname(highest_res_file[0]), new_filename)
+                    target_file = highest_res_file[0]
+                    if same_location is not None and not same_location(row, highest_res_file[2]):
+                        target_file = file_path
+                    new_filepath = os.path.join(os.path.dirname(target_file), new_filename)
+                    plan.append((file_path, new_filepath, row))
+    return plan
+
+def _find_duplicates(root_folder, cache, max_distance, checkpoint, max_diameter=None, thumbs=None):
+    store = HashStore()
+    _scan_into_store(root_folder, cache, store, thumbs)
+    plan = plan_renames(store, max_distance, max_diameter=max_diameter)
+
+    checkpoint.state = {"phase": "files", "plan": plan}
+    checkpoint.save()
+    _finish_renames(root_folder, checkpoint, cache, store)
+    return store
+
+def scan_shard(roots, shard_path, node=None, use_cache=True):
+    """Scan the roots assigned to one node and save them as a partial index at shard_path.
+
+    The shard is a self-contained HashStore file holding the hash, size,
+    resolution and path of every image, tagged with the node name (the host
+    name by default). Nothing is renamed. Returns the number of images.
+    """
+    store = HashStore()
+    store.meta = {"node": node or socket.gethostname(), "roots": [os.path.abspath(root) for root in roots]}
+    for root in roots:
+        cache = FingerprintCache(os.path.join(root, CACHE_FILENAME)) if use_cache else None
+        try:
+            _scan_into_store(root, cache, store)
+        finally:
+            if cache is not None:
+                cache.close()
+    store.save(shard_path)
+    return len(store)
+
+def merge_shards(shard_paths, plan_path, max_distance=0, max_diameter=None):
+    """Group the duplicates across all shards and write the rename plan to plan_path.
 
-                    try:
-                        os.rename(file_path, new_filepath)
-                        logging.info(f"Renamed {file_path} -> {new_filepath}")
-                    except Exception as e:
-                        logging.error(f"Error renaming {file_path} to {new_filepath}: {e}")
+    Files are only moved next to their highest-resolution copy when both are
+    on the same node; otherwise they are renamed where they are. Returns the
+    plan, a list of {"node", "src", "dst"} entries.
+    """
+    stores = [HashStore.load(shard_path) for shard_path in shard_paths]
+    merged = HashStore.concat(stores)
+    shard_of_row = np.repeat(np.arange(len(stores)), [len(store) for store in stores])
+    nodes = [store.meta.get("node", str(i)) for i, store in enumerate(stores)]
 
-    rename_subfolders(root_folder)
+    def same_node(row, other_row):
+        return nodes[shard_of_row[row]] == nodes[shard_of_row[other_row]]
 
-def rename_subfolders(root_folder):
-    """Rename subfolders to _Sized, ignoring specific folders."""
+    renames = [
+        {"node": nodes[shard_of_row[row]], "src": file_path, "dst": new_filepath}
+        for file_path, new_filepath, row in plan_renames(merged, max_distance, same_node, max_diameter)
+    ]
+    plan = {"shards": [os.path.abspath(shard_path) for shard_path in shard_paths], "files": len(merged),
+            "max_distance": max_distance, "renames": renames}
+    with open(plan_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(plan, f, indent=1)
+    os.replace(plan_path + ".tmp", plan_path)
+    print(f"Merged {len(stores)} shards, {len(merged)} files: {len(renames)} renames planned in {plan_path}")
+    return renames
+
+def apply_plan(plan_path, node=None):
+    """Run the renames of a merged plan that belong to node (all of them if node is None).
+
+    Renames that already happened are skipped, so the plan can be re-run.
+    """
+    with open(plan_path, encoding="utf-8") as f:
+        plan = json.load(f)
+    for entry in plan["renames"]:
+        if node is not None and entry["node"] != node:
+            continue
+        if not os.path.exists(entry["src"]) and os.path.exists(entry["dst"]):
+            continue
+        rename_file(entry["src"], entry["dst"])
+
+def _scan_shard_task(args):
+    return scan_shard(*args)
+
+def run_local_shards(root_groups, work_folder, max_distance=0, use_cache=True, max_diameter=None):
+    """Scan each group of roots in its own process as if on its own node, then merge.
+
+    Node i is named local<i> and writes work_folder/shard<i>.hst. Returns the
+    path of the merged plan; apply it with apply_plan().
+    """
+    os.makedirs(work_folder, exist_ok=True)
+    tasks = [(roots, os.path.join(work_folder, f"shard{i}.hst"), f"local{i}", use_cache)
+             for i, roots in enumerate(root_groups)]
+    if tasks:
+        with multiprocessing.Pool(min(len(tasks), os.cpu_count() or 1)) as pool:
+            pool.map(_scan_shard_task, tasks)
+    plan_path = os.path.join(work_folder, "plan.json")
+    merge_shards([task[1] for task in tasks], plan_path, max_distance, max_diameter)
+    return plan_path
+
+def rename_subfolders(root_folder, cache=None, store=None):
+    """Rename subfolders to _Sized, ignoring specific folders and ones already renamed."""
     ignore_folders = {"Document", "Screenshot", "Meme", "Error", "Photograph"}
 
-    # Count total directories for progress bar
-    total_dirs = sum([len(dirs) for r, dirs, files in os.walk(root_folder)])
-
-    with tqdm(total=total_dirs, desc="Renaming folders") as pbar:
-        for dirpath, dirnames, filenames in os.walk(root_folder):
-            for dirname in dirnames:
-                if dirname not in ignore_folders:
-                    old_path = os.path.join(dirpath, dirname)
-                    new_path = os.path.join(dirpath, f"{dirname}_Sized")
-                    try:
-                        os.rename(old_path, new_path)
-                        logging.info(f"Renamed folder {old_path} -> {new_path}")
-                    except Exception as e:
-                        logging.error(f"Error renaming folder {old_path} to {new_path}: {e}")
-                pbar.update(1)
+    # Only ignored folders are descended into; every other folder is renamed instead
+    def is_ignored(entry):
+        return entry.name in ignore_folders
+
+    with tqdm(total=0, desc="Renaming folders") as pbar:
+        for entry in scan_dirs(root_folder, descend=is_ignored, pbar=pbar):
+            if not is_ignored(entry) and not entry.name.endswith("_Sized"):
+                old_path = entry.path
+                new_path = os.path.join(os.path.dirname(old_path), f"{entry.name}_Sized")
+                try:
+                    os.rename(old_path, new_path)
+                    logging.info(f"Renamed folder {old_path} -> {new_path}")
+                    if cache is not None:
+                        cache.rename_folder(old_path, new_path)
+                    if store is not None:
+                        store.rename_folder(old_path, new_path)
+                except Exception as e:
+                    logging.error(f"Error renaming folder {old_path} to {new_path}: {e}")
+            pbar.update(1)
 
 if __name__ == "__main__":
+    # A threshold tuned with tune_hashes.py for this script's 8x8 average hash replaces MAX_DISTANCE
+    max_distance = max_distance_for(load_hash_config(), "dupli_across_size2", MAX_DISTANCE)
+    if len(sys.argv) > 1:
+        # Shard mode: python dupli_across_size2.py scan <shard> <root>... | merge <plan> <shard>... | apply <plan> [node]
+        parser = argparse.ArgumentParser(description="Find duplicates across several machines")
+        commands = parser.add_subparsers(dest="command", required=True)
+        scan_parser = commands.add_parser("scan", help="scan this node's roots into a shard file")
+        scan_parser.add_argument("shard")
+        scan_parser.add_argument("roots", nargs="+")
+        scan_parser.add_argument("--node", help="node name (default: host name)")
+        merge_parser = commands.add_parser("merge", help="merge shard files into a rename plan")
+        merge_parser.add_argument("plan")
+        merge_parser.add_argument("shards", nargs="+")
+        merge_parser.add_argument("--max-distance", type=int, default=max_distance)
+        merge_parser.add_argument("--max-diameter", type=int, default=MAX_DIAMETER)
+        apply_parser = commands.add_parser("apply", help="run a plan's renames for one node")
+        apply_parser.add_argument("plan")
+        apply_parser.add_argument("node", nargs="?")
+        args = parser.parse_args()
+        if args.command == "scan":
+            scan_shard(args.roots, args.shard, args.node)
+        elif args.command == "merge":
+            merge_shards(args.shards, args.plan, args.max_distance, args.max_diameter)
+        else:
+            apply_plan(args.plan, args.node)
+        sys.exit(0)
+
     root_folder = "F:\\ULTFONE_20240829_175529\\E\\Lost Files\\File Name Lost\\jpg\\JPG\\2024\\Processed1"
-    find_duplicates(root_folder)
+    find_duplicates(root_folder, max_distance=max_distance, max_diameter=MAX_DIAMETER,
+                    thumb_store=store_folder_for(root_folder) if USE_THUMB_STORE else None)
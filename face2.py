@@ -3,9 +3,20 @@ import cv2
 import shutil
 import face_recognition
 from pathlib import Path
+import numpy as np
+from thumb_store import DEFAULT_KINDS, ThumbStore, store_folder_for
+
+# Look for faces in the shared thumbnail store's 512-pixel thumbnails instead of the full image
+USE_THUMB_STORE = False
 
 # Function to load image and detect faces
-def detect_faces(image_path):
+def detect_faces(image_path, thumbs=None):
+    if thumbs is not None:
+        # Detect on the stored thumbnail and scale the boxes back to the full image
+        thumb = np.ascontiguousarray(thumbs.fetch(str(image_path), "fit512"))
+        scale = thumbs.resolution(str(image_path))[0] / thumb.shape[1]
+        return [tuple(round(v * scale) for v in location) for location in face_recognition.face_locations(thumb)]
+
     # Load the image
     image = face_recognition.load_image_file(image_path)
     face_locations = face_recognition.face_locations(image)
@@ -19,7 +30,7 @@ def get_face_encoding(image_path):
     return face_encodings
 
 # Main logic to sort images
-def sort_images_by_faces(source_folder, destination_folder):
+def sort_images_by_faces(source_folder, destination_folder, thumbs=None):
     if not os.path.exists(destination_folder):
         os.makedirs(destination_folder)
     
@@ -34,7 +45,7 @@ def sort_images_by_faces(source_folder, destination_folder):
     for image_file in image_files:
         print(f"Processing {image_file.name}...")
         
-        face_locations = detect_faces(image_file)
+        face_locations = detect_faces(image_file, thumbs)
         
         # If faces are found in the image
         if face_locations:
@@ -76,5 +87,10 @@ if __name__ == "__main__":
     source_folder = "D:\sample"  # Replace with your source folder path
     destination_folder = "D:\sample_out"  # Replace with your destination folder path
 
-    sort_images_by_faces(source_folder, destination_folder)
+    thumbs = ThumbStore(store_folder_for(source_folder), kinds=DEFAULT_KINDS + ("fit512",)) if USE_THUMB_STORE else None
+    try:
+        sort_images_by_faces(source_folder, destination_folder, thumbs)
+    finally:
+        if thumbs is not None:
+            thumbs.close()
     print("Image sorting complete.")
@@ -1,9 +1,11 @@
+import io
 import os
 import cv2
 import face_recognition
+from prefetch import Prefetcher, decode_cv2
 
 # Function to detect and recognize faces in an image
-def process_image(image_path, known_face_encodings, known_face_names):
+def process_image(image_path, known_face_encodings, known_face_names, data=None):
     """
     Detects and recognizes faces in an image.
 
@@ -11,11 +13,12 @@ def process_image(image_path, known_face_encodings, known_face_names):
         image_path: Path to the image file.
         known_face_encodings: List of known face encodings.
         known_face_names: List of corresponding names for known faces.
+        data: Contents of the image file if already read into memory.
 
     Returns:
         List of recognized face names.
     """
-    image = face_recognition.load_image_file(image_path)
+    image = face_recognition.load_image_file(io.BytesIO(data) if data is not None else image_path)
     face_locations = face_recognition.face_locations(image)
     face_encodings = face_recognition.face_encodings(image, face_locations)
 
@@ -48,33 +51,39 @@ def sort_photos(input_dir, output_dir):
     # Create output directory if it doesn't exist
     os.makedirs(output_dir, exist_ok=True)
 
-    # Iterate through images in the input directory
-    for filename in os.listdir(input_dir):
-        if filename.lower().endswith(('.jpg', '.jpeg', '.png')):
-            image_path = os.path.join(input_dir, filename)
-
-            try:
-                face_names = process_image(image_path, known_face_encodings, known_face_names)
-            except Exception as e:
-                print(f"Error processing image '{filename}': {e}")
-                continue
-
-            for face_name in face_names:
-                face_dir = os.path.join(output_dir, face_name)
-                os.makedirs(face_dir, exist_ok=True)
-                new_filename = f"{face_name}_{os.path.splitext(filename)[0]}.jpg"
-                new_path = os.path.join(face_dir, new_filename)
-                cv2.imwrite(new_path, cv2.imread(image_path))
-
-            # If any faces are recognized, add them to the known faces list
-            for name in face_names:
-                if name not in known_face_names:
-                    known_face_names.append(name)
-                    # Get the first encoding for each new face
-                    face_encodings = face_recognition.face_encodings(
-                        face_recognition.load_image_file(image_path))
-                    if len(face_encodings) > 0:
-                        known_face_encodings.append(face_encodings[0])
+    image_paths = [
+        os.path.join(input_dir, filename) for filename in os.listdir(input_dir)
+        if filename.lower().endswith(('.jpg', '.jpeg', '.png'))
+    ]
+
+    # Iterate through images in the input directory, reading ahead while faces are detected
+    prefetcher = Prefetcher(image_paths)
+    for image_path, data, _ in prefetcher:
+        filename = os.path.basename(image_path)
+
+        try:
+            face_names = process_image(image_path, known_face_encodings, known_face_names, data)
+        except Exception as e:
+            print(f"Error processing image '{filename}': {e}")
+            continue
+
+        for face_name in face_names:
+            face_dir = os.path.join(output_dir, face_name)
+            os.makedirs(face_dir, exist_ok=True)
+            new_filename = f"{face_name}_{os.path.splitext(filename)[0]}.jpg"
+            new_path = os.path.join(face_dir, new_filename)
+            cv2.imwrite(new_path, decode_cv2(data) if data is not None else cv2.imread(image_path))
+
+        # If any faces are recognized, add them to the known faces list
+        for name in face_names:
+            if name not in known_face_names:
+                known_face_names.append(name)
+                # Get the first encoding for each new face
+                face_encodings = face_recognition.face_encodings(
+                    face_recognition.load_image_file(io.BytesIO(data) if data is not None else image_path))
+                if len(face_encodings) > 0:
+                    known_face_encodings.append(face_encodings[0])
+    print(prefetcher.stats.summary())
 
 if __name__ == "__main__":
     input_dir = "D:\sample"  # Replace with your input directory
@@ -0,0 +1,159 @@
+"""Several fingerprints of an image from a single decode.
+
+The image is decoded once (scaled down in the JPEG decoder where possible),
+converted to grayscale once and halved into a small pyramid; every hash then
+takes its thumbnail from the nearest pyramid level instead of decoding and
+resizing the full image again. Thumbnails of a batch are stacked so that each
+algorithm runs once per batch in hash_engine. Because thumbnails come from
+the pyramid, hashes can differ from imagehash's by a bit or two.
+
+Fingerprints are chosen with a dict of name -> size:
+    ahash, dhash, phash, whash  hash side in bits (8 gives a 64-bit hash)
+    color                       side of the RGB thumbnail the color moments
+                                are taken from
+"""
+import numpy as np
+from PIL import Image
+
+import hash_engine
+
+DEFAULT_FINGERPRINTS = {"ahash": 8, "dhash": 8, "phash": 8, "whash": 8}
+
+# pHash and wHash look at a thumbnail this many times the hash side
+PHASH_SCALE = 4
+WHASH_SCALE = 4
+
+# A pyramid level is used for a thumbnail when it is at least this much larger
+PYRAMID_OVERSAMPLE = 2
+
+def _thumbnail_size(name, size):
+    if name == "ahash":
+        return (size, size)
+    if name == "dhash":
+        return (size + 1, size)
+    if name == "phash":
+        return (size * PHASH_SCALE, size * PHASH_SCALE)
+    if name == "whash":
+        if size & (size - 1):
+            raise ValueError(f"whash size must be a power of 2, got {size}")
+        return (size * WHASH_SCALE, size * WHASH_SCALE)
+    if name == "color":
+        return (size, size)
+    raise ValueError(f"Unknown fingerprint {name!r}")
+
+def _hash(name, size, thumbnails):
+    if name == "ahash":
+        return hash_engine.ahash(thumbnails)
+    if name == "dhash":
+        return hash_engine.dhash(thumbnails)
+    if name == "phash":
+        return hash_engine.phash(thumbnails, size)
+    return hash_engine.whash(thumbnails, size)
+
+def _to_int(words):
+    """Turn one hash (a uint64 or a row of them, most significant first) into an int."""
+    words = np.atleast_1d(words)
+    value = 0
+    for word in words:
+        value = (value << 64) | int(word)
+    return value
+
+def color_moments(rgb):
+    """Mean, standard deviation and skewness of each HSV channel of an RGB thumbnail.
+
+    Returns 9 float32 values, channel by channel. Skewness is the cube root of
+    the third central moment, so all three share the channel's scale.
+    """
+    pixels = np.asarray(rgb.convert("HSV"), dtype=np.float64).reshape(-1, 3) / 255.0
+    mean = pixels.mean(axis=0)
+    centered = pixels - mean
+    std = np.sqrt((centered ** 2).mean(axis=0))
+    skew = np.cbrt((centered ** 3).mean(axis=0))
+    return np.stack([mean, std, skew], axis=1).ravel().astype(np.float32)
+
+def _gray_pyramid(gray, smallest_level):
+    """Halve gray while the next level is still at least smallest_level on each side."""
+    levels = [gray]
+    while min(levels[-1].size) // 2 >= smallest_level:
+        levels.append(levels[-1].reduce(2))
+    return levels
+
+def _from_pyramid(levels, size):
+    # Smallest level that is still comfortably larger than the thumbnail
+    for level in reversed(levels):
+        if level.width >= size[0] * PYRAMID_OVERSAMPLE and level.height >= size[1] * PYRAMID_OVERSAMPLE:
+            return level
+    return levels[0]
+
+def thumbnails(img, fingerprints=DEFAULT_FINGERPRINTS, fast_decode=True):
+    """Decode an open image once and return {name: thumbnail} for the fingerprints asked for.
+
+    Grayscale thumbnails are uint8 arrays; the color thumbnail is an RGB image.
+    """
+    sizes = {name: _thumbnail_size(name, size) for name, size in fingerprints.items()}
+    largest = max(max(size) for size in sizes.values())
+    if fast_decode:
+        # Let the JPEG decoder scale by up to 1/8 in the DCT; no-op for other formats
+        img.draft("RGB" if "color" in sizes else "L", (largest * PYRAMID_OVERSAMPLE,) * 2)
+
+    result = {}
+    gray_sizes = {name: size for name, size in sizes.items() if name != "color"}
+    if gray_sizes:
+        smallest = min(min(size) for size in gray_sizes.values()) * PYRAMID_OVERSAMPLE
+        levels = _gray_pyramid(img.convert("L"), smallest)
+        for name, size in gray_sizes.items():
+            level = _from_pyramid(levels, size)
+            result[name] = np.asarray(level.resize(size, Image.Resampling.LANCZOS), dtype=np.uint8)
+    if "color" in sizes:
+        result["color"] = img.convert("RGB").resize(sizes["color"], Image.Resampling.LANCZOS)
+    return result
+
+def fingerprint_thumbnails(batch, fingerprints=DEFAULT_FINGERPRINTS):
+    """Compute fingerprints for a list of thumbnails() results, one algorithm pass per batch.
+
+    Returns one dict per image mapping each name to an int hash, or to the
+    float32 color moments.
+    """
+    results = [{} for _ in batch]
+    for name, size in fingerprints.items():
+        if not batch:
+            break
+        if name == "color":
+            for result, thumbs in zip(results, batch):
+                result[name] = color_moments(thumbs[name])
+            continue
+        hashes = _hash(name, size, np.stack([thumbs[name] for thumbs in batch]))
+        for result, value in zip(results, hashes):
+            result[name] = _to_int(value)
+    return results
+
+def fingerprint_image(img, fingerprints=DEFAULT_FINGERPRINTS, fast_decode=True):
+    """Return the requested fingerprints of an open image."""
+    return fingerprint_thumbnails([thumbnails(img, fingerprints, fast_decode)], fingerprints)[0]
+
+def fingerprint_file(image_path, fingerprints=DEFAULT_FINGERPRINTS, fast_decode=True):
+    """Return the requested fingerprints of an image file."""
+    with Image.open(image_path) as img:
+        return fingerprint_image(img, fingerprints, fast_decode)
+
+def fingerprint_files(image_paths, fingerprints=DEFAULT_FINGERPRINTS, fast_decode=True, batch_size=256):
+    """Yield (path, fingerprints, error) for each path, in order.
+
+    Images are hashed in batches of batch_size; unreadable files yield
+    fingerprints None and the exception.
+    """
+    image_paths = list(image_paths)
+    for start in range(0, len(image_paths), batch_size):
+        chunk = image_paths[start:start + batch_size]
+        decoded, errors = [], [None] * len(chunk)
+        for i, image_path in enumerate(chunk):
+            try:
+                with Image.open(image_path) as img:
+                    decoded.append((i, thumbnails(img, fingerprints, fast_decode)))
+            except Exception as e:
+                errors[i] = e
+        results = [None] * len(chunk)
+        for (i, _), result in zip(decoded, fingerprint_thumbnails([thumbs for _, thumbs in decoded], fingerprints)):
+            results[i] = result
+        for image_path, result, error in zip(chunk, results, errors):
+            yield image_path, result, error
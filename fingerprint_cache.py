@@ -0,0 +1,118 @@
+import os
+import sqlite3
+
+# Bump when the meaning of the stored columns changes; older caches are dropped
+SCHEMA_VERSION = 5
+# Default cache file name, created inside the scanned root folder
+CACHE_FILENAME = ".fingerprints.sqlite"
+# Number of writes batched into one transaction
+COMMIT_EVERY = 1000
+
+def _normalize(path):
+    return os.path.normcase(os.path.abspath(path))
+
+class FingerprintCache:
+    """On-disk cache of image hash, resolution and decode error per file.
+
+    Entries are looked up by path and only trusted while the file's size and
+    mtime are unchanged. If the path is unknown the inode is tried as well, so
+    files renamed by other tools are still found.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.pending_writes = 0
+        self._create_schema()
+
+    def _create_schema(self):
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self.conn.execute("DROP TABLE IF EXISTS fingerprints")
+            self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS fingerprints (
+                path TEXT PRIMARY KEY,
+                inode INTEGER,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                hash TEXT,
+                width INTEGER,
+                height INTEGER,
+                error TEXT
+            )"""
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS fingerprints_inode ON fingerprints (inode, size, mtime_ns)")
+        self.conn.commit()
+
+    def get(self, path, stat_result):
+        """Return (hash, resolution, error) for an unchanged file, else None."""
+        key = _normalize(path)
+        row = self.conn.execute(
+            "SELECT hash, width, height, error FROM fingerprints WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (key, stat_result.st_size, stat_result.st_mtime_ns),
+        ).fetchone()
+
+        # Some filesystems (FAT on USB drives) report no inode numbers
+        if row is None and stat_result.st_ino:
+            found = self.conn.execute(
+                "SELECT path, hash, width, height, error FROM fingerprints WHERE inode = ? AND size = ? AND mtime_ns = ?",
+                (stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns),
+            ).fetchone()
+            if found is not None:
+                self.rename(found[0], path)
+                row = found[1:]
+
+        if row is None:
+            return None
+        file_hash, width, height, error = row
+        resolution = (width, height) if width is not None else None
+        return file_hash, resolution, error
+
+    def put(self, path, stat_result, file_hash, resolution, error=None):
+        """Store the fingerprint of a file."""
+        width, height = resolution if resolution else (None, None)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (_normalize(path), stat_result.st_ino or None, stat_result.st_size, stat_result.st_mtime_ns,
+             file_hash, width, height, error),
+        )
+        self._written()
+
+    def rename(self, old_path, new_path):
+        """Move a file's entry to its new name after a rename."""
+        self.conn.execute("DELETE FROM fingerprints WHERE path = ?", (_normalize(new_path),))
+        self.conn.execute(
+            "UPDATE fingerprints SET path = ? WHERE path = ?",
+            (_normalize(new_path), _normalize(old_path)),
+        )
+        self._written()
+
+    def rename_folder(self, old_dir, new_dir):
+        """Move the entries of every file below a renamed folder."""
+        old_prefix = os.path.join(_normalize(old_dir), "")
+        new_prefix = os.path.join(_normalize(new_dir), "")
+        self.conn.execute(
+            "UPDATE fingerprints SET path = ? || substr(path, ?) WHERE substr(path, 1, ?) = ?",
+            (new_prefix, len(old_prefix) + 1, len(old_prefix), old_prefix),
+        )
+        self._written()
+
+    def _written(self):
+        self.pending_writes += 1
+        if self.pending_writes >= COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.pending_writes = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,45 @@
+"""Hash algorithm, hash size and distance threshold shared by the dedup scripts.
+
+tune_hashes.py measures every combination on a labeled corpus and writes the
+recommended one to hash_config.json next to the scripts. The scripts read it
+with load_hash_config(); without the file they keep their own settings, for
+most of them DEFAULT_HASH_CONFIG: an 8x8 average hash with exact matching.
+algorithm, hash_size and max_distance are for dupli_across_size.py, the
+script whose hash is configurable; "scripts" holds the thresholds of the
+scripts whose hash is fixed.
+"""
+import json
+import os
+
+HASH_CONFIG_FILENAME = "hash_config.json"
+DEFAULT_HASH_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), HASH_CONFIG_FILENAME)
+DEFAULT_HASH_CONFIG = {"algorithm": "ahash", "hash_size": 8, "max_distance": 0}
+
+def config_key(algorithm, hash_size):
+    return f"{algorithm}/{hash_size}"
+
+def load_hash_config(config_path=DEFAULT_HASH_CONFIG_PATH, default=None):
+    """Return the saved configuration, or default if there is none."""
+    if not config_path or not os.path.exists(config_path):
+        return default
+    config = dict(DEFAULT_HASH_CONFIG)
+    with open(config_path, encoding="utf-8") as f:
+        config.update(json.load(f))
+    return config
+
+def max_distance_for(config, script, default=0):
+    """Return the threshold tuned for a script whose hash algorithm and size are fixed, or default.
+
+    tune_hashes.py scores those scripts on their own hash functions and keeps
+    one threshold per script name. config may be None, meaning nothing was tuned.
+    """
+    if config is None:
+        return default
+    return config.get("scripts", {}).get(script, default)
+
+def save_hash_config(config, config_path=DEFAULT_HASH_CONFIG_PATH):
+    """Write the configuration, atomically replacing config_path."""
+    temp_path = config_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=2)
+    os.replace(temp_path, config_path)
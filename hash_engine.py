@@ -0,0 +1,109 @@
+"""NumPy perceptual hashes over uint8 thumbnails.
+
+Every hash function takes a single grayscale thumbnail (2-D uint8 array) or a
+batch of them (3-D array, one thumbnail per row) and returns the hash bits
+packed into uint64 values, first pixel in the most significant bit. Hashes of
+up to 64 bits give one uint64 per thumbnail; larger hash sizes give several
+words per thumbnail, most significant word first.
+"""
+import hashlib
+import numpy as np
+from PIL import Image
+
+# Smallest size a JPEG is decoded at before hash_thumbnail scales it down
+DRAFT_SIZE = (64, 64)
+
+def hash_thumbnail(img, fast_decode=False, size=(8, 8)):
+    """Return the grayscale thumbnail dupli_across_size2 hashes, as a uint8 array.
+
+    Takes an image that is open but not yet loaded. Everything that hashes
+    files for dupli_across_size2 and its fingerprint cache (the thumbnail
+    store, the pipeline's hash stage) goes through this function, so all of
+    them produce the same bits for the same file. fast_decode is off by
+    default: a draft decode moves some hashes by a bit or more, which changes
+    the duplicate groups (see bench_fast_decode.py).
+    """
+    if fast_decode:
+        # Let the JPEG decoder scale by up to 1/8 in the DCT; no-op for other formats
+        img.draft("L", DRAFT_SIZE)
+    return np.asarray(img.resize(size, Image.Resampling.LANCZOS).convert("L"), dtype=np.uint8)
+
+def to_gray_array(img, size, resample=Image.Resampling.LANCZOS):
+    """Convert a PIL image to a grayscale uint8 thumbnail of size (width, height)."""
+    return np.asarray(img.convert("L").resize(size, resample), dtype=np.uint8)
+
+def _as_batch(pixels):
+    pixels = np.asarray(pixels)
+    if pixels.ndim == 2:
+        return pixels[np.newaxis], True
+    if pixels.ndim != 3:
+        raise ValueError(f"Expected a 2-D thumbnail or a 3-D batch, got shape {pixels.shape}")
+    return pixels, False
+
+def pack_bits(bits):
+    """Pack a boolean array of shape (N, ...) into big-endian uint64 words per row."""
+    bits = np.asarray(bits, dtype=bool).reshape(len(bits), -1)
+    nbits = bits.shape[1]
+    words = -(-nbits // 64)
+    # Left-pad so the value of each row equals its bit string read as a binary number
+    padded = np.zeros((len(bits), words * 64), dtype=bool)
+    padded[:, words * 64 - nbits:] = bits
+    packed = np.packbits(padded, axis=1).view(">u8").astype(np.uint64)
+    return packed[:, 0] if words == 1 else packed
+
+def _result(packed, single):
+    return packed[0] if single else packed
+
+def ahash(pixels):
+    """Average hash: each pixel is compared with the thumbnail mean."""
+    batch, single = _as_batch(pixels)
+    means = batch.reshape(len(batch), -1).mean(axis=1, dtype=np.float64)
+    return _result(pack_bits(batch > means[:, np.newaxis, np.newaxis]), single)
+
+def dhash(pixels):
+    """Difference hash over thumbnails one column wider than the hash."""
+    batch, single = _as_batch(pixels)
+    return _result(pack_bits(batch[:, :, 1:] > batch[:, :, :-1]), single)
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, np.newaxis]
+    x = np.arange(n)[np.newaxis, :]
+    return np.cos(np.pi * k * (2 * x + 1) / (2 * n))
+
+def phash(pixels, hash_size=8):
+    """DCT hash: low-frequency DCT coefficients compared with their median."""
+    batch, single = _as_batch(pixels)
+    dct = _dct_matrix(batch.shape[1])
+    coefficients = dct @ batch.astype(np.float64) @ _dct_matrix(batch.shape[2]).T
+    low = coefficients[:, :hash_size, :hash_size]
+    medians = np.median(low.reshape(len(low), -1), axis=1)
+    return _result(pack_bits(low > medians[:, np.newaxis, np.newaxis]), single)
+
+def whash(pixels, hash_size=8):
+    """Haar wavelet hash: the low-frequency band of the wavelet transform against its median.
+
+    With Haar wavelets that band is the mean of each block of the thumbnail,
+    so this matches imagehash.whash(image, hash_size, image_scale=thumbnail side),
+    except that blocks tied with the median may land either side in imagehash.
+    """
+    batch, single = _as_batch(pixels)
+    n, height, width = batch.shape
+    blocks = batch.astype(np.float64).reshape(n, hash_size, height // hash_size, hash_size, width // hash_size)
+    low = blocks.mean(axis=(2, 4))
+    medians = np.median(low.reshape(n, -1), axis=1)
+    return _result(pack_bits(low > medians[:, np.newaxis, np.newaxis]), single)
+
+def hamming(a, b):
+    """Element-wise Hamming distance between uint64 words (broadcasts like a ^ b).
+
+    For multi-word hashes, sum the result over the last axis.
+    """
+    diff = np.bitwise_xor(np.asarray(a, dtype=np.uint64), np.asarray(b, dtype=np.uint64))
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(diff).astype(np.int64)
+    return np.unpackbits(diff[..., np.newaxis].view(np.uint8), axis=-1).sum(axis=-1, dtype=np.int64)
+
+def to_md5(value, nbits=64):
+    """MD5 of the '0'/'1' bit string, the key format of the original scripts."""
+    hash_string = format(int(value), f"0{nbits}b")
+    return hashlib.md5(hash_string.encode('utf-8')).hexdigest()
@@ -0,0 +1,99 @@
+def hamming_distance(a, b):
+    """Number of differing bits between two integer hashes."""
+    return bin(a ^ b).count("1")
+
+def hash_to_int(image_hash):
+    """Convert an imagehash.ImageHash (or a hex string) to an integer."""
+    return int(str(image_hash), 16)
+
+class HammingIndex:
+    """Near-duplicate lookup over integer hashes using a BK-tree.
+
+    Each distinct hash keeps a list of payloads. find() returns the payload list
+    of the nearest stored hash within max_distance bits, so callers can use it
+    like the dict they replace: append to the returned list or add a new hash.
+    Exact lookups (max_distance=0) go through a plain dict.
+    """
+
+    def __init__(self):
+        # A node is [hash, payloads, {distance: child node}]
+        self.root = None
+        self.nodes = {}
+
+    @classmethod
+    def build(cls, items):
+        """Bulk-build an index from (hash, payload) pairs."""
+        index = cls()
+        grouped = {}
+        for value, payload in items:
+            grouped.setdefault(value, []).append(payload)
+        for value, payloads in grouped.items():
+            index._insert(value).extend(payloads)
+        return index
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, value):
+        return value in self.nodes
+
+    def add(self, value, payload):
+        """Add a payload under a hash, creating the hash if needed."""
+        self._insert(value).append(payload)
+
+    def _insert(self, value):
+        node = self.nodes.get(value)
+        if node is not None:
+            return node[1]
+
+        new_node = [value, [], {}]
+        self.nodes[value] = new_node
+        if self.root is None:
+            self.root = new_node
+            return new_node[1]
+
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = new_node
+                return new_node[1]
+            node = child
+
+    def query(self, value, max_distance):
+        """Return (distance, hash, payloads) for every hash within max_distance."""
+        if max_distance == 0:
+            node = self.nodes.get(value)
+            return [(0, value, node[1])] if node is not None else []
+
+        matches = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= max_distance:
+                matches.append((distance, node[0], node[1]))
+            # Triangle inequality: only children in this distance band can match
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return matches
+
+    def find(self, value, max_distance=0):
+        """Return the payload list of the nearest hash within max_distance, or None."""
+        node = self.nodes.get(value)
+        if node is not None:
+            return node[1]
+        if max_distance == 0:
+            return None
+
+        matches = self.query(value, max_distance)
+        if not matches:
+            return None
+        return min(matches, key=lambda match: match[0])[2]
+
+    def items(self):
+        """Yield (hash, payloads) for every stored hash, in insertion order."""
+        for value, node in self.nodes.items():
+            yield value, node[1]
@@ -0,0 +1,239 @@
+"""Compact, array-backed store of image hashes, resolutions and paths.
+
+One row per image: the 64-bit hash and file size in uint64 arrays, width and
+height in uint16 arrays, and the path split into an interned directory id
+(uint32) and a file name kept in one UTF-8 blob addressed by start and length
+arrays. That is a few dozen bytes per image instead of a dict of tuples and
+strings.
+
+save() writes everything to a single file: an 8-byte magic, the length of a
+JSON header describing each section, the header, then the raw arrays aligned
+to 64 bytes. load() memory-maps the arrays, so a saved store can be queried
+straight away without reading or parsing the rows.
+"""
+import json
+import os
+import struct
+
+import numpy as np
+
+import hash_engine
+
+MAGIC = b"HSTORE1\0"
+FORMAT_VERSION = 2
+SECTION_ALIGNMENT = 64
+
+# Per-row arrays, in file order
+_ROW_ARRAYS = {
+    "hashes": np.uint64,
+    "sizes": np.uint64,
+    "widths": np.uint16,
+    "heights": np.uint16,
+    "dir_ids": np.uint32,
+    "name_starts": np.uint64,
+    "name_lengths": np.uint32,
+}
+
+def _clamp_uint16(value):
+    return min(max(int(value), 0), 0xFFFF)
+
+def _encode(text):
+    return text.encode("utf-8", "surrogateescape")
+
+def _decode(data):
+    return bytes(data).decode("utf-8", "surrogateescape")
+
+class HashStore:
+    """Rows of (hash, resolution, size, path), appendable in memory or memory-mapped from a file.
+
+    A loaded store keeps its arrays memory-mapped until it is modified; the
+    first add() or rename() copies them into memory. meta is a small dict of
+    JSON values saved in the file header.
+    """
+
+    def __init__(self, capacity=1024):
+        self.count = 0
+        for name, dtype in _ROW_ARRAYS.items():
+            setattr(self, name, np.zeros(capacity, dtype=dtype))
+        self.name_blob = bytearray()
+        self.dirs = []
+        self.dir_index = {}
+        self.mapped = False
+        self.meta = {}
+
+    def __len__(self):
+        return self.count
+
+    def _make_writable(self, capacity):
+        for name in _ROW_ARRAYS:
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+        if self.mapped:
+            self.name_blob = bytearray(self.name_blob)
+            self.mapped = False
+
+    def _reserve(self, rows):
+        if self.mapped or self.count + rows > len(self.hashes):
+            self._make_writable(max(2 * len(self.hashes), self.count + rows, 1024))
+
+    def _dir_id(self, folder):
+        dir_id = self.dir_index.get(folder)
+        if dir_id is None:
+            dir_id = len(self.dirs)
+            self.dirs.append(folder)
+            self.dir_index[folder] = dir_id
+        return dir_id
+
+    def _set_path(self, row, path):
+        folder, name = os.path.split(path)
+        encoded = _encode(name)
+        self.dir_ids[row] = self._dir_id(folder)
+        self.name_starts[row] = len(self.name_blob)
+        self.name_lengths[row] = len(encoded)
+        self.name_blob.extend(encoded)
+
+    def add(self, path, image_hash, resolution, size=0):
+        """Append a row and return its index. Resolutions are clamped to 65535."""
+        self._reserve(1)
+        row = self.count
+        self.hashes[row] = image_hash
+        self.sizes[row] = size
+        self.widths[row] = _clamp_uint16(resolution[0])
+        self.heights[row] = _clamp_uint16(resolution[1])
+        self._set_path(row, path)
+        self.count += 1
+        return row
+
+    def name(self, row):
+        start = int(self.name_starts[row])
+        return _decode(self.name_blob[start:start + int(self.name_lengths[row])])
+
+    def path(self, row):
+        return os.path.join(self.dirs[int(self.dir_ids[row])], self.name(row))
+
+    def resolution(self, row):
+        return int(self.widths[row]), int(self.heights[row])
+
+    def rename(self, row, new_path):
+        """Point a row at a new path. The old name stays in the blob unused."""
+        self._reserve(0)
+        self._set_path(row, new_path)
+
+    def rename_folder(self, old_folder, new_folder):
+        """Move every row under old_folder, including subfolders, to new_folder."""
+        prefix = old_folder + os.sep
+        for dir_id, folder in enumerate(self.dirs):
+            if folder == old_folder or folder.startswith(prefix):
+                renamed = new_folder + folder[len(old_folder):]
+                if self.dir_index.get(folder) == dir_id:
+                    del self.dir_index[folder]
+                self.dirs[dir_id] = renamed
+                self.dir_index[renamed] = dir_id
+
+    @classmethod
+    def concat(cls, stores):
+        """Return a new in-memory store holding the rows of every store, in order."""
+        merged = cls(capacity=0)
+        for name in _ROW_ARRAYS:
+            setattr(merged, name, np.concatenate([getattr(store, name)[:store.count] for store in stores]
+                                                 or [np.zeros(0, dtype=_ROW_ARRAYS[name])]))
+        blob_offset, row_offset = 0, 0
+        for store in stores:
+            rows = slice(row_offset, row_offset + store.count)
+            dir_map = np.array([merged._dir_id(folder) for folder in store.dirs], dtype=np.uint32)
+            if store.count:
+                merged.dir_ids[rows] = dir_map[store.dir_ids[:store.count]]
+            merged.name_starts[rows] += np.uint64(blob_offset)
+            merged.name_blob.extend(bytes(store.name_blob))
+            blob_offset += len(store.name_blob)
+            row_offset += store.count
+        merged.count = row_offset
+        return merged
+
+    def query(self, value, max_distance=0):
+        """Return the rows whose hash is within max_distance bits of value."""
+        distances = hash_engine.hamming(self.hashes[:self.count], np.uint64(value))
+        return np.flatnonzero(distances <= max_distance)
+
+    def exact_groups(self):
+        """Return arrays of rows that share a hash, for hashes held by more than one row.
+
+        Groups are ordered by their first row and rows within a group by index.
+        """
+        hashes = self.hashes[:self.count]
+        order = np.argsort(hashes, kind="stable")
+        sorted_hashes = hashes[order]
+        boundaries = np.flatnonzero(sorted_hashes[1:] != sorted_hashes[:-1]) + 1
+        groups = [group for group in np.split(order, boundaries) if len(group) > 1]
+        groups.sort(key=lambda group: group[0])
+        return groups
+
+    def save(self, store_path):
+        """Write the store to a single file, atomically replacing store_path."""
+        dir_blob = bytearray()
+        dir_offsets = np.zeros(len(self.dirs) + 1, dtype=np.uint64)
+        for i, folder in enumerate(self.dirs):
+            dir_blob.extend(_encode(folder))
+            dir_offsets[i + 1] = len(dir_blob)
+
+        sections = {name: getattr(self, name)[:self.count] for name in _ROW_ARRAYS}
+        sections["name_blob"] = np.frombuffer(bytes(self.name_blob), dtype=np.uint8)
+        sections["dir_offsets"] = dir_offsets
+        sections["dir_blob"] = np.frombuffer(bytes(dir_blob), dtype=np.uint8)
+
+        # Lay the sections out first: the header holds their offsets
+        header = {"version": FORMAT_VERSION, "count": self.count, "meta": self.meta, "sections": {}}
+        header_size = 4096
+        while True:
+            offset = header_size
+            for name, array in sections.items():
+                offset = -(-offset // SECTION_ALIGNMENT) * SECTION_ALIGNMENT
+                header["sections"][name] = {"offset": offset, "dtype": array.dtype.str, "length": len(array)}
+                offset += array.nbytes
+            header_bytes = json.dumps(header).encode("utf-8")
+            if len(MAGIC) + 8 + len(header_bytes) <= header_size:
+                break
+            header_size *= 2
+
+        temp_path = store_path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<Q", len(header_bytes)))
+            f.write(header_bytes)
+            for name, array in sections.items():
+                f.seek(header["sections"][name]["offset"])
+                f.write(array.tobytes())
+        os.replace(temp_path, store_path)
+
+    @classmethod
+    def load(cls, store_path):
+        """Memory-map a saved store. Only the header and directory table are read."""
+        with open(store_path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{store_path} is not a hash store")
+            header_length, = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(header_length))
+        if header["version"] != FORMAT_VERSION:
+            raise ValueError(f"{store_path} has unsupported version {header['version']}")
+
+        sections = {}
+        for name, section in header["sections"].items():
+            if section["length"] == 0:
+                sections[name] = np.zeros(0, dtype=np.dtype(section["dtype"]))
+            else:
+                sections[name] = np.memmap(store_path, dtype=np.dtype(section["dtype"]), mode="r",
+                                           offset=section["offset"], shape=(section["length"],))
+
+        store = cls(capacity=0)
+        store.count = header["count"]
+        store.meta = header.get("meta", {})
+        for name in _ROW_ARRAYS:
+            setattr(store, name, sections[name])
+        store.name_blob = sections["name_blob"]
+        dir_offsets, dir_blob = sections["dir_offsets"], sections["dir_blob"]
+        store.dirs = [_decode(dir_blob[int(start):int(end)]) for start, end in zip(dir_offsets[:-1], dir_offsets[1:])]
+        store.dir_index = {folder: dir_id for dir_id, folder in enumerate(store.dirs)}
+        store.mapped = True
+        return store
@@ -0,0 +1,105 @@
+"""Decode and transform images in worker processes for the PyTorch classifiers.
+
+JPEG decoding and the torchvision transform are CPU work of their own; done
+on the model's thread they alternate with the forward pass instead of
+overlapping it. load_batches() hands chunks of batch_size files to a process
+pool and yields them back in input order as stacked tensors, with at most
+prefetch_depth batches per worker loaded ahead of the model. items may be a
+lazy iterator such as a TreeScanner, so work starts before the scan ends.
+
+A file that cannot be read, decoded or transformed does not fail its batch:
+it comes back as a LoadError naming the step and the exception type.
+"""
+import collections
+import itertools
+import os
+import signal
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from prefetch import open_image
+
+# Worker processes decoding and transforming images
+LOADER_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+# Batches per worker loaded ahead of the model
+PREFETCH_DEPTH = 2
+
+# stage is "read", "decode" or "transform"; error_type is the exception's class name
+LoadError = collections.namedtuple("LoadError", ["item", "stage", "error_type", "message"])
+# items and the rows of tensor match; tensor is None if no file of the batch loaded
+LoadedBatch = collections.namedtuple("LoadedBatch", ["items", "tensor", "errors"])
+
+_worker_transform = None
+
+def _init_worker(transform):
+    # Leave Ctrl-C handling to the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    global _worker_transform
+    _worker_transform = transform
+
+def load_tensor(path, transform):
+    """Read, decode and transform one file. Returns (tensor, None) or (None, (stage, error type, message))."""
+    stage = "read"
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        stage = "decode"
+        with open_image(data) as img:
+            image = img.convert("RGB")
+        stage = "transform"
+        return transform(image), None
+    except Exception as e:
+        return None, (stage, type(e).__name__, str(e))
+
+def _load_chunk(paths):
+    return [load_tensor(path, _worker_transform) for path in paths]
+
+def _collate(items, results, pin_memory):
+    import torch
+    loaded, tensors, errors = [], [], []
+    for item, (tensor, error) in zip(items, results):
+        if error is None:
+            loaded.append(item)
+            tensors.append(tensor)
+        else:
+            errors.append(LoadError(item, *error))
+    batch = torch.stack(tensors) if tensors else None
+    if batch is not None and pin_memory:
+        batch = batch.pin_memory()
+    return LoadedBatch(loaded, batch, errors)
+
+def load_batches(items, transform, batch_size, workers=LOADER_WORKERS, prefetch_depth=PREFETCH_DEPTH, pin_memory=None):
+    """Yield a LoadedBatch per batch_size items, in input order.
+
+    items are paths or os.DirEntry objects and are yielded back unchanged.
+    transform must be picklable, as torchvision transforms are. With workers 0
+    everything runs in this process. pin_memory defaults to whether CUDA is
+    available, so batches can be copied to the GPU asynchronously.
+    """
+    import torch
+    if pin_memory is None:
+        pin_memory = torch.cuda.is_available()
+    items = iter(items)
+    chunks = iter(lambda: list(itertools.islice(items, batch_size)), [])
+
+    if workers < 1:
+        for chunk in chunks:
+            yield _collate(chunk, [load_tensor(os.fspath(item), transform) for item in chunk], pin_memory)
+        return
+
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(transform,))
+    pending = deque()
+    try:
+        for chunk in chunks:
+            pending.append((chunk, executor.submit(_load_chunk, [os.fspath(item) for item in chunk])))
+            if len(pending) >= workers * prefetch_depth:
+                chunk, future = pending.popleft()
+                yield _collate(chunk, future.result(), pin_memory)
+        while pending:
+            chunk, future = pending.popleft()
+            yield _collate(chunk, future.result(), pin_memory)
+    except BaseException:
+        # Ctrl-C or an abandoned generator: drop queued work and stop the pool
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
@@ -0,0 +1,29 @@
+import collections
+from PIL import Image
+
+ImageProbe = collections.namedtuple("ImageProbe", ["resolution", "format", "orientation", "hash"])
+
+# EXIF tag holding the camera orientation (1 = upright)
+EXIF_ORIENTATION = 0x0112
+# Formats whose EXIF block is parsed with the header; PNG and others would need a full decode
+HEADER_EXIF_FORMATS = {"JPEG", "MPO", "TIFF"}
+
+def probe_image(image_path, hash_func=None):
+    """Open an image once and return its resolution, format, EXIF orientation and hash.
+
+    Without hash_func only the file header is read and hash is None. hash_func
+    is called with the open image and may decode it; resolution is taken
+    before that, so reduced-size decoding does not affect it.
+    """
+    with Image.open(image_path) as img:
+        resolution = img.size
+        image_format = img.format
+        orientation = None
+        if image_format in HEADER_EXIF_FORMATS:
+            try:
+                orientation = img.getexif().get(EXIF_ORIENTATION, 1)
+            except Exception:
+                # A damaged EXIF block should not make the image unreadable
+                orientation = None
+        image_hash = hash_func(img) if hash_func is not None else None
+    return ImageProbe(resolution, image_format, orientation, image_hash)
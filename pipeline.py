@@ -0,0 +1,468 @@
+"""Run dedup, classification and detection over a tree in one pass.
+
+Usage: python pipeline.py <root> [--stage NAME ...] [--workers STAGE=N ...]
+                          [--batch-size STAGE=N ...] [--decode-workers N]
+                          [--max-distance BITS] [--dry-run] [--report report.json]
+
+The readme's steps are separate scripts that each walk and decode the whole
+tree. Here the tree is walked once (TreeScanner), every file is read once
+(Prefetcher) and decoded once, draft-scaled to the largest size any enabled
+stage asks for. Each decoded image is then handed to every stage; the hash
+stage decodes the file's bytes again on its own at 1/8 scale, so its hashes
+are those of dupli_across_size2 and its fingerprint cache:
+
+    hash      8x8 average hash, grouped like dupli_across_size2 (_Size renames)
+    classify  classi2's category model; files move to <subfolder>/<category>
+    faces     face_recognition face locations; files with faces are copied
+    yellow    yellow2's person and yellow shirt detector; matches are copied
+
+Every stage has its own thread pool and batch size, and at most a few
+batches in flight, so all stages run at once and the slowest one sets the
+pace: wall time approaches the busiest stage's time rather than the sum.
+Stages load their models lazily on the first batch.
+
+Nothing on disk changes until every stage is done. The stages then plan their
+moves and copies on one CommitPlan, which runs them together, moves journaled
+for undo with rename_plan.py. --dry-run prints the plan instead.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import hash_engine
+from hash_store import HashStore
+from prefetch import Prefetcher, open_image
+from rename_plan import RenameJournal, RenamePlanner, new_journal_path
+from scan_pipeline import TreeScanner
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tiff")
+# Threads decoding images for all stages
+DECODE_WORKERS = os.cpu_count() or 1
+# Batches queued or running per stage worker before decoding waits for that stage
+BATCHES_AHEAD = 2
+# Folders the pipeline writes to or the scripts leave alone
+SKIPPED_FOLDERS = {"Error", "found_images", "face_images", ".thumb_store"}
+
+def fit(image, side):
+    """Scale an image down, keeping its aspect ratio, so its longest side is at most side."""
+    if side is None or max(image.size) <= side:
+        return image
+    scale = side / max(image.size)
+    return image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+                        Image.Resampling.LANCZOS)
+
+class Stage:
+    """One consumer of decoded images.
+
+    prepare() runs on the decode threads and turns the shared RGB image into
+    this stage's input; process() runs on the stage's own pool, a batch at a
+    time; plan() runs in the commit phase with {path: result} of every image.
+    input_size is the longest image side the stage needs, None for full size.
+    A stage with own_decode gets the file's bytes in prepare_data() instead
+    and takes no part in the shared decode.
+    """
+    name = None
+    workers = 1
+    batch_size = 1
+    input_size = None
+    own_decode = False
+
+    def __init__(self, workers=None, batch_size=None):
+        if workers is not None:
+            self.workers = workers
+        if batch_size is not None:
+            self.batch_size = batch_size
+        self.loaded = False
+        self.load_lock = threading.Lock()
+
+    def ensure_loaded(self):
+        with self.load_lock:
+            if not self.loaded:
+                self.load()
+                self.loaded = True
+
+    def load(self):
+        """Import dependencies and load models; called once, before the first batch."""
+
+    def prepare(self, image, resolution):
+        return image
+
+    def prepare_data(self, data, resolution):
+        raise NotImplementedError
+
+    def process(self, inputs):
+        raise NotImplementedError
+
+    def plan(self, results, commit, root):
+        """Add this stage's moves and copies to commit."""
+
+class HashStage(Stage):
+    """8x8 average hash; duplicates get dupli_across_size2's _Size names."""
+    name = "hash"
+    batch_size = 256
+    own_decode = True
+
+    def __init__(self, max_distance=0, **kwargs):
+        super().__init__(**kwargs)
+        self.max_distance = max_distance
+
+    def prepare_data(self, data, resolution):
+        # Same full decode as dupli_across_size2.image_bits, not the shared draft-decoded RGB one
+        with open_image(data) as img:
+            return hash_engine.hash_thumbnail(img), resolution
+
+    def process(self, inputs):
+        hashes = hash_engine.ahash(np.stack([thumb for thumb, _ in inputs]))
+        return [(int(value), resolution) for value, (_, resolution) in zip(hashes, inputs)]
+
+    def plan(self, results, commit, root):
+        from dupli_across_size2 import plan_renames
+        store = HashStore()
+        for path, (value, resolution) in results.items():
+            store.add(path, value, resolution)
+        for path, new_path, _ in plan_renames(store, self.max_distance):
+            commit.move(path, new_path)
+
+class ClassifyStage(Stage):
+    """classi2's category model; each file moves into <subfolder of root>/<category>."""
+    name = "classify"
+    batch_size = 32
+    input_size = 224
+
+    def load(self):
+        import classi2
+        self.classi2 = classi2
+        self.model = classi2.load_model()
+
+    def prepare(self, image, resolution):
+        self.ensure_loaded()
+        return self.classi2.transform(image)
+
+    def process(self, inputs):
+        return self.classi2.predict_tensors(inputs, self.model)
+
+    def plan(self, results, commit, root):
+        for path, category in results.items():
+            destination = commit.destination(path)
+            relative = os.path.relpath(destination, root).split(os.sep)
+            target_dir = os.path.join(root, relative[0]) if len(relative) > 1 else root
+            commit.move(path, os.path.join(target_dir, category, os.path.basename(destination)))
+
+class FaceStage(Stage):
+    """face_recognition face locations, in full-image coordinates; files with faces are copied."""
+    name = "faces"
+    input_size = 1024
+    output_folder = "face_images"
+
+    def load(self):
+        import face_recognition
+        self.face_recognition = face_recognition
+
+    def prepare(self, image, resolution):
+        return np.asarray(fit(image, self.input_size)), resolution
+
+    def process(self, inputs):
+        results = []
+        for pixels, resolution in inputs:
+            scale = resolution[0] / pixels.shape[1]
+            locations = self.face_recognition.face_locations(pixels)
+            results.append([tuple(round(v * scale) for v in location) for location in locations])
+        return results
+
+    def plan(self, results, commit, root):
+        for path, locations in results.items():
+            if locations:
+                commit.copy(path, os.path.join(root, self.output_folder))
+
+class YellowStage(Stage):
+    """yellow2's person and yellow shirt detector; matches are copied to found_images."""
+    name = "yellow"
+    batch_size = 8
+    input_size = 1280
+    output_folder = "found_images"
+
+    def load(self):
+        import yellow2
+        yellow2.load_model()
+        self.yellow2 = yellow2
+
+    def prepare(self, image, resolution):
+        # OpenCV order, as cv2.imread gives it
+        return np.ascontiguousarray(np.asarray(fit(image, self.input_size))[:, :, ::-1])
+
+    def process(self, inputs):
+        return self.yellow2.detect_yellow_shirts(inputs)
+
+    def plan(self, results, commit, root):
+        for path, found in results.items():
+            if found:
+                commit.copy(path, os.path.join(root, self.output_folder))
+
+STAGES = {stage.name: stage for stage in (HashStage, ClassifyStage, FaceStage, YellowStage)}
+DEFAULT_STAGES = ("hash", "classify")
+
+class CommitPlan:
+    """Moves and copies requested by the stages, run together once every stage is done.
+
+    move() replaces the file's planned destination, so a later stage can
+    build on an earlier one through destination(). Copies are made from the
+    file's final location.
+    """
+
+    def __init__(self):
+        self.destinations = {}
+        self.copies = []
+
+    def destination(self, path):
+        return self.destinations.get(path, path)
+
+    def move(self, path, new_path):
+        self.destinations[path] = new_path
+
+    def copy(self, path, folder):
+        self.copies.append((path, folder))
+
+    def execute(self, journal=None, dry_run=False):
+        """Run the moves, then the copies, and return (moved, copied)."""
+        planner = RenamePlanner()
+        final = {}
+        for src, dst in self.destinations.items():
+            if dst == src:
+                continue
+            folder, name = os.path.split(dst)
+            if planner.exists(dst):
+                base, ext = os.path.splitext(name)
+                dst = planner.unique_path(folder, base, "_{}", ext)
+            planner.add(src, dst, "Moved")
+            final[src] = dst
+
+        if dry_run:
+            for src, dst, label in planner.plan:
+                print(f"{label}: {src} -> {dst}")
+            for src, folder in self.copies:
+                print(f"Copy: {final.get(src, src)} -> {folder}")
+            return len(planner.plan), len(self.copies)
+
+        for folder in {os.path.dirname(dst) for _, dst, _ in planner.plan}:
+            os.makedirs(folder, exist_ok=True)
+        moved = planner.execute(journal)
+        copied = 0
+        for src, folder in self.copies:
+            source = final.get(src, src)
+            try:
+                os.makedirs(folder, exist_ok=True)
+                shutil.copy2(source, os.path.join(folder, os.path.basename(source)))
+                copied += 1
+            except OSError as e:
+                print(f"Error copying {source} to {folder}: {e}")
+        return moved, copied
+
+class _StageRunner:
+    """A stage's pool, its pending batch, results and timings."""
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.executor = ThreadPoolExecutor(max_workers=stage.workers, thread_name_prefix=f"Stage-{stage.name}")
+        self.slots = threading.Semaphore(stage.workers * BATCHES_AHEAD)
+        self.pending = []
+        self.futures = []
+        self.results = {}
+        self.errors = {}
+        self.busy_seconds = 0.0
+        self.waited_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, path, item):
+        self.pending.append((path, item))
+        if len(self.pending) >= self.stage.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        start = time.perf_counter()
+        # Blocks while this stage is BATCHES_AHEAD batches per worker behind
+        self.slots.acquire()
+        self.waited_seconds += time.perf_counter() - start
+        self.futures.append(self.executor.submit(self._run, batch))
+
+    def _run(self, batch):
+        try:
+            self.stage.ensure_loaded()
+            start = time.perf_counter()
+            try:
+                results = self.stage.process([item for _, item in batch])
+                with self.lock:
+                    self.results.update(zip((path for path, _ in batch), results))
+            except Exception as e:
+                with self.lock:
+                    self.errors.update((path, str(e)) for path, _ in batch)
+            with self.lock:
+                self.busy_seconds += time.perf_counter() - start
+        finally:
+            self.slots.release()
+
+    def close(self):
+        self.flush()
+        for future in self.futures:
+            future.result()
+        self.executor.shutdown()
+
+def _decode(path, data, stages, decode_size):
+    """Decode one file and return (resolution, {stage name: input})."""
+    shared = [stage for stage in stages if not stage.own_decode]
+    with open_image(data) as img:
+        resolution = img.size
+        if shared:
+            if decode_size is not None:
+                # Let the JPEG decoder scale by up to 1/8 in the DCT; no-op for other formats
+                img.draft("RGB", (decode_size, decode_size))
+            image = img.convert("RGB")
+    inputs = {}
+    for stage in stages:
+        if stage.own_decode:
+            inputs[stage.name] = stage.prepare_data(data, resolution)
+        else:
+            inputs[stage.name] = stage.prepare(image, resolution)
+    return resolution, inputs
+
+def run_pipeline(root, stages, decode_workers=DECODE_WORKERS, dry_run=False):
+    """Run every stage over the images below root, then commit their moves and copies.
+
+    Returns a report dict with per-stage counts and timings.
+    """
+    sizes = [stage.input_size for stage in stages if not stage.own_decode]
+    decode_size = None if None in sizes or not sizes else max(sizes)
+    runners = [_StageRunner(stage) for stage in stages]
+    decode_errors = {}
+
+    def is_image(entry):
+        name = entry.name.lower()
+        return name.endswith(IMAGE_EXTENSIONS) and not name.endswith(".xxjpg")
+
+    def is_scanned(dirpath):
+        return os.path.basename(dirpath) not in SKIPPED_FOLDERS
+
+    def should_descend(entry):
+        return entry.name not in SKIPPED_FOLDERS
+
+    start = time.perf_counter()
+    scanner = TreeScanner(root, dir_filter=is_scanned, descend=should_descend, entry_filter=is_image)
+    prefetcher = Prefetcher(scanner)
+    decoded = deque()
+
+    def hand_out(entry, future):
+        try:
+            _, inputs = future.result()
+        except Exception as e:
+            decode_errors[entry.path] = str(e)
+            return
+        for runner in runners:
+            runner.add(entry.path, inputs[runner.stage.name])
+
+    with ThreadPoolExecutor(max_workers=decode_workers, thread_name_prefix="Decode") as decoder:
+        for entry, data, error in prefetcher:
+            if error is not None:
+                decode_errors[entry.path] = str(error)
+                continue
+            decoded.append((entry, decoder.submit(_decode, entry.path, data, stages, decode_size)))
+            # Keep images in order, with only a few decoded ahead
+            while len(decoded) > decode_workers * 2:
+                hand_out(*decoded.popleft())
+        while decoded:
+            hand_out(*decoded.popleft())
+    for runner in runners:
+        runner.close()
+    scan_seconds = time.perf_counter() - start
+
+    commit = CommitPlan()
+    for runner in runners:
+        runner.stage.plan(runner.results, commit, root)
+    start = time.perf_counter()
+    if dry_run:
+        moved, copied = commit.execute(dry_run=True)
+    else:
+        # Every move of this run is journaled; undo with: python rename_plan.py undo <journal>
+        with RenameJournal(new_journal_path(root, "pipeline_journal")) as journal:
+            moved, copied = commit.execute(journal)
+    commit_seconds = time.perf_counter() - start
+
+    return {
+        "root": root,
+        "images": scanner.discovered,
+        "decode_errors": decode_errors,
+        "scan_seconds": scan_seconds,
+        "commit_seconds": commit_seconds,
+        "moved": moved,
+        "copied": copied,
+        "prefetch": prefetcher.stats.summary(),
+        "stages": {
+            runner.stage.name: {
+                "workers": runner.stage.workers,
+                "batch_size": runner.stage.batch_size,
+                "images": len(runner.results),
+                "errors": runner.errors,
+                "busy_seconds": runner.busy_seconds,
+                "decode_waited_seconds": runner.waited_seconds,
+            }
+            for runner in runners
+        },
+    }
+
+def _stage_options(values, parser):
+    options = {}
+    for value in values or []:
+        name, _, number = value.partition("=")
+        if name not in STAGES or not number.isdigit() or int(number) < 1:
+            parser.error(f"expected STAGE=N with STAGE one of {', '.join(STAGES)}, got {value!r}")
+        options[name] = int(number)
+    return options
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("root")
+    parser.add_argument("--stage", action="append", choices=sorted(STAGES),
+                        help=f"stage to run (default: {', '.join(DEFAULT_STAGES)})")
+    parser.add_argument("--workers", action="append", metavar="STAGE=N", help="threads for one stage")
+    parser.add_argument("--batch-size", action="append", metavar="STAGE=N", help="batch size for one stage")
+    parser.add_argument("--decode-workers", type=int, default=DECODE_WORKERS)
+    parser.add_argument("--max-distance", type=int, default=0, help="hash stage: bits apart that still count as duplicates")
+    parser.add_argument("--dry-run", action="store_true", help="print the moves and copies instead of making them")
+    parser.add_argument("--report", help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    workers = _stage_options(args.workers, parser)
+    batch_sizes = _stage_options(args.batch_size, parser)
+    stages = []
+    for name in args.stage or DEFAULT_STAGES:
+        kwargs = {"workers": workers.get(name), "batch_size": batch_sizes.get(name)}
+        if name == "hash":
+            kwargs["max_distance"] = args.max_distance
+        stages.append(STAGES[name](**kwargs))
+
+    report = run_pipeline(args.root, stages, args.decode_workers, args.dry_run)
+    print(f"{report['images']} images in {report['scan_seconds']:.1f}s, {len(report['decode_errors'])} undecodable; "
+          f"commit {report['commit_seconds']:.1f}s: {report['moved']} moved, {report['copied']} copied")
+    print(report["prefetch"])
+    for name, stage in report["stages"].items():
+        print(f"{name:>9}: {stage['images']} images, {len(stage['errors'])} errors, busy {stage['busy_seconds']:.1f}s "
+              f"({stage['workers']} workers, batches of {stage['batch_size']}), "
+              f"decoding waited {stage['decode_waited_seconds']:.1f}s for it")
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,111 @@
+"""Read files ahead of the decode stage so disk and CPU work overlap.
+
+A small thread pool reads upcoming files into memory while the caller
+decodes the current one. At most max_ahead files are read or waiting at a
+time, and reading pauses while the unconsumed buffers exceed byte_budget.
+The stats tell whether the disk keeps up: consumer waits ("starved") mean
+decode was faster than the disk; none means the disk was ahead.
+"""
+import io
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Reader threads; a USB disk rarely benefits from more than a few
+PREFETCH_READERS = 4
+# Upper bound on bytes read but not yet handed to the consumer
+PREFETCH_BYTE_BUDGET = 256 * 1024 * 1024
+
+def open_image(data):
+    """Open an in-memory file with PIL."""
+    from PIL import Image
+    return Image.open(io.BytesIO(data))
+
+def decode_cv2(data, flags=None):
+    """Decode an in-memory file with OpenCV, BGR like cv2.imread. Returns None if undecodable."""
+    import cv2
+    import numpy as np
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR if flags is None else flags)
+
+class PrefetchStats:
+    """Counters for one Prefetcher run."""
+
+    def __init__(self):
+        self.files = 0
+        self.errors = 0
+        self.bytes_read = 0
+        self.read_seconds = 0.0
+        self.starved = 0
+        self.starved_seconds = 0.0
+        self.start = time.perf_counter()
+        self.elapsed = 0.0
+
+    def summary(self):
+        mib = self.bytes_read / (1024 * 1024)
+        throughput = mib / self.elapsed if self.elapsed else 0.0
+        return (f"Prefetch: {self.files} files, {mib:.1f} MiB in {self.elapsed:.1f}s ({throughput:.1f} MiB/s), "
+                f"{self.errors} read errors, consumer waited {self.starved} times ({self.starved_seconds:.1f}s)")
+
+class Prefetcher:
+    """Iterate over (item, data, error) for each item, with file contents read ahead.
+
+    items may be paths or os.DirEntry objects and may be a lazy iterator, such
+    as a TreeScanner; each item is yielded back unchanged, in order. data is
+    the file's bytes, or None with the exception if reading failed.
+    """
+
+    def __init__(self, items, readers=PREFETCH_READERS, byte_budget=PREFETCH_BYTE_BUDGET, max_ahead=None):
+        self.items = iter(items)
+        self.readers = readers
+        self.byte_budget = byte_budget
+        self.max_ahead = max_ahead if max_ahead is not None else readers * 4
+        self.stats = PrefetchStats()
+        self.lock = threading.Lock()
+        self.buffered_bytes = 0
+
+    def _read(self, item):
+        start = time.perf_counter()
+        with open(item, "rb") as f:
+            data = f.read()
+        with self.lock:
+            self.buffered_bytes += len(data)
+            self.stats.bytes_read += len(data)
+            self.stats.read_seconds += time.perf_counter() - start
+        return data
+
+    def _fill(self, executor, pending):
+        while len(pending) < self.max_ahead and self.buffered_bytes < self.byte_budget:
+            item = next(self.items, None)
+            if item is None:
+                return False
+            pending.append((item, executor.submit(self._read, item)))
+        return True
+
+    def __iter__(self):
+        pending = deque()
+        self.stats.start = time.perf_counter()
+        executor = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix="Prefetch")
+        try:
+            more = self._fill(executor, pending)
+            while pending:
+                item, future = pending.popleft()
+                if not future.done():
+                    self.stats.starved += 1
+                    start = time.perf_counter()
+                    future.exception()
+                    self.stats.starved_seconds += time.perf_counter() - start
+                error = future.exception()
+                data = None if error is not None else future.result()
+                if error is not None:
+                    self.stats.errors += 1
+                else:
+                    with self.lock:
+                        self.buffered_bytes -= len(data)
+                self.stats.files += 1
+                if more:
+                    more = self._fill(executor, pending)
+                yield item, data, error
+        finally:
+            self.stats.elapsed = time.perf_counter() - self.stats.start
+            executor.shutdown(wait=True, cancel_futures=True)
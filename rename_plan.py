@@ -0,0 +1,189 @@
+"""Plan renames in memory, run them in bulk and journal them for undo.
+
+Usage: python rename_plan.py undo <journal.jsonl>
+
+Renames include dupli8_working's moves of unreadable images into Error
+folders. Besides renames, a journal can hold files a run rewrote next to the
+renamed ones, such as dupli8_working's shards, with their earlier contents,
+so an undo rolls them back too.
+"""
+import hashlib
+import json
+import os
+import sys
+import time
+
+def new_journal_path(folder, prefix="rename_journal"):
+    """Return a timestamped journal path inside folder."""
+    return os.path.join(folder, f"{prefix}_{time.strftime('%Y%m%d_%H%M%S')}.jsonl")
+
+def _digest(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def _read_text(path):
+    """Return the contents of a text file, or None if it does not exist."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def replace_file(path, text):
+    """Write a text file atomically so a crash never leaves a half-written file."""
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(path + ".tmp", path)
+
+class RenameJournal:
+    """Append-only log of renames and file rewrites, written before each change is made."""
+
+    def __init__(self, journal_path):
+        self.journal_path = journal_path
+        self.file = open(journal_path, "a", encoding="utf-8")
+
+    def record(self, src, dst):
+        self.file.write(json.dumps({"src": src, "dst": dst}) + "\n")
+        self.file.flush()
+
+    def rename(self, src, dst):
+        """Journal a rename, then perform it."""
+        self.record(src, dst)
+        os.rename(src, dst)
+
+    def replace_file(self, path, text):
+        """Journal a file's current contents and a digest of text, then replace the file with text."""
+        self.file.write(json.dumps({"file": path, "before": _read_text(path), "after": _digest(text)}) + "\n")
+        self.file.flush()
+        replace_file(path, text)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class RenamePlanner:
+    """Collect renames against an in-memory index of the names in each folder.
+
+    Each folder is listed once; after that, name collisions are checked
+    against the index, which also tracks the renames already planned.
+    """
+
+    def __init__(self):
+        self.names = {}
+        self.counters = {}
+        self.plan = []
+
+    def _folder_names(self, folder):
+        key = os.path.normcase(os.path.abspath(folder))
+        names = self.names.get(key)
+        if names is None:
+            names = {os.path.normcase(name) for name in os.listdir(folder)} if os.path.isdir(folder) else set()
+            self.names[key] = names
+        return names
+
+    def exists(self, path):
+        """Whether path exists once the planned renames have run."""
+        folder, name = os.path.split(path)
+        return os.path.normcase(name) in self._folder_names(folder)
+
+    def unique_path(self, folder, base_name, suffix, ext):
+        """Return the first free folder/base_name + suffix.format(n) + ext, counting n from 1."""
+        names = self._folder_names(folder)
+        key = (os.path.normcase(os.path.abspath(folder)), base_name, suffix, ext)
+        # Start after the last number handed out for this name, not at 1 again
+        counter = self.counters.get(key, 1)
+        while os.path.normcase(f"{base_name}{suffix.format(counter)}{ext}") in names:
+            counter += 1
+        self.counters[key] = counter + 1
+        return os.path.join(folder, f"{base_name}{suffix.format(counter)}{ext}")
+
+    def add(self, src, dst, label="Renamed"):
+        """Plan renaming src to dst; label prefixes the message printed when it runs."""
+        src_folder, src_name = os.path.split(src)
+        dst_folder, dst_name = os.path.split(dst)
+        self._folder_names(src_folder).discard(os.path.normcase(src_name))
+        self._folder_names(dst_folder).add(os.path.normcase(dst_name))
+        self.plan.append((src, dst, label))
+
+    def execute(self, journal=None):
+        """Run the planned renames in order and return how many succeeded."""
+        done = run_plan(self.plan, journal)
+        self.plan = []
+        return done
+
+def run_plan(plan, journal=None, resume=False):
+    """Run (src, dst, label) renames in order and return how many succeeded.
+
+    With resume, renames that already happened in an interrupted run (src
+    gone, dst present) are skipped instead of reported as errors.
+    """
+    done = 0
+    for src, dst, label in plan:
+        if resume and not os.path.exists(src) and os.path.exists(dst):
+            continue
+        try:
+            if journal is not None:
+                journal.rename(src, dst)
+            else:
+                os.rename(src, dst)
+            print(f"{label}: {src} -> {dst}")
+            done += 1
+        except OSError as e:
+            print(f"Error renaming {src} to {dst}: {e}")
+    return done
+
+def undo_journal(journal_path):
+    """Reverse every change in a journal, newest first, without rescanning any folder.
+
+    Entries whose change never happened (or was already undone) are skipped.
+    Rewritten files get their earlier contents back; if one of them changed
+    after the run, a later run built on it, and nothing is undone. The
+    journal is renamed to *.undone afterwards.
+    """
+    with open(journal_path, encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+
+    latest = {entry["file"]: entry for entry in entries if "file" in entry}
+    for path, entry in latest.items():
+        current = _read_text(path)
+        if current is None and entry["before"] is None:
+            continue
+        if current is None or (_digest(current) != entry["after"] and current != entry["before"]):
+            raise RuntimeError(f"{path} changed after the run of {journal_path}; undo the later runs first")
+
+    undone = 0
+    for entry in reversed(entries):
+        if "file" in entry:
+            path, before = entry["file"], entry["before"]
+            current = _read_text(path)
+            if current is None or _digest(current) != entry["after"]:
+                continue
+            if before is None:
+                os.remove(path)
+            else:
+                replace_file(path, before)
+            print(f"Rolled back: {path}")
+            undone += 1
+            continue
+        src, dst = entry["src"], entry["dst"]
+        if os.path.exists(dst) and not os.path.exists(src):
+            os.rename(dst, src)
+            print(f"Restored: {dst} -> {src}")
+            undone += 1
+
+    os.replace(journal_path, journal_path + ".undone")
+    return undone
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "undo":
+        print(__doc__)
+        sys.exit(1)
+    try:
+        print(f"Undid {undo_journal(sys.argv[2])} changes")
+    except RuntimeError as e:
+        print(e)
+        sys.exit(1)
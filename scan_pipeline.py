@@ -0,0 +1,125 @@
+"""Streaming directory scan: one os.scandir pass feeding consumers as it goes.
+
+A background thread walks the tree (same order as a top-down os.walk) and
+puts one batch of os.DirEntry objects per directory on a bounded queue, so
+work can start on the first files while the rest of the tree is still being
+listed. DirEntry objects carry the stat information the scan already has.
+"""
+import os
+import queue
+import threading
+
+# Directory batches buffered between the scanner thread and the consumer
+SCAN_QUEUE_SIZE = 64
+
+_DONE = object()
+
+class TreeScanner:
+    """Iterate over the files (or directories) below root while a thread scans ahead.
+
+    dir_filter(dirpath) decides whether a directory's entries are yielded,
+    descend(entry) whether a subdirectory is scanned at all, and
+    entry_filter(entry) whether a single entry is yielded. discovered counts
+    the entries found so far and finished is set once the scan is complete.
+    empty_dirs lists scanned directories that held no files, in scan order.
+    """
+
+    def __init__(self, root, want_dirs=False, dir_filter=None, descend=None, entry_filter=None,
+                 queue_size=SCAN_QUEUE_SIZE):
+        self.root = root
+        self.want_dirs = want_dirs
+        self.dir_filter = dir_filter
+        self.descend = descend
+        self.entry_filter = entry_filter
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stop = threading.Event()
+        self.discovered = 0
+        self.finished = False
+        self.empty_dirs = []
+
+    def _put(self, item):
+        # Give up if the consumer went away, instead of blocking forever
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _list_dir(self, dirpath):
+        files, subdirs = [], []
+        try:
+            with os.scandir(dirpath) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry)
+                        elif entry.is_file():
+                            files.append(entry)
+                    except OSError:
+                        continue
+        except OSError:
+            # Unreadable or vanished directories are skipped, as os.walk does
+            return None, None
+        return files, subdirs
+
+    def _scan(self):
+        try:
+            stack = [self.root]
+            while stack and not self.stop.is_set():
+                dirpath = stack.pop()
+                files, subdirs = self._list_dir(dirpath)
+                if files is None:
+                    continue
+                if not files:
+                    self.empty_dirs.append(dirpath)
+
+                if self.dir_filter is None or self.dir_filter(dirpath):
+                    batch = subdirs if self.want_dirs else files
+                    if self.entry_filter is not None:
+                        batch = [entry for entry in batch if self.entry_filter(entry)]
+                    if batch:
+                        self.discovered += len(batch)
+                        self._put(batch)
+
+                children = [entry.path for entry in subdirs if self.descend is None or self.descend(entry)]
+                # Reverse so the stack pops subdirectories in listing order
+                stack.extend(reversed(children))
+        finally:
+            self.finished = True
+            self._put(_DONE)
+
+    def __iter__(self):
+        thread = threading.Thread(target=self._scan, name="TreeScanner", daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = self.queue.get()
+                if batch is _DONE:
+                    break
+                yield from batch
+        finally:
+            self.stop.set()
+            thread.join()
+
+def _with_progress(scanner, pbar):
+    """Yield from a scanner, growing pbar.total as entries are discovered."""
+    for entry in scanner:
+        if pbar is not None and pbar.total != scanner.discovered:
+            pbar.total = scanner.discovered
+            pbar.refresh()
+        yield entry
+
+def scan_files(root, dir_filter=None, descend=None, file_filter=None, pbar=None):
+    """Yield DirEntry objects for files below root, streaming as the tree is scanned."""
+    scanner = TreeScanner(root, dir_filter=dir_filter, descend=descend, entry_filter=file_filter)
+    return _with_progress(scanner, pbar)
+
+def scan_dirs(root, descend=None, dir_filter=None, pbar=None):
+    """Yield DirEntry objects for directories below root, streaming as the tree is scanned.
+
+    Only subdirectories accepted by descend are scanned, so the consumer may
+    rename any directory it is given that descend rejects.
+    """
+    scanner = TreeScanner(root, want_dirs=True, dir_filter=dir_filter, descend=descend)
+    return _with_progress(scanner, pbar)
@@ -1,14 +1,26 @@
 import tensorflow as tf
 from tensorflow.keras.preprocessing.image import load_img, img_to_array
+import itertools
 import numpy as np
 import os
 import shutil
-import pytesseract
-from PIL import Image
+from text_detect import TextDetector, default_cache_path, measure_file
+from thumb_store import ThumbStore, store_folder_for
 
 # Define class labels
 CLASS_LABELS = ["Document", "Meme", "Normal", "Screenshots"]
 
+# Read the 224x224 input from the shared thumbnail store instead of decoding every file
+USE_THUMB_STORE = False
+
+# Images predicted together in one call
+BATCH_SIZE = 32
+IMAGE_SIZE = (224, 224)
+IMAGE_EXTENSIONS = ('png', 'jpg', 'jpeg', 'bmp', 'gif')
+
+# Percentage of a "Document" image that must be covered by text for it to stay a Document
+TEXT_AREA_THRESHOLD = 30
+
 # Load a pre-trained MobileNetV2 model for feature extraction
 def load_model():
 
@@ -41,47 +53,123 @@ def load_or_fine_tune_model(model_path="model.h5"):
     return model
 
 # Preprocess input image
-def preprocess_image(image_path):
-    img = load_img(image_path, target_size=(224, 224))
+def preprocess_image(image_path, thumbs=None):
+    if thumbs is not None:
+        img = thumbs.image(image_path, "rgb224")
+    else:
+        img = load_img(image_path, target_size=(224, 224))
     img_array = img_to_array(img)
     img_array = tf.keras.applications.mobilenet_v2.preprocess_input(img_array)
     return np.expand_dims(img_array, axis=0)
 
-# Check if the image contains at least 30% text
+# Decode, resize and preprocess one file inside the tf.data pipeline, as load_img and preprocess_image do
+def decode_image(image_path):
+    data = tf.io.read_file(image_path)
+    img = tf.io.decode_image(data, channels=3, expand_animations=False)
+    img = tf.cast(tf.image.resize(img, IMAGE_SIZE, method="nearest"), tf.float32)
+    return image_path, tf.keras.applications.mobilenet_v2.preprocess_input(img)
+
+# Batches of (paths, images), decoded and resized in parallel and prepared ahead of the model
+def image_dataset(image_paths, batch_size=BATCH_SIZE):
+    dataset = tf.data.Dataset.from_tensor_slices(image_paths)
+    dataset = dataset.map(decode_image, num_parallel_calls=tf.data.AUTOTUNE)
+    # A corrupt file drops out of the stream instead of ending it
+    dataset = dataset.apply(tf.data.experimental.ignore_errors())
+    return dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+# Batches of (paths, images) read from the thumbnail store; unreadable files are left out
+def thumb_batches(image_paths, thumbs, batch_size=BATCH_SIZE):
+    for start in range(0, len(image_paths), batch_size):
+        paths, images = [], []
+        for image_path in image_paths[start:start + batch_size]:
+            try:
+                images.append(preprocess_image(image_path, thumbs)[0])
+                paths.append(image_path)
+            except Exception:
+                continue
+        if paths:
+            yield paths, np.stack(images)
+
+# Yield (path, class probabilities) for every path, in order; probabilities are None if the file could not be read
+def predict_images(model, image_paths, thumbs=None, batch_size=BATCH_SIZE):
+    if not image_paths:
+        return
+    if thumbs is not None:
+        batches = thumb_batches(image_paths, thumbs, batch_size)
+    else:
+        batches = (([path.decode() for path in paths.numpy()], images)
+                   for paths, images in image_dataset(image_paths, batch_size))
+
+    remaining = iter(image_paths)
+    for paths, images in batches:
+        predictions = model.predict_on_batch(images)
+        for image_path, prediction in zip(paths, predictions):
+            # Paths skipped over were dropped from the stream
+            for skipped in remaining:
+                if skipped == image_path:
+                    break
+                yield skipped, None
+            yield image_path, prediction
+    for skipped in remaining:
+        yield skipped, None
+
+# Check if the image contains at least 30% text; images without enough text-like strokes are not OCRed
 def contains_text(image_path):
-    image = Image.open(image_path)
-    image_area = image.size[0] * image.size[1]
-    boxes = pytesseract.image_to_boxes(image)
-    text_area = 0
-    for box in boxes.splitlines():
-        b = box.split(' ')
-        x, y, w, h = int(b[1]), int(b[2]), int(b[3]), int(b[4])
-        text_area += (w - x) * (h - y)
-    text_percentage = (text_area / image_area) * 100
-    return text_percentage >= 30
+    text_percentage, _ = measure_file(image_path, "text_area")
+    return text_percentage >= TEXT_AREA_THRESHOLD
 
 # Predict image class
-def predict_image_class(model, image_path):
-    preprocessed_image = preprocess_image(image_path)
+def predict_image_class(model, image_path, thumbs=None):
+    preprocessed_image = preprocess_image(image_path, thumbs)
     predictions = model.predict(preprocessed_image, verbose=0)
-    predicted_class = CLASS_LABELS[np.argmax(predictions)]
-    confidence = np.max(predictions)
-    
+    return class_from_predictions(image_path, predictions)
+
+# Class and confidence of one image from the model's output for it, before the text check
+def model_class(predictions):
+    return CLASS_LABELS[np.argmax(predictions)], np.max(predictions)
+
+# Class and confidence of one image from the model's output for it
+def class_from_predictions(image_path, predictions):
+    predicted_class, confidence = model_class(predictions)
+
     # Check if the image contains text
     if predicted_class == "Document" and not contains_text(image_path):
         predicted_class = "Normal"
     
     return predicted_class, confidence
 
-# Process images in a folder and its subfolders
-def process_images_in_folder(model, folder_path):
+# Image files in a folder and its subfolders, outside the Error folders
+def list_images(folder_path):
+    image_paths = []
     for root, _, files in os.walk(folder_path):
         if "Error" in root:
             continue
         for file in files:
-            if file.lower().endswith(('png', 'jpg', 'jpeg', 'bmp', 'gif')) and not file.lower().endswith('xxjpg'):
-                file_path = os.path.join(root, file)
-                predicted_class, confidence = predict_image_class(model, file_path)
+            if file.lower().endswith(IMAGE_EXTENSIONS) and not file.lower().endswith('xxjpg'):
+                image_paths.append(os.path.join(root, file))
+    return image_paths
+
+# Process images in a folder and its subfolders
+def process_images_in_folder(model, folder_path, thumbs=None, batch_size=BATCH_SIZE, ocr_cache_path=None):
+    # Files are listed first, then predicted batch_size at a time while the next batches are decoded
+    results = predict_images(model, list_images(folder_path), thumbs, batch_size)
+    # The text check of a batch's "Document" images runs in a process pool and once per file contents
+    with TextDetector(ocr_cache_path) as detector:
+        for batch in iter(lambda: list(itertools.islice(results, batch_size)), []):
+            documents = [file_path for file_path, predictions in batch
+                         if predictions is not None and model_class(predictions)[0] == "Document"]
+            text_areas = detector.measure(documents, "text_area")
+
+            for file_path, predictions in batch:
+                if predictions is None:
+                    print(f"Error processing {file_path}: could not be decoded, left in place")
+                    continue
+                predicted_class, confidence = model_class(predictions)
+
+                # Check if the image contains text
+                if predicted_class == "Document" and not (text_areas[file_path] or 0) >= TEXT_AREA_THRESHOLD:
+                    predicted_class = "Normal"
+
                 print(f"File: {file_path}")
                 print(f"Predicted Class: {predicted_class}")
                 print(f"Confidence: {confidence:.2f}")
@@ -100,8 +188,9 @@ def process_images_in_folder(model, folder_path):
                 os.makedirs(target_dir, exist_ok=True)
 
                 # Move the file to the target directory
-                target_path = os.path.join(target_dir, file)
+                target_path = os.path.join(target_dir, os.path.basename(file_path))
                 shutil.move(file_path, target_path)
+        print(detector.summary())
 
 if __name__ == "__main__":
     # Load or fine-tune model
@@ -109,5 +198,12 @@ if __name__ == "__main__":
     # Path to folder containing images
     folder_path = "F:\\ULTFONE_20240829_175529\\E\\Lost Files\\File Name Lost\\jpg\\JPG\\2024\\Processed1\\300 x 200_Done"  # Update with actual folder path
 
+    # The store sits next to Processed1, shared with the scripts that run on the whole folder
+    thumbs = ThumbStore(store_folder_for(os.path.dirname(folder_path))) if USE_THUMB_STORE else None
+
     # Process images
-    process_images_in_folder(model, folder_path)
+    try:
+        process_images_in_folder(model, folder_path, thumbs, BATCH_SIZE, default_cache_path(folder_path))
+    finally:
+        if thumbs is not None:
+            thumbs.close()
@@ -0,0 +1,333 @@
+"""Decide whether images contain text without running OCR on every one.
+
+OCR is the slowest step of dupli.py and tensorflow_image_clasification.py.
+Before it runs, scan_text() looks at a downscaled edge map of the image:
+text is made of short strokes, so it shows up as tiles dense in both rising
+and falling edges, unlike flat areas, smooth photos and the outlines of
+objects. Edges are measured against each tile's own contrast, so gray or
+blurred text counts as well as black on white, and large images are scaled
+down only as far as MIN_TEXT_SIZE text stays legible. An image with too few
+such tiles cannot pass the caller's rule and is not OCRed at all; otherwise
+only the part of the image holding the tiles is.
+
+A TextDetector runs the OCR in a process pool and keeps every measurement
+in an SQLite cache keyed by a digest of the file contents, so a file is
+never OCRed twice, whatever it is renamed to or wherever it is moved.
+Images the prefilter skipped are cached with PREFILTER_VERSION and scanned
+again once it changes.
+"""
+import collections
+import os
+import signal
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+import pytesseract
+
+from thumb_store import content_digest
+
+# Longest side of the edge map the prefilter looks at, for images small enough
+PREFILTER_SIDE = 512
+# Smallest text, as font size in image pixels, the prefilter must not miss
+MIN_TEXT_SIZE = 24
+# Size that text is kept at in the edge map so its strokes stay apart; larger
+# images get a larger edge map instead of being scaled down further
+MAP_TEXT_SIZE = 6
+# Side of the square tiles the edge map is split into, in edge map pixels
+TILE = 16
+# Tiles whose brightness varies less than this (1st to 99th percentile) are flat
+MIN_TILE_CONTRAST = 32
+# Brightness step between neighbouring pixels that counts as a stroke edge,
+# as a share of the tile's contrast, so faint and blurred text counts too
+EDGE_SHARE = 0.4
+# Smallest stroke edge step, so sensor noise on paper does not count
+MIN_EDGE_STEP = 12
+# Share of a tile's pixels on stroke edges for it to look like text; strokes
+# have as many rising as falling edges, so only the rarer of the two counts
+MIN_TILE_EDGES = 0.08
+# Tiles denser than this are texture (grass, gravel, noise) rather than strokes
+MAX_TILE_EDGES = 0.6
+# Bump when the prefilter changes; images it skipped are checked again
+PREFILTER_VERSION = 2
+
+# What a TextDetector measures:
+#   words      number of words image_to_string finds (dupli.contains_text)
+#   text_area  percentage of the image covered by image_to_boxes boxes (tensorflow_image_clasification.contains_text)
+MODES = ("words", "text_area")
+# Images with fewer text tiles count as 0 words; dupli wants more than 10,
+# and ten words at MIN_TEXT_SIZE cover 6 tiles or more
+MIN_WORD_TILES = 5
+# Images with a smaller share of text tiles count as 0% text area; the classifier wants 30%
+MIN_TEXT_TILE_SHARE = 0.15
+
+# Processes running OCR
+OCR_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+# Bump when a measurement changes meaning; older caches are dropped, except
+# version 1, which only lacks the prefilter version
+SCHEMA_VERSION = 2
+CACHE_FILENAME = ".ocr_cache.sqlite"
+# Number of writes batched into one transaction
+COMMIT_EVERY = 1000
+
+# density is the share of tiles that look like text, tiles their number, and
+# region the (left, top, right, bottom) box around them in image pixels, or None
+TextScan = collections.namedtuple("TextScan", ["density", "tiles", "region"])
+
+def default_cache_path(root_folder):
+    """Default cache file for a scanned folder: next to it, so the scripts do not walk into it."""
+    return os.path.join(os.path.dirname(os.path.abspath(root_folder)), CACHE_FILENAME)
+
+def prefilter_size(size):
+    """Return the (width, height) of the edge map for an image of the given size."""
+    width, height = size
+    scale = min(1.0, max(PREFILTER_SIDE / max(width, height), MAP_TEXT_SIZE / MIN_TEXT_SIZE))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def scan_text(img, size=None):
+    """Estimate from a downscaled edge map how much of an image looks like text.
+
+    size is the (width, height) of the original image, if img was draft-decoded smaller.
+    """
+    width, height = size or img.size
+    edge_map = img.convert("L")
+    edge_map.thumbnail(prefilter_size((width, height)))
+    gray = np.asarray(edge_map, dtype=np.int16)
+    rows, columns = (gray.shape[0] - 1) // TILE, (gray.shape[1] - 1) // TILE
+    if rows == 0 or columns == 0:
+        return TextScan(0.0, 0, None)
+
+    def tiled(pixels):
+        return pixels[:rows * TILE, :columns * TILE].reshape(rows, TILE, columns, TILE)
+
+    # Edge step of each tile, relative to its contrast
+    pixels = tiled(gray).transpose(0, 2, 1, 3).reshape(rows, columns, TILE * TILE)
+    low, high = np.percentile(pixels, [1, 99], axis=-1)
+    contrast = high - low
+    step = np.maximum(EDGE_SHARE * contrast, MIN_EDGE_STEP)[:, None, :, None]
+
+    # Rising and falling edges between horizontal and vertical neighbours
+    rising = falling = 0
+    for diff in (tiled(np.diff(gray, axis=1)), tiled(np.diff(gray, axis=0))):
+        rising = rising + (diff > step).sum(axis=(1, 3))
+        falling = falling + (diff < -step).sum(axis=(1, 3))
+    shares = 2 * np.minimum(rising, falling) / (TILE * TILE)
+    text_tiles = (contrast >= MIN_TILE_CONTRAST) & (shares >= MIN_TILE_EDGES) & (shares <= MAX_TILE_EDGES)
+    count = int(text_tiles.sum())
+    if count == 0:
+        return TextScan(0.0, 0, None)
+
+    # Bounding box of the text tiles, one tile wider on every side, in image pixels
+    found_rows, found_columns = np.nonzero(text_tiles)
+    scale_x, scale_y = width / gray.shape[1], height / gray.shape[0]
+    region = (
+        max(0, int((found_columns.min() - 1) * TILE * scale_x)),
+        max(0, int((found_rows.min() - 1) * TILE * scale_y)),
+        min(width, int((found_columns.max() + 2) * TILE * scale_x)),
+        min(height, int((found_rows.max() + 2) * TILE * scale_y)),
+    )
+    return TextScan(count / text_tiles.size, count, region)
+
+def needs_ocr(scan, mode):
+    """Whether an image scanned by scan_text could pass the rule behind mode."""
+    if mode == "words":
+        return scan.tiles >= MIN_WORD_TILES
+    if mode == "text_area":
+        return scan.density >= MIN_TEXT_TILE_SHARE
+    raise ValueError(f"Unknown text measurement {mode!r}; expected one of {', '.join(MODES)}")
+
+def ocr_region(img, region, mode):
+    """OCR the region of a full-size image and return the measurement for mode."""
+    crop = img.crop(region)
+    if mode == "words":
+        text = pytesseract.image_to_string(crop)
+        return len(text.strip().split())
+    boxes = pytesseract.image_to_boxes(crop)
+    text_area = 0
+    for box in boxes.splitlines():
+        b = box.split(' ')
+        x, y, w, h = int(b[1]), int(b[2]), int(b[3]), int(b[4])
+        text_area += (w - x) * (h - y)
+    return text_area / (img.size[0] * img.size[1]) * 100
+
+def measure_image(img, mode):
+    """Return (measurement, whether OCR ran) for an open image."""
+    scan = scan_text(img)
+    if not needs_ocr(scan, mode):
+        return 0, False
+    return ocr_region(img, scan.region, mode), True
+
+def measure_file(image_path, mode):
+    """Return (measurement, whether OCR ran) for an image file, decoding it in full only for OCR."""
+    with Image.open(image_path) as img:
+        size = img.size
+        # Let the JPEG decoder scale down in the DCT for the prefilter; no-op for other formats
+        img.draft("L", prefilter_size(size))
+        scan = scan_text(img, size)
+    if not needs_ocr(scan, mode):
+        return 0, False
+    with Image.open(image_path) as img:
+        return ocr_region(img, scan.region, mode), True
+
+def _init_worker():
+    # Leave Ctrl-C handling to the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+class OcrCache:
+    """Measurements by content digest, plus path, size, mtime -> digest so unchanged files are not read again."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.pending_writes = 0
+        self._create_schema()
+
+    def _create_schema(self):
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version == 1:
+            # Version 1 did not record the prefilter: its OCR results stay, its skips are checked again
+            self.conn.execute("ALTER TABLE measurements ADD COLUMN prefilter INTEGER NOT NULL DEFAULT 0")
+            self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        elif version != SCHEMA_VERSION:
+            self.conn.execute("DROP TABLE IF EXISTS measurements")
+            self.conn.execute("DROP TABLE IF EXISTS paths")
+            self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS measurements (
+                digest BLOB NOT NULL,
+                mode TEXT NOT NULL,
+                value REAL NOT NULL,
+                ocr INTEGER NOT NULL,
+                prefilter INTEGER NOT NULL,
+                PRIMARY KEY (digest, mode)
+            )"""
+        )
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS paths (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                digest BLOB NOT NULL
+            )"""
+        )
+        self.conn.commit()
+
+    def key(self, path):
+        """Return the content digest of a file, reading it only if it changed or is new to the cache."""
+        stat_result = os.stat(path)
+        normalized = os.path.normcase(os.path.abspath(path))
+        found = self.conn.execute(
+            "SELECT digest FROM paths WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (normalized, stat_result.st_size, stat_result.st_mtime_ns),
+        ).fetchone()
+        if found is not None:
+            return found[0]
+        with open(path, "rb") as f:
+            digest = content_digest(f.read())
+        self.conn.execute("INSERT OR REPLACE INTO paths VALUES (?, ?, ?, ?)",
+                          (normalized, stat_result.st_size, stat_result.st_mtime_ns, digest))
+        self._written()
+        return digest
+
+    def get(self, digest, mode):
+        """Return the stored measurement, or None; a skip by another prefilter version counts as none."""
+        row = self.conn.execute(
+            "SELECT value FROM measurements WHERE digest = ? AND mode = ? AND (ocr = 1 OR prefilter = ?)",
+            (digest, mode, PREFILTER_VERSION),
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def put(self, digest, mode, value, ocr):
+        self.conn.execute("INSERT OR REPLACE INTO measurements VALUES (?, ?, ?, ?, ?)",
+                          (digest, mode, value, int(ocr), PREFILTER_VERSION))
+        self._written()
+
+    def _written(self):
+        self.pending_writes += 1
+        if self.pending_writes >= COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.pending_writes = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+class TextDetector:
+    """Text measurements of image files: prefiltered, OCRed in a process pool and cached.
+
+    With workers 0 the OCR runs in this process; with cache_path None nothing
+    is cached.
+    """
+
+    def __init__(self, cache_path=None, workers=OCR_WORKERS):
+        self.cache = OcrCache(cache_path) if cache_path else None
+        self.workers = workers
+        self.executor = None
+        self.cached = self.skipped = self.ocr_runs = self.errors = 0
+
+    def measure(self, image_paths, mode):
+        """Return {path: measurement} for image_paths; the measurement is None if the file could not be measured."""
+        if mode not in MODES:
+            raise ValueError(f"Unknown text measurement {mode!r}; expected one of {', '.join(MODES)}")
+        results, digests, missing = {}, {}, []
+        for image_path in image_paths:
+            if self.cache is not None:
+                try:
+                    digests[image_path] = self.cache.key(image_path)
+                except OSError as e:
+                    print(f"Error reading {image_path}: {e}")
+                    results[image_path] = None
+                    self.errors += 1
+                    continue
+                value = self.cache.get(digests[image_path], mode)
+                if value is not None:
+                    results[image_path] = value
+                    self.cached += 1
+                    continue
+            missing.append(image_path)
+
+        if self.workers > 0 and len(missing) > 1:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+            futures = [(image_path, self.executor.submit(measure_file, image_path, mode)) for image_path in missing]
+            outcomes = ((image_path, future.result) for image_path, future in futures)
+        else:
+            outcomes = ((image_path, lambda image_path=image_path: measure_file(image_path, mode)) for image_path in missing)
+
+        for image_path, outcome in outcomes:
+            try:
+                value, ocr = outcome()
+            except Exception as e:
+                print(f"Error performing OCR on {image_path}: {e}")
+                results[image_path] = None
+                self.errors += 1
+                continue
+            results[image_path] = value
+            if ocr:
+                self.ocr_runs += 1
+            else:
+                self.skipped += 1
+            if self.cache is not None:
+                self.cache.put(digests[image_path], mode, value, ocr)
+        return results
+
+    def summary(self):
+        return (f"Text detection: {self.ocr_runs} OCR runs, {self.skipped} skipped by the prefilter, "
+                f"{self.cached} from the cache, {self.errors} errors")
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+        if self.cache is not None:
+            self.cache.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,260 @@
+"""Decode each image once and keep standard-size thumbnails for every later stage.
+
+The workflow decodes every photo several times: dedup hashes it, classi2
+classifies it, dupli_across_size2 hashes it again and the face and yellow
+scripts open it once more. A ThumbStore decodes a file once, keeps fixed-size
+derivatives of it (KINDS) and hands those to the later stages instead.
+
+Thumbnails are keyed by a digest of the file contents, so they survive the
+renames and moves every stage makes. The store is a folder holding an SQLite
+index (digest -> row, and path, size, mtime -> digest so unchanged files are
+not read again) and, for every CHUNK_ROWS images, one .npy array per kind,
+memory-mapped when used. Thumbnails come from a draft-decoded image, so
+hashes computed from them can differ from a full decode by a bit or two;
+gray8 is made by hash_engine.hash_thumbnail instead, exactly as
+dupli_across_size2 hashes a file, so its hashes match bit for bit.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+
+import numpy as np
+from PIL import Image
+
+import hash_engine
+from prefetch import open_image
+
+# name -> (width, height, mode)
+KINDS = {
+    "gray8": (8, 8, "L"),
+    "gray32": (32, 32, "L"),
+    "rgb224": (224, 224, "RGB"),
+    # Aspect ratio kept, padded on the right and bottom; for face detection
+    "fit512": (512, 512, "RGB"),
+}
+# Kinds a new store keeps unless told otherwise; fit512 takes 768 KiB per image
+DEFAULT_KINDS = ("gray8", "gray32", "rgb224")
+# Kinds scaled to fit rather than stretched
+FIT_KINDS = {"fit512"}
+# Kinds made by hash_engine.hash_thumbnail from a decode of their own, so hashes
+# of them match dupli_across_size2.image_bits and its fingerprint cache
+HASH_KINDS = {"gray8"}
+# Bump when a kind is made differently; older stores are emptied and refilled
+LAYOUT_VERSION = 3
+# Images per chunk file
+CHUNK_ROWS = 1024
+# Number of writes batched into one transaction
+COMMIT_EVERY = 1000
+# Store folder name, created next to the scanned root so the scripts do not walk into it
+THUMB_STORE_FOLDER = ".thumb_store"
+INDEX_FILENAME = "index.sqlite"
+
+def content_digest(data):
+    """Identity of a file's contents."""
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+def store_folder_for(root_folder):
+    """Default store folder for a root folder: a sibling, outside the tree being processed."""
+    return os.path.join(os.path.dirname(os.path.abspath(root_folder)), THUMB_STORE_FOLDER)
+
+def fit_size(resolution, side):
+    """Size of an image of the given resolution scaled down to fit in side x side."""
+    width, height = resolution
+    scale = min(1.0, side / max(width, height, 1))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def make_thumbnails(img, kinds=DEFAULT_KINDS):
+    """Decode an open image once and return {kind: uint8 array} for the kinds asked for, except HASH_KINDS."""
+    kinds = [kind for kind in kinds if kind not in HASH_KINDS]
+    if not kinds:
+        return {}
+    largest = max(max(KINDS[kind][:2]) for kind in kinds)
+    # Let the JPEG decoder scale by up to 1/8 in the DCT; no-op for other formats
+    img.draft("RGB", (largest, largest))
+    rgb = img.convert("RGB")
+    gray = rgb.convert("L") if any(KINDS[kind][2] == "L" for kind in kinds) else None
+
+    thumbs = {}
+    for kind in kinds:
+        width, height, mode = KINDS[kind]
+        source = gray if mode == "L" else rgb
+        if kind in FIT_KINDS:
+            fitted = np.asarray(source.resize(fit_size(source.size, width), Image.Resampling.LANCZOS), dtype=np.uint8)
+            thumb = np.zeros((height, width) + fitted.shape[2:], dtype=np.uint8)
+            thumb[:fitted.shape[0], :fitted.shape[1]] = fitted
+        else:
+            thumb = np.asarray(source.resize((width, height), Image.Resampling.LANCZOS), dtype=np.uint8)
+        thumbs[kind] = thumb
+    return thumbs
+
+class ThumbStore:
+    """Thumbnails of image files, decoded once and read back from memory-mapped chunks.
+
+    kinds only matter when the store is created; an existing store keeps the
+    kinds it was created with.
+    """
+
+    def __init__(self, folder, kinds=DEFAULT_KINDS, chunk_rows=CHUNK_ROWS):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(folder, INDEX_FILENAME))
+        self.pending_writes = 0
+        self.chunks = {}
+        self._create_schema(kinds, chunk_rows)
+        self.count = self.conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM thumbs").fetchone()[0]
+
+    def _create_schema(self, kinds, chunk_rows):
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS thumbs (
+                digest BLOB PRIMARY KEY,
+                row INTEGER NOT NULL,
+                width INTEGER NOT NULL,
+                height INTEGER NOT NULL
+            )"""
+        )
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS paths (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                digest BLOB NOT NULL
+            )"""
+        )
+        saved = self.conn.execute("SELECT value FROM meta WHERE key = 'layout'").fetchone()
+        if saved is not None:
+            layout = json.loads(saved[0])
+            if layout.get("version") != LAYOUT_VERSION:
+                # Thumbnails of an older version may differ from what the scripts decode now
+                self._clear()
+                kinds, chunk_rows = layout["kinds"], layout["chunk_rows"]
+                saved = None
+        if saved is None:
+            for kind in kinds:
+                if kind not in KINDS:
+                    raise ValueError(f"Unknown thumbnail kind {kind!r}")
+            layout = {"kinds": list(kinds), "chunk_rows": chunk_rows, "version": LAYOUT_VERSION}
+            self.conn.execute("INSERT INTO meta VALUES ('layout', ?)", (json.dumps(layout),))
+        self.conn.commit()
+        self.kinds = tuple(layout["kinds"])
+        self.chunk_rows = layout["chunk_rows"]
+
+    def _clear(self):
+        """Drop every thumbnail; the path -> digest index stays valid and is kept."""
+        self.conn.execute("DELETE FROM thumbs")
+        self.conn.execute("DELETE FROM meta WHERE key = 'layout'")
+        for name in os.listdir(self.folder):
+            if name.endswith(".npy"):
+                os.remove(os.path.join(self.folder, name))
+
+    def __len__(self):
+        return self.count
+
+    def key(self, path, data=None):
+        """Return the content digest of a file, reading it only if it changed or is new to the store."""
+        stat_result = os.stat(path)
+        normalized = os.path.normcase(os.path.abspath(path))
+        found = self.conn.execute(
+            "SELECT digest FROM paths WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (normalized, stat_result.st_size, stat_result.st_mtime_ns),
+        ).fetchone()
+        if found is not None:
+            return found[0]
+        if data is None:
+            with open(path, "rb") as f:
+                data = f.read()
+        digest = content_digest(data)
+        self.conn.execute("INSERT OR REPLACE INTO paths VALUES (?, ?, ?, ?)",
+                          (normalized, stat_result.st_size, stat_result.st_mtime_ns, digest))
+        self._written()
+        return digest
+
+    def _chunk(self, index, kind):
+        chunk = self.chunks.get((index, kind))
+        if chunk is None:
+            chunk_path = os.path.join(self.folder, f"{index:05d}.{kind}.npy")
+            if os.path.exists(chunk_path):
+                chunk = np.load(chunk_path, mmap_mode="r+")
+            else:
+                width, height, mode = KINDS[kind]
+                shape = (self.chunk_rows, height, width) + ((3,) if mode == "RGB" else ())
+                chunk = np.lib.format.open_memmap(chunk_path, mode="w+", dtype=np.uint8, shape=shape)
+            self.chunks[(index, kind)] = chunk
+        return chunk
+
+    def _entry(self, path, data=None):
+        """Return (row, resolution) of a file, decoding and storing it first if needed."""
+        digest = self.key(path, data)
+        found = self.conn.execute("SELECT row, width, height FROM thumbs WHERE digest = ?", (digest,)).fetchone()
+        if found is not None:
+            return found[0], (found[1], found[2])
+
+        def open_source():
+            return open_image(data) if data is not None else Image.open(path)
+
+        with open_source() as img:
+            resolution = img.size
+            thumbs = make_thumbnails(img, self.kinds)
+        for kind in HASH_KINDS.intersection(self.kinds):
+            with open_source() as img:
+                thumbs[kind] = hash_engine.hash_thumbnail(img, size=KINDS[kind][:2])
+        row = self.count
+        for kind, thumb in thumbs.items():
+            self._chunk(row // self.chunk_rows, kind)[row % self.chunk_rows] = thumb
+        self.conn.execute("INSERT INTO thumbs VALUES (?, ?, ?, ?)", (digest, row, resolution[0], resolution[1]))
+        self.count += 1
+        self._written()
+        return row, resolution
+
+    def add(self, path, data=None):
+        """Decode a file into the store unless its contents are already there."""
+        self._entry(path, data)
+
+    def fetch(self, path, kind, data=None):
+        """Return a file's thumbnail of the given kind as a read-only uint8 array.
+
+        The file is decoded and stored first if needed. Fit kinds are cropped
+        to the scaled image, without the padding.
+        """
+        if kind not in self.kinds:
+            raise ValueError(f"Thumbnail store {self.folder} has no {kind!r} thumbnails (it keeps {', '.join(self.kinds)})")
+        row, resolution = self._entry(path, data)
+        thumb = self._chunk(row // self.chunk_rows, kind)[row % self.chunk_rows]
+        if kind in FIT_KINDS:
+            width, height = fit_size(resolution, KINDS[kind][0])
+            thumb = thumb[:height, :width]
+        thumb = thumb.view()
+        thumb.flags.writeable = False
+        return thumb
+
+    def image(self, path, kind, data=None):
+        """Return a file's thumbnail of the given kind as a PIL image."""
+        return Image.fromarray(np.ascontiguousarray(self.fetch(path, kind, data)), KINDS[kind][2])
+
+    def resolution(self, path, data=None):
+        """Return the (width, height) of the original image."""
+        return self._entry(path, data)[1]
+
+    def _written(self):
+        self.pending_writes += 1
+        if self.pending_writes >= COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        # Thumbnails reach the disk before the index rows pointing at them
+        for chunk in self.chunks.values():
+            chunk.flush()
+        self.conn.commit()
+        self.pending_writes = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+        self.chunks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -5,6 +5,10 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torchvision.transforms as transforms
+from image_loader import LOADER_WORKERS, load_batches
+
+# Images classified together in one forward pass
+BATCH_SIZE = 32
 
 # Define a simple convolutional neural network for image classification
 class SimpleCNN(nn.Module):
@@ -32,10 +36,39 @@ transform = transforms.Compose([
     transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
 ])
 
-# Create and load the model
-model = SimpleCNN(num_classes=4)  # 4 classes: Document, Screenshot, Meme, Photograph
-model.load_state_dict(torch.load('path/to/your/trained_model.pth'))  # Load your trained model weights
-model.eval()
+# Define your class mapping
+class_mapping = {
+    0: 'Document',
+    1: 'Screenshot',
+    2: 'Meme',
+    3: 'Photograph'
+}
+
+# Check probability threshold
+probability_threshold = 0.8  # Adjust as needed
+
+# The trained model, loaded by load_model() so loader worker processes do not load it too
+model = None
+
+def load_model():
+    global model
+    if model is None:
+        model = SimpleCNN(num_classes=4)  # 4 classes: Document, Screenshot, Meme, Photograph
+        model.load_state_dict(torch.load('path/to/your/trained_model.pth'))  # Load your trained model weights
+        model.eval()
+    return model
+
+def predict_batch(batch):
+    """Return the predicted category of each image in a stacked batch, 'Unknown' below the threshold."""
+    with torch.no_grad():
+        output = load_model()(batch)
+
+    # Get predicted class probabilities
+    probabilities = torch.softmax(output, dim=1)
+    top_probabilities, predicted_class_indices = torch.max(probabilities, 1)
+
+    return [class_mapping.get(index, 'Unknown') if probability >= probability_threshold else 'Unknown'
+            for probability, index in zip(top_probabilities.tolist(), predicted_class_indices.tolist())]
 
 def classify_image(image_path):
     """
@@ -52,57 +85,53 @@ def classify_image(image_path):
         img = Image.open(image_path)
         img_tensor = transform(img).unsqueeze(0)  # Add batch dimension
 
-        with torch.no_grad():
-            output = model(img_tensor)
-
-        # Get predicted class probabilities
-        probabilities = torch.softmax(output, dim=1) 
-        _, predicted_class_index = torch.max(probabilities, 1) 
-
-        # Define your class mapping
-        class_mapping = {
-            0: 'Document',
-            1: 'Screenshot',
-            2: 'Meme',
-            3: 'Photograph'
-        }
-
-        predicted_category = class_mapping.get(predicted_class_index.item(), 'Unknown')
-
-        # Check probability threshold
-        probability_threshold = 0.8  # Adjust as needed
-        top_probability, _ = torch.topk(probabilities, 1)
-        if top_probability.item() < probability_threshold:
-            predicted_category = 'Unknown' 
-
-        return predicted_category
+        return predict_batch(img_tensor)[0]
 
     except Exception as e:
         print(f"Error processing image {image_path}: {e}")
         return 'Unknown'
 
-def classify_and_move_images(root_dir):
+def move_to_category(file_path, predicted_category):
+    root, file = os.path.split(file_path)
+
+    # Create category subfolders if they don't exist
+    category_dir = os.path.join(root, predicted_category)
+    if not os.path.exists(category_dir):
+        os.makedirs(category_dir)
+
+    # Move the file to the appropriate category subfolder
+    new_file_path = os.path.join(category_dir, file)
+    shutil.move(file_path, new_file_path)
+
+def classify_and_move_images(root_dir, batch_size=BATCH_SIZE, workers=LOADER_WORKERS):
     """
     Classifies images in a given directory and moves them to respective subfolders.
 
     Args:
         root_dir: The root directory containing the images.
+        batch_size: Images classified together in one forward pass.
+        workers: Processes decoding and transforming images ahead of the model; 0 loads them in this process.
     """
 
-    for root, _, files in os.walk(root_dir):
-        for file in files:
-            if file.lower().endswith(('.jpg', '.jpeg')): 
-                file_path = os.path.join(root, file)
-                predicted_category = classify_image(file_path)
-
-                # Create category subfolders if they don't exist
-                category_dir = os.path.join(root, predicted_category)
-                if not os.path.exists(category_dir):
-                    os.makedirs(category_dir)
-
-                # Move the file to the appropriate category subfolder
-                new_file_path = os.path.join(category_dir, file)
-                shutil.move(file_path, new_file_path)
+    def image_paths():
+        for root, _, files in os.walk(root_dir):
+            for file in files:
+                if file.lower().endswith(('.jpg', '.jpeg')):
+                    yield os.path.join(root, file)
+
+    for batch in load_batches(image_paths(), transform, batch_size, workers):
+        for error in batch.errors:
+            print(f"Error processing image {error.item}: {error.stage} failed with {error.error_type}: {error.message}")
+            move_to_category(error.item, 'Unknown')
+        if not batch.items:
+            continue
+        try:
+            predicted_categories = predict_batch(batch.tensor)
+        except Exception as e:
+            print(f"Error classifying a batch of {len(batch.items)} images: {e}")
+            predicted_categories = ['Unknown'] * len(batch.items)
+        for file_path, predicted_category in zip(batch.items, predicted_categories):
+            move_to_category(file_path, predicted_category)
 
 if __name__ == "__main__":
     root_directory = "F:\\ULTFONE_20240829_175529\\E\\Lost Files\\File Name Lost\\jpg\\JPG\\2024\\Processed1\\300 x 200_Done"  # Replace with the actual root directory
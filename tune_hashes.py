@@ -0,0 +1,401 @@
+"""Tune the hash algorithm, hash size and distance threshold on a labeled corpus.
+
+Usage: python tune_hashes.py [--corpus DIR --manifest FILE] [--originals N] [--seed S]
+                             [--algorithm NAME ...] [--hash-size N ...]
+                             [--min-precision P] [--negative-samples N] [--repeat N]
+                             [--output results.json] [--config hash_config.json]
+
+Without --corpus the synthetic corpus of benchmark.py is generated in a
+temporary directory, labeled by its own manifest. A manifest for a real
+corpus is JSON mapping each path, relative to the corpus, to {"group": ...}:
+files sharing a group are copies of one original, group null is unique.
+
+Each script is scored on the hash function it runs itself:
+dupli_across_size.py on every algorithm and hash size (its hash_file), and
+dupli8_working.py and dupli_across_size2.py, whose hash is fixed, on theirs.
+Every hash gets its own timed passes over the corpus (images/sec, decoding
+included, fastest of --repeat). Every threshold from 0 to a quarter of the
+hash bits is then scored on file pairs: precision is the share of pairs
+within the threshold that are real duplicates, recall the share of real
+duplicate pairs within the threshold.
+
+Duplicate pairs are all compared. When the corpus has more than
+--negative-samples pairs, the other pairs are a uniform random sample of
+that many, scaled to the full count; rare false positives can then go
+unseen, so keep the sample well above the number of files. dupli_across_size2
+groups duplicates with union-find, so it is scored on the pairs inside its
+clusters instead, linking hashes with clustering.candidate_pairs one
+threshold at a time.
+
+The frontier lists the settings that no other setting matches or beats on
+precision, recall and throughput at once. The recommendation for
+dupli_across_size.py is its setting with the best recall among those
+reaching --min-precision, the fastest on a tie; the other scripts get the
+best threshold of their hash the same way. All of it is written to --config
+for the dedup scripts to load (see hash_config.py).
+"""
+import argparse
+import functools
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+import dupli8_working
+import dupli_across_size
+import hash_engine
+from benchmark import list_corpus_images, make_corpus
+from clustering import candidate_pairs, union_pairs
+from hash_config import DEFAULT_HASH_CONFIG_PATH, config_key, save_hash_config
+from hash_index import hash_to_int
+
+ALGORITHMS = ("ahash", "dhash", "phash", "whash")
+HASH_SIZES = (4, 8, 16)
+# Thresholds are tried up to this fraction of the hash bits
+MAX_THRESHOLD_FRACTION = 0.25
+# Smallest precision a recommended setting may have
+MIN_PRECISION = 0.99
+# Timed passes per hash; the fastest counts, to keep noise out of the throughput
+TIMING_REPEATS = 3
+# Non-duplicate pairs compared per hash; above this many pairs in the corpus they are sampled
+NEGATIVE_SAMPLES = 1_000_000
+# Pairs whose distances are computed at once
+DISTANCE_CHUNK_SIZE = 1_000_000
+
+def dupli_across_size_hash(image_path, algorithm, hash_size):
+    """dupli_across_size's hash of a file."""
+    return hash_to_int(dupli_across_size.hash_file(image_path, hash_size, algorithm)[0])
+
+def dupli8_hash(image_path):
+    """dupli8_working's hash of a file: imagehash's average hash."""
+    return hash_to_int(dupli8_working.hash_image(image_path))
+
+def dupli_across_size2_hash(image_path):
+    """dupli_across_size2's hash of a file, as its image_bits computes it.
+
+    The script itself is not imported: it opens its log file on import.
+    """
+    with Image.open(image_path) as img:
+        return int(hash_engine.ahash(hash_engine.hash_thumbnail(img)))
+
+# Scripts whose hash is fixed: (algorithm, hash size, hash function, whether duplicates are grouped transitively)
+FIXED_HASHES = {
+    "dupli8_working": ("ahash", 8, dupli8_hash, False),
+    "dupli_across_size2": ("ahash", 8, dupli_across_size2_hash, True),
+}
+
+def load_manifest(corpus_root, manifest_path):
+    """Return {absolute path: group} from a manifest of corpus-relative paths."""
+    with open(manifest_path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    return {os.path.join(corpus_root, path): entry["group"] for path, entry in manifest.items()}
+
+def hash_corpus(paths, hasher, repeat=1):
+    """Hash every path with hasher and return ({path: int hash}, seconds of the fastest pass)."""
+    best = None
+    for _ in range(repeat):
+        hashes = {}
+        start = time.perf_counter()
+        for path in paths:
+            try:
+                hashes[path] = hasher(path)
+            except Exception:
+                continue
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return hashes, best
+
+def _words(values, bits):
+    """Split int hashes into an (N, words) uint64 array, most significant word first."""
+    count = -(-bits // 64)
+    words = np.zeros((len(values), count), dtype=np.uint64)
+    for i, value in enumerate(values):
+        for w in range(count):
+            words[i, w] = (value >> (64 * (count - 1 - w))) & 0xFFFFFFFFFFFFFFFF
+    return words
+
+def _distances(words, first, second):
+    """Hamming distances between the hashes of each (first[i], second[i]) pair."""
+    distances = [np.zeros(0, dtype=np.int64)]
+    for start in range(0, len(first), DISTANCE_CHUNK_SIZE):
+        chunk = slice(start, start + DISTANCE_CHUNK_SIZE)
+        distances.append(hash_engine.hamming(words[first[chunk]], words[second[chunk]]).sum(axis=-1))
+    return np.concatenate(distances)
+
+def positive_pairs(group_ids):
+    """Return (first, second) index arrays of every pair of files sharing a group (ids of -1 share none)."""
+    first, second = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    if len(group_ids):
+        order = np.argsort(group_ids, kind="stable")
+        sorted_ids = group_ids[order]
+        starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+        for start, end in zip(starts, np.r_[starts[1:], len(order)]):
+            if sorted_ids[start] < 0 or end - start < 2:
+                continue
+            a, b = np.triu_indices(end - start, 1)
+            first.append(order[start + a])
+            second.append(order[start + b])
+    return np.concatenate(first), np.concatenate(second)
+
+def negative_pairs(group_ids, samples=NEGATIVE_SAMPLES, seed=0):
+    """Return (first, second, weight) index arrays of file pairs that are not duplicates.
+
+    With at most samples pairs in all, every such pair is returned, with
+    weight 1. Otherwise samples pairs are drawn uniformly with replacement
+    and weight is the number of non-duplicate pairs each stands for.
+    """
+    count = len(group_ids)
+    total = count * (count - 1) // 2
+    if total <= samples:
+        first, second = np.triu_indices(count, 1)
+        apart = (group_ids[first] != group_ids[second]) | (group_ids[first] < 0)
+        return first[apart], second[apart], 1.0
+
+    _, sizes = np.unique(group_ids[group_ids >= 0], return_counts=True)
+    negatives = total - int((sizes * (sizes - 1) // 2).sum())
+    if negatives == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), 1.0
+    rng = np.random.default_rng(seed)
+    first, second, drawn = [], [], 0
+    while drawn < samples:
+        a, b = rng.integers(0, count, samples - drawn), rng.integers(0, count, samples - drawn)
+        keep = (a != b) & ((group_ids[a] != group_ids[b]) | (group_ids[a] < 0))
+        first.append(np.minimum(a, b)[keep])
+        second.append(np.maximum(a, b)[keep])
+        drawn += int(keep.sum())
+    return np.concatenate(first), np.concatenate(second), negatives / drawn
+
+def duplicate_pairs(groups):
+    """Number of pairs sharing a group, ignoring group None."""
+    _, counts = np.unique([group for group in groups if group is not None], return_counts=True)
+    return int((counts * (counts - 1) // 2).sum())
+
+def _cluster_pairs(labels, group_ids):
+    """Return (pairs in the same cluster, of which in the same group) for cluster labels."""
+    _, sizes = np.unique(labels, return_counts=True)
+    labeled = group_ids >= 0
+    _, shared = np.unique(np.stack([labels[labeled], group_ids[labeled]]), axis=1, return_counts=True)
+    return int((sizes * (sizes - 1) // 2).sum()), int((shared * (shared - 1) // 2).sum())
+
+def _transitive_counts(values, group_ids, bits, thresholds):
+    """(threshold, pairs in a cluster, of which duplicates) after union-find linking, thresholds ascending."""
+    if bits > 64:
+        raise ValueError(f"Transitive scoring works on hashes of up to 64 bits, got {bits}")
+    hashes = np.array(values, dtype=np.uint64)
+    parent = np.arange(len(hashes), dtype=np.int64)
+    counts, linked = [], -1
+    for threshold in sorted(thresholds):
+        # Link the pairs farther apart than the previous threshold, one distance at a time
+        for distance in range(linked + 1, threshold + 1):
+            for a, b in candidate_pairs(hashes, distance, distance):
+                union_pairs(parent, a, b)
+        linked = threshold
+        counts.append((threshold, *_cluster_pairs(parent, group_ids)))
+    return counts
+
+def score_thresholds(values, groups, bits, positives, thresholds, transitive=False,
+                     samples=NEGATIVE_SAMPLES, seed=0):
+    """Return (threshold, precision, recall) for each threshold.
+
+    values and groups describe the hashed files; positives is the number of
+    real duplicate pairs in the whole corpus, so files that failed to hash
+    count against recall. Pairwise, non-duplicate pairs are sampled as
+    negative_pairs() does; transitive scoring links every pair.
+    """
+    group_index = {group: i for i, group in enumerate(dict.fromkeys(g for g in groups if g is not None))}
+    group_ids = np.array([group_index.get(group, -1) for group in groups], dtype=np.int64)
+
+    if transitive:
+        counts = _transitive_counts(values, group_ids, bits, thresholds)
+    else:
+        words = _words(values, bits)
+        top = max(thresholds)
+
+        def cumulative(first, second):
+            distances = np.minimum(_distances(words, first, second), top + 1)
+            return np.cumsum(np.bincount(distances, minlength=top + 2))
+
+        true = cumulative(*positive_pairs(group_ids))
+        first, second, weight = negative_pairs(group_ids, samples, seed)
+        false = cumulative(first, second) * weight
+        counts = [(threshold, int(true[threshold]) + float(false[threshold]), int(true[threshold]))
+                  for threshold in thresholds]
+
+    return [(threshold, true / predicted if predicted else 1.0, true / positives if positives else 1.0)
+            for threshold, predicted, true in counts]
+
+def sweep(file_groups, algorithms=ALGORITHMS, hash_sizes=HASH_SIZES, repeat=TIMING_REPEATS,
+          samples=NEGATIVE_SAMPLES, seed=0):
+    """Score every hash of every script at every threshold; return one result dict per setting."""
+    paths = sorted(file_groups)
+    positives = duplicate_pairs(file_groups.values())
+    # Read everything once so the page cache does not favor the later passes
+    for path in paths:
+        with open(path, "rb") as f:
+            f.read()
+
+    settings = []
+    for algorithm in algorithms:
+        for hash_size in hash_sizes:
+            if algorithm == "whash" and hash_size & (hash_size - 1):
+                print(f"Skipping whash/{hash_size}: whash needs a power of 2")
+                continue
+            hasher = functools.partial(dupli_across_size_hash, algorithm=algorithm, hash_size=hash_size)
+            settings.append(("dupli_across_size", algorithm, hash_size, hasher, False))
+    for script, (algorithm, hash_size, hasher, transitive) in FIXED_HASHES.items():
+        settings.append((script, algorithm, hash_size, hasher, transitive))
+
+    results = []
+    for script, algorithm, hash_size, hasher, transitive in settings:
+        hashes, seconds = hash_corpus(paths, hasher, repeat)
+        bits = hash_size * hash_size
+        hashed = sorted(hashes)
+        thresholds = range(int(bits * MAX_THRESHOLD_FRACTION) + 1)
+        scores = score_thresholds([hashes[path] for path in hashed], [file_groups[path] for path in hashed],
+                                  bits, positives, thresholds, transitive, samples, seed)
+        for threshold, precision, recall in scores:
+            results.append({
+                "script": script,
+                "algorithm": algorithm,
+                "hash_size": hash_size,
+                "bits": bits,
+                "max_distance": threshold,
+                "transitive": transitive,
+                "precision": precision,
+                "recall": recall,
+                "f1": 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+                "images_per_sec": len(paths) / seconds if seconds else None,
+                "errors": len(paths) - len(hashes),
+            })
+        print(f"{script:>18} {config_key(algorithm, hash_size):>9}: {len(paths) / seconds:.1f} images/sec, "
+              f"{len(paths) - len(hashes)} errors")
+    return results
+
+def _beats(a, b):
+    keys = ("precision", "recall", "images_per_sec")
+    return all(a[key] >= b[key] for key in keys) and any(a[key] > b[key] for key in keys)
+
+def frontier(results):
+    """Return the results no other result beats on precision, recall and throughput, fastest first.
+
+    Of the thresholds of one hash that score the same, only the lowest is kept.
+    """
+    best, seen = [], set()
+    for result in sorted(results, key=lambda result: result["max_distance"]):
+        scores = (result["script"], result["algorithm"], result["hash_size"], result["precision"], result["recall"])
+        if scores not in seen and not any(_beats(other, result) for other in results):
+            seen.add(scores)
+            best.append(result)
+    return sorted(best, key=lambda result: (-result["images_per_sec"], -result["recall"]))
+
+def recommend(results, min_precision=MIN_PRECISION):
+    """Return the result with the best recall at min_precision or better, the fastest on a tie.
+
+    If nothing reaches min_precision, the most precise result is returned.
+    """
+    if not results:
+        return None
+    qualified = [result for result in results if result["precision"] >= min_precision]
+    if not qualified:
+        return max(results, key=lambda result: (result["precision"], result["recall"]))
+    return max(qualified, key=lambda result: (result["recall"], result["images_per_sec"],
+                                              result["precision"], -result["max_distance"]))
+
+def recommended_config(results, min_precision=MIN_PRECISION, corpus=None):
+    """Return the configuration the dedup scripts load, from the sweep results."""
+    best = recommend([result for result in results if result["script"] == "dupli_across_size"], min_precision)
+    scripts = {}
+    for script in FIXED_HASHES:
+        candidates = [result for result in results if result["script"] == script
+                      and result["precision"] >= min_precision]
+        if candidates:
+            scripts[script] = recommend(candidates, min_precision)["max_distance"]
+    return {
+        "algorithm": best["algorithm"],
+        "hash_size": best["hash_size"],
+        "max_distance": best["max_distance"],
+        "precision": best["precision"],
+        "recall": best["recall"],
+        "images_per_sec": best["images_per_sec"],
+        "min_precision": min_precision,
+        "scripts": scripts,
+        "corpus": corpus or {},
+    }
+
+def _row(result):
+    return (f"{result['script']:>18} {config_key(result['algorithm'], result['hash_size']):>9} "
+            f"d<={result['max_distance']:<3} precision {result['precision']:.3f}  recall {result['recall']:.3f}  "
+            f"{result['images_per_sec']:.1f} images/sec")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", help="labeled corpus folder (default: generate a synthetic one)")
+    parser.add_argument("--manifest", help="manifest of the --corpus folder")
+    parser.add_argument("--originals", type=int, default=100, help="original images in the synthetic corpus")
+    parser.add_argument("--seed", type=int, default=0, help="synthetic corpus and pair sampling random seed")
+    parser.add_argument("--algorithm", action="append", choices=ALGORITHMS,
+                        help="dupli_across_size algorithm to try (default: all)")
+    parser.add_argument("--hash-size", action="append", type=int,
+                        help="dupli_across_size hash side in bits to try (default: 4, 8, 16)")
+    parser.add_argument("--min-precision", type=float, default=MIN_PRECISION,
+                        help="smallest precision a recommended setting may have")
+    parser.add_argument("--negative-samples", type=int, default=NEGATIVE_SAMPLES,
+                        help="non-duplicate pairs compared per hash; more pairs than this are sampled")
+    parser.add_argument("--repeat", type=int, default=TIMING_REPEATS, help="timed passes per hash, fastest counts")
+    parser.add_argument("--output", help="write every scored setting to this JSON file")
+    parser.add_argument("--config", default=DEFAULT_HASH_CONFIG_PATH, help="where to write the recommended configuration")
+    args = parser.parse_args()
+    if bool(args.corpus) != bool(args.manifest):
+        parser.error("--corpus and --manifest go together")
+
+    with tempfile.TemporaryDirectory() as scratch:
+        if args.corpus:
+            file_groups = load_manifest(args.corpus, args.manifest)
+            corpus = {"root": os.path.abspath(args.corpus), "manifest": os.path.abspath(args.manifest)}
+        else:
+            corpus_root = os.path.join(scratch, "corpus")
+            manifest = make_corpus(corpus_root, args.originals, args.seed)
+            file_groups = {os.path.join(corpus_root, path): entry["group"] for path, entry in manifest.items()}
+            corpus = {"synthetic": True, "originals": args.originals, "seed": args.seed}
+            unlabeled = set(list_corpus_images(corpus_root)) - set(file_groups)
+            file_groups.update(dict.fromkeys(unlabeled))
+        corpus["files"] = len(file_groups)
+        corpus["duplicate_pairs"] = duplicate_pairs(file_groups.values())
+        print(f"Corpus: {corpus['files']} files, {corpus['duplicate_pairs']} duplicate pairs")
+        if corpus["files"] * (corpus["files"] - 1) // 2 > args.negative_samples:
+            print(f"Sampling {args.negative_samples} non-duplicate pairs per hash")
+        results = sweep(file_groups, args.algorithm or ALGORITHMS, args.hash_size or HASH_SIZES,
+                        args.repeat, args.negative_samples, args.seed)
+
+    if not any(result["script"] == "dupli_across_size" for result in results):
+        print("Nothing was scored.")
+        return 1
+
+    print("\nFrontier (precision / recall / throughput):")
+    for result in frontier(results):
+        print("  " + _row(result))
+
+    config = recommended_config(results, args.min_precision, corpus)
+    best = recommend([result for result in results if result["script"] == "dupli_across_size"], args.min_precision)
+    if best["precision"] < args.min_precision:
+        print(f"\nNo dupli_across_size setting reaches precision {args.min_precision}; recommending the most precise one.")
+    print("\nRecommended: " + _row(best))
+    for script in FIXED_HASHES:
+        if script in config["scripts"]:
+            print(f"{script}: max_distance {config['scripts'][script]}")
+        else:
+            print(f"{script}: no threshold reaches precision {args.min_precision}; it keeps its own")
+    save_hash_config(config, args.config)
+    print(f"Wrote {args.config}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"corpus": corpus, "results": results, "frontier": frontier(results), "config": config}, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
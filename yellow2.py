@@ -3,37 +3,50 @@ import cv2
 import numpy as np
 import shutil
 import torch
+from prefetch import Prefetcher, decode_cv2
 
-# Load YOLO model
+# YOLO model
 MODEL_PATH = "D:\\Projects\\face_sorter\\yolov5s.pt"  # Pre-trained YOLOv5 model (download from official source)
-model = torch.hub.load('ultralytics/yolov5', 'custom', path=MODEL_PATH)
+model = None
 
-def detect_yellow_shirt(image_path):
+def load_model():
+    """Load the YOLO model on first use, so importing this module stays cheap."""
+    global model
+    if model is None:
+        model = torch.hub.load('ultralytics/yolov5', 'custom', path=MODEL_PATH)
+    return model
+
+def detect_yellow_shirt(image_path, data=None):
     try:
-        # Load image
-        image = cv2.imread(image_path)
+        # Load image, from memory if it was read ahead
+        image = decode_cv2(data) if data is not None else cv2.imread(image_path)
         if image is None:
             print(f"Warning: Failed to load image {image_path}. Skipping...")
             return False
+        return detect_yellow_shirts([image])[0]
+    except Exception as e:
+        print(f"Error processing {image_path}: {e}")
+        return False
 
-        image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-
-        # Perform detection
-        results = model(image_rgb)
-        detections = results.xyxy[0].cpu().numpy()
+def detect_yellow_shirts(images):
+    """Return for each decoded BGR image whether someone in it wears a yellow shirt.
 
+    The images go through YOLO as one batch.
+    """
+    results = load_model()([cv2.cvtColor(image, cv2.COLOR_BGR2RGB) for image in images])
+    found = []
+    for image, detections in zip(images, results.xyxy):
+        found.append(False)
         # Filter results for people
-        for det in detections:
+        for det in detections.cpu().numpy():
             x1, y1, x2, y2, conf, cls = det
             if int(cls) == 0:  # Class 0 in YOLOv5 is typically "person"
                 # Extract the upper body region (top half of the bounding box)
                 person_roi = image[int(y1):int(y1 + (y2 - y1) / 2), int(x1):int(x2)]
                 if is_wearing_yellow(person_roi):
-                    return True  # Yellow shirt detected
-        return False  # No yellow shirt detected
-    except Exception as e:
-        print(f"Error processing {image_path}: {e}")
-        return False
+                    found[-1] = True  # Yellow shirt detected
+                    break
+    return found
 
 def is_wearing_yellow(roi):
     try:
@@ -66,21 +79,29 @@ def process_folder(folder_path):
     found_folder = os.path.join(folder_path, "found_images")
     os.makedirs(found_folder, exist_ok=True)
 
-    for root, _, files in os.walk(folder_path):
-        for file in files:
-            if file.lower().endswith(valid_extensions) and not file.lower().endswith(".xxjpg"):
-                file_path = os.path.join(root, file)
-                print(f"Processing: {file_path}")
-                try:
-                    if detect_yellow_shirt(file_path):
-                        print(f"Yellow shirt detected: {file_path}")
-                        # Move the file to the "found_images" folder
-                        shutil.copy(file_path, os.path.join(found_folder, file))
-                except Exception as e:
-                    print(f"Error processing file {file_path}: {e}")
+    def image_files():
+        for root, _, files in os.walk(folder_path):
+            for file in files:
+                if file.lower().endswith(valid_extensions) and not file.lower().endswith(".xxjpg"):
+                    yield os.path.join(root, file)
+
+    # Files are read ahead while YOLO runs on the current one
+    prefetcher = Prefetcher(image_files())
+    for file_path, data, _ in prefetcher:
+        file = os.path.basename(file_path)
+        print(f"Processing: {file_path}")
+        try:
+            if detect_yellow_shirt(file_path, data):
+                print(f"Yellow shirt detected: {file_path}")
+                # Move the file to the "found_images" folder
+                shutil.copy(file_path, os.path.join(found_folder, file))
+        except Exception as e:
+            print(f"Error processing file {file_path}: {e}")
+    print(prefetcher.stats.summary())
 
 
-SOURCE_DIR = "F:\\ULTFONE_20240829_175529\\E\\Lost Files\\File Name Lost\\jpg\\JPG\\2024\\Processed1\\"
-# Example usage
-folder_path = SOURCE_DIR # Replace with the path to your folder
-process_folder(folder_path)
+if __name__ == "__main__":
+    SOURCE_DIR = "F:\\ULTFONE_20240829_175529\\E\\Lost Files\\File Name Lost\\jpg\\JPG\\2024\\Processed1\\"
+    # Example usage
+    folder_path = SOURCE_DIR # Replace with the path to your folder
+    process_folder(folder_path)